@@ -0,0 +1,327 @@
+import sys
+sys.path.append(".")
+import argparse
+import copy
+import json
+import os
+import platform
+import shutil
+import subprocess as sp
+import tempfile
+import time
+import multiprocessing as mp
+
+import numpy as np
+import torch
+
+from query_representation.query import *
+from evaluation.eval_fns import *
+from evaluation.plan_losses import PlanCost
+from cardinality_estimation.algs import *
+from cardinality_estimation.dataset import pad_sets
+from query_representation.db_backends import get_db_backend
+from benchmarks.synthetic import *
+
+'''
+Benchmarks for the hot paths of the CEB pipeline, run on synthetic qreps
+generated in-process, so no PostgreSQL instance is needed.
+
+Results are written as json; if a baseline json is given, each benchmark's
+median time is compared against it, and the run fails if any of them regressed
+by more than --regression_threshold.
+
+    python3 benchmarks/run_benchmarks.py --output results/bench.json
+    python3 benchmarks/run_benchmarks.py --baseline results/bench.json
+'''
+
+ALL_BENCHMARKS = ["load_qrep", "generate_subset_graph", "featurizer_combined",
+        "featurizer_set", "mscn_collate_fn", "pad_sets", "qerr", "plancost",
+        "ppc", "fcnn_epoch", "mscn_epoch"]
+
+def _time_fn(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+def _summarize(times, num_items):
+    res = {}
+    res["median"] = float(np.median(times))
+    res["min"] = float(np.min(times))
+    res["mean"] = float(np.mean(times))
+    res["repeats"] = len(times)
+    res["num_items"] = num_items
+    return res
+
+def _all_subplans(qreps):
+    subplans = []
+    for qrep in qreps:
+        nodes = list(qrep["subset_graph"].nodes())
+        if SOURCE_NODE in nodes:
+            nodes.remove(SOURCE_NODE)
+        nodes.sort()
+        for node in nodes:
+            subplans.append((qrep, node))
+    return subplans
+
+def bench_load_qrep(qreps, results):
+    tmp_dir = tempfile.mkdtemp()
+    fns = []
+    for i, qrep in enumerate(qreps):
+        fn = os.path.join(tmp_dir, str(i) + ".pkl")
+        save_qrep(fn, qrep)
+        fns.append(fn)
+
+    def _run():
+        for fn in fns:
+            load_qrep(fn)
+
+    times = _time_fn(_run, args.repeats)
+    shutil.rmtree(tmp_dir)
+    results["load_qrep"] = _summarize(times, len(fns))
+
+def bench_generate_subset_graph(qreps, results):
+    for num_tables in args.subset_graph_tables.split(","):
+        num_tables = int(num_tables)
+        join_graph = gen_synthetic_join_graph(num_tables, args.seed)
+        num_subplans = []
+        def _run():
+            num_subplans.append(len(generate_subset_graph(join_graph)))
+        times = _time_fn(_run, args.repeats)
+        key = "generate_subset_graph-" + str(num_tables)
+        results[key] = _summarize(times, num_subplans[-1])
+
+def _bench_featurizer(qreps, results, feat_type):
+    featurizer = get_synthetic_featurizer(qreps, feat_type)
+    subplans = _all_subplans(qreps)
+    def _run():
+        for qrep, node in subplans:
+            featurizer.get_subplan_features(qrep, node)
+    times = _time_fn(_run, args.repeats)
+    results["featurizer_" + feat_type] = _summarize(times, len(subplans))
+
+def bench_featurizer_combined(qreps, results):
+    _bench_featurizer(qreps, results, "combined")
+
+def bench_featurizer_set(qreps, results):
+    _bench_featurizer(qreps, results, "set")
+
+def _get_set_batches(qreps):
+    featurizer = get_synthetic_featurizer(qreps, "set")
+    subplans = _all_subplans(qreps)
+    batch = []
+    for i, (qrep, node) in enumerate(subplans):
+        x,y = featurizer.get_subplan_features(qrep, node)
+        batch.append((x, y, {"query_idx" : i}))
+
+    batches = []
+    for i in range(0, len(batch), args.mb_size):
+        batches.append(batch[i:i+args.mb_size])
+    return batches, len(batch)
+
+def bench_mscn_collate_fn(qreps, results):
+    batches, num_items = _get_set_batches(qreps)
+    def _run():
+        for batch in batches:
+            mscn_collate_fn(batch)
+    times = _time_fn(_run, args.repeats)
+    results["mscn_collate_fn"] = _summarize(times, num_items)
+
+def bench_pad_sets(qreps, results):
+    batches, num_items = _get_set_batches(qreps)
+    padargs = []
+    for batch in batches:
+        tabs = [d[0]["table"] for d in batch]
+        preds = [d[0]["pred"] for d in batch]
+        joins = [d[0]["join"] for d in batch]
+        padargs.append((tabs, preds, joins, max([len(t) for t in tabs]),
+                max([len(p) for p in preds]), max([len(j) for j in joins])))
+    def _run():
+        for pa in padargs:
+            pad_sets(*pa)
+    times = _time_fn(_run, args.repeats)
+    results["pad_sets"] = _summarize(times, num_items)
+
+def bench_qerr(qreps, results):
+    ests = Postgres().test(qreps)
+    qerr = QError()
+    def _run():
+        qerr.eval(qreps, ests, result_dir=None)
+    times = _time_fn(_run, args.repeats)
+    results["qerr"] = _summarize(times, len(_all_subplans(qreps)))
+
+def bench_plancost(qreps, results):
+    # compute_costs adds the SOURCE node to the subset graphs, so we work on
+    # a copy to leave the other benchmarks unaffected
+    qreps = copy.deepcopy(qreps)
+    ests = Postgres().test(qreps)
+    pc = PlanCost("C")
+    pool = mp.Pool(args.num_processes)
+    def _run():
+        pc.compute_costs(qreps, ests, pool=pool)
+    times = _time_fn(_run, args.repeats)
+    pool.close()
+    results["plancost"] = _summarize(times, len(qreps))
+
+def bench_ppc(qreps, results):
+    # the local backend answers the EXPLAINs, so this times the python side
+    # of PPC (hint generation, join order extraction, pooling)
+    db_backend = get_db_backend("local", qreps=qreps)
+    ests = Postgres().test(qreps)
+    ppc = PostgresPlanCost()
+    def _run():
+        ppc.eval(qreps, ests, num_processes=args.num_processes,
+                result_dir=None, db_backend=db_backend)
+    times = _time_fn(_run, args.repeats)
+    results["ppc"] = _summarize(times, len(qreps))
+
+def _bench_nn_epoch(qreps, results, alg_name):
+    torch.manual_seed(args.seed)
+    if alg_name == "fcnn":
+        featurizer = get_synthetic_featurizer(qreps, "combined")
+        alg = FCNN(max_epochs = 0, lr=0.0001, mb_size = args.mb_size,
+                weight_decay = 0.0, load_query_together = False,
+                result_dir = None, num_hidden_layers=2, eval_epoch = 1,
+                optimizer_name="adamw", clip_gradient=20.0,
+                loss_func_name = "mse", hidden_layer_size = 128)
+    else:
+        featurizer = get_synthetic_featurizer(qreps, "set")
+        alg = MSCN(max_epochs = 0, lr=0.0001, mb_size = args.mb_size,
+                load_padded_mscn_feats = False,
+                weight_decay = 0.0, load_query_together = False,
+                result_dir = None, num_hidden_layers=2, eval_epoch = 1,
+                optimizer_name="adamw", clip_gradient=20.0,
+                loss_func_name = "mse", hidden_layer_size = 128)
+
+    # with max_epochs = 0, train only sets up the dataset and the network
+    alg.train(qreps, valqs=[], testqs=[], featurizer=featurizer,
+            result_dir=None)
+    times = _time_fn(alg.train_one_epoch, args.repeats)
+    results[alg_name + "_epoch"] = _summarize(times, len(alg.trainds))
+
+def bench_fcnn_epoch(qreps, results):
+    _bench_nn_epoch(qreps, results, "fcnn")
+
+def bench_mscn_epoch(qreps, results):
+    _bench_nn_epoch(qreps, results, "mscn")
+
+def get_meta():
+    meta = {}
+    meta["timestamp"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    meta["python"] = platform.python_version()
+    meta["platform"] = platform.platform()
+    meta["numpy"] = np.__version__
+    meta["torch"] = torch.__version__
+    meta["networkx"] = nx.__version__
+    try:
+        meta["git_commit"] = sp.check_output(["git", "rev-parse", "HEAD"],
+                stderr=sp.DEVNULL).decode("utf-8").strip()
+    except Exception:
+        meta["git_commit"] = None
+    meta["args"] = vars(args)
+    return meta
+
+def compare_to_baseline(results, baseline):
+    '''
+    @ret: list of benchmark names that regressed.
+    '''
+    regressions = []
+    print("{:<32} {:>12} {:>12} {:>8}".format("benchmark", "baseline(s)",
+        "current(s)", "ratio"))
+    for name, res in sorted(results.items()):
+        if name not in baseline:
+            print("{:<32} {:>12} {:>12.4f} {:>8}".format(name, "-",
+                res["median"], "-"))
+            continue
+        base = baseline[name]["median"]
+        ratio = res["median"] / max(base, 1e-9)
+        flag = ""
+        if ratio > args.regression_threshold:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print("{:<32} {:>12.4f} {:>12.4f} {:>8.2f}{}".format(name, base,
+            res["median"], ratio, flag))
+
+    return regressions
+
+def main():
+    if args.benchmarks == "all":
+        benchmarks = ALL_BENCHMARKS
+    else:
+        benchmarks = args.benchmarks.split(",")
+
+    table_counts = [int(t) for t in args.table_counts.split(",")]
+    qreps = gen_synthetic_workload(table_counts, args.num_templates,
+            args.queries_per_template, seed=args.seed)
+    print("generated {} synthetic queries with {} subplans".format(
+        len(qreps), len(_all_subplans(qreps))))
+
+    results = {}
+    for bench in benchmarks:
+        start = time.time()
+        globals()["bench_" + bench](qreps, results)
+        print("benchmark {} took {} seconds".format(bench,
+            round(time.time()-start, 2)))
+
+    out = {}
+    out["meta"] = get_meta()
+    out["results"] = results
+
+    if args.output is not None:
+        out_dir = os.path.dirname(args.output)
+        if out_dir != "":
+            make_dir(out_dir)
+        with open(args.output, "w") as f:
+            json.dump(out, f, indent=2)
+        print("wrote results to: ", args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_to_baseline(results, baseline)
+        if len(regressions) > 0:
+            print("regressions in: ", ",".join(regressions))
+            sys.exit(1)
+    else:
+        for name, res in sorted(results.items()):
+            print("{:<32} median: {:.4f}s, per item: {:.2e}s".format(name,
+                res["median"], res["median"] / max(res["num_items"], 1)))
+
+def read_flags():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmarks", type=str, required=False,
+            default="all", help="""comma separated list, from: """ + \
+                    ",".join(ALL_BENCHMARKS))
+    parser.add_argument("--table_counts", type=str, required=False,
+            default="4,6,8", help="""number of tables in the synthetic
+            templates.""")
+    parser.add_argument("--subset_graph_tables", type=str, required=False,
+            default="4,8,12,14")
+    parser.add_argument("--num_templates", type=int, required=False,
+            default=6)
+    parser.add_argument("--queries_per_template", type=int, required=False,
+            default=20)
+    parser.add_argument("--repeats", type=int, required=False,
+            default=3)
+    parser.add_argument("--mb_size", type=int, required=False,
+            default=1024)
+    parser.add_argument("--num_processes", type=int, required=False,
+            default=2)
+    parser.add_argument("--seed", type=int, required=False,
+            default=1234)
+    parser.add_argument("--output", type=str, required=False,
+            default=None, help="""json file to write the results to; can be
+            used as the --baseline in later runs.""")
+    parser.add_argument("--baseline", type=str, required=False,
+            default=None)
+    parser.add_argument("--regression_threshold", type=float, required=False,
+            default=1.25, help="""ratio of current / baseline median times
+            above which a benchmark is considered to have regressed.""")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = read_flags()
+    main()
@@ -0,0 +1,288 @@
+import sys
+sys.path.append(".")
+import random
+import sqlite3
+import numpy as np
+import networkx as nx
+
+from query_representation.utils import *
+from cardinality_estimation.featurizer import Featurizer
+
+'''
+Generates synthetic qrep objects in-process, so the hot paths of the CEB
+pipeline (featurization, evaluation, training) can be exercised without a
+PostgreSQL instance or the downloaded workloads.
+
+The synthetic join graphs are random trees over a fixed pool of relations; each
+relation joins its parent with a `ref_id = id` foreign key, and has at most one
+predicate filter (IN, range, or ILIKE), mirroring the structure of the CEB
+templates. Cardinalities follow the usual independence + foreign key
+assumptions, with some noise, so the true / estimated values have realistic
+magnitudes.
+'''
+
+MAX_SYNTHETIC_TABLES = 16
+TABLE_NAME_FMT = "rel{}"
+ALIAS_NAME_FMT = "r{}"
+
+NUM_KINDS = 20
+KIND_FMT = "kind_{}"
+MIN_YEAR = 1900
+MAX_YEAR = 2020
+NUM_NAMES = 100000
+NAME_CHARS = "abcdefghijklmnopqrstuvwxyz"
+
+PRED_TYPES = ["in", "lt", "ilike", None]
+
+SQLITE_COLUMNS = ["id", "ref_id", "kind", "year"]
+SQLITE_COLUMN_TYPES = {"id": "INTEGER", "ref_id": "INTEGER", "kind": "TEXT",
+        "year": "INTEGER", "name": "TEXT"}
+
+def _table_rows(tidx):
+    # deterministic per relation, so all templates agree on the table sizes
+    rng = np.random.RandomState(tidx)
+    return int(10**rng.uniform(3, 7))
+
+def _gen_predicate(alias, pred_type, rng):
+    '''
+    @ret: predicate strings, and the pred_cols, pred_types, pred_vals lists in
+    the same format as extract_predicates.
+    '''
+    if pred_type == "in":
+        col = alias + ".kind"
+        num_vals = rng.randint(1, 6)
+        vals = list(set([KIND_FMT.format(rng.randint(0, NUM_KINDS))
+                for _ in range(num_vals)]))
+        vals.sort()
+        val_str = ",".join(["'{}'".format(v) for v in vals])
+        preds = ["{} IN ({})".format(col, val_str)]
+        return preds, [col], ["in"], [vals], len(vals) / float(NUM_KINDS)
+
+    elif pred_type == "lt":
+        col = alias + ".year"
+        lower = rng.randint(MIN_YEAR, MAX_YEAR-1)
+        upper = rng.randint(lower+1, MAX_YEAR+1)
+        preds = ["{} >= {}".format(col, lower), "{} <= {}".format(col, upper)]
+        sel = (upper - lower) / float(MAX_YEAR - MIN_YEAR)
+        return preds, [col], ["lt"], [[lower, upper]], sel
+
+    elif pred_type == "ilike":
+        col = alias + ".name"
+        num_chars = rng.randint(1, 4)
+        filt = "".join([NAME_CHARS[rng.randint(0, len(NAME_CHARS))]
+                for _ in range(num_chars)])
+        filt = "%" + filt + "%"
+        preds = ["{} ILIKE '{}'".format(col, filt)]
+        sel = min(1.0, 0.5 / (num_chars**2))
+        return preds, [col], ["ilike"], [[filt]], sel
+
+    return [], [], [], [], 1.0
+
+def gen_synthetic_join_graph(num_tables, seed):
+    '''
+    @ret: nx.Graph in the same format as extract_join_graph; the shape only
+    depends on the seed, so it plays the role of a template.
+    '''
+    assert num_tables <= MAX_SYNTHETIC_TABLES
+    rng = random.Random(seed)
+    tidxs = rng.sample(range(MAX_SYNTHETIC_TABLES), num_tables)
+
+    join_graph = nx.Graph()
+    for i, tidx in enumerate(tidxs):
+        alias = ALIAS_NAME_FMT.format(tidx)
+        join_graph.add_node(alias)
+        join_graph.nodes()[alias]["real_name"] = TABLE_NAME_FMT.format(tidx)
+        join_graph.nodes()[alias]["table_idx"] = tidx
+        if i == 0:
+            continue
+        parent = ALIAS_NAME_FMT.format(tidxs[rng.randint(0, i-1)])
+        join_graph.add_edge(alias, parent)
+        join_graph[alias][parent]["join_condition"] = \
+                "{}.ref_id = {}.id".format(alias, parent)
+
+    return join_graph
+
+def gen_synthetic_qrep(num_tables, template_seed, query_seed,
+        template_name=None):
+    '''
+    @num_tables: number of relations in the join graph.
+    @template_seed: determines the join graph, and the predicate types.
+    @query_seed: determines the predicate values, and the cardinalities.
+
+    @ret: qrep dict, in the same format as returned by load_qrep.
+    '''
+    join_graph = gen_synthetic_join_graph(num_tables, template_seed)
+    trng = random.Random(template_seed)
+    rng = np.random.RandomState(query_seed)
+
+    singles = {}
+    for alias in sorted(join_graph.nodes()):
+        info = join_graph.nodes()[alias]
+        pred_type = PRED_TYPES[trng.randint(0, len(PRED_TYPES)-1)]
+        preds, cols, types, vals, sel = _gen_predicate(alias, pred_type, rng)
+        info["predicates"] = preds
+        info["pred_cols"] = cols
+        info["pred_types"] = types
+        info["pred_vals"] = vals
+        rows = _table_rows(info["table_idx"])
+        singles[alias] = (rows, max(sel*rng.uniform(0.2, 1.0), 1.0 / rows))
+
+    subset_graph = nx.OrderedDiGraph(generate_subset_graph(join_graph))
+    for node in subset_graph.nodes():
+        # independence + fkey assumption: each ref_id = id join scales the
+        # result with the selectivity of the primary key side.
+        log_card = 0.0
+        log_total = 0.0
+        for alias in node:
+            rows, sel = singles[alias]
+            log_card += np.log(rows*sel)
+            log_total += np.log(rows)
+        for a1, a2 in join_graph.subgraph(node).edges():
+            pk_alias = join_graph[a1][a2]["join_condition"].split("=")[1]
+            pk_alias = pk_alias.strip().split(".")[0]
+            log_card -= np.log(singles[pk_alias][0])
+            log_total -= np.log(singles[pk_alias][0])
+        if len(node) > 1:
+            log_card += rng.normal(0.0, 1.0)
+
+        actual = max(1, int(np.exp(min(log_card, 40.0))))
+        expected = max(1, int(np.exp(min(log_card + rng.normal(0.0, 1.5),
+            40.0))))
+        total = max(float(actual), float(np.exp(min(log_total, 80.0))))
+
+        subset_graph.nodes()[node]["cardinality"] = {}
+        cards = subset_graph.nodes()[node]["cardinality"]
+        cards["actual"] = actual
+        cards["expected"] = expected
+        cards["total"] = total
+
+    for alias in join_graph.nodes():
+        del join_graph.nodes()[alias]["table_idx"]
+
+    qrep = {}
+    qrep["sql"] = nx_graph_to_query(join_graph)
+    qrep["join_graph"] = join_graph
+    qrep["subset_graph"] = subset_graph
+    if template_name is None:
+        template_name = "syn" + str(num_tables) + "-" + str(template_seed)
+    qrep["template_name"] = template_name
+    qrep["name"] = template_name + "-" + str(query_seed) + ".pkl"
+    return qrep
+
+def gen_synthetic_workload(table_counts, num_templates, queries_per_template,
+        seed=1234):
+    '''
+    @table_counts: list of ints; templates are evenly split between these.
+    @ret: [qreps]
+    '''
+    qreps = []
+    for ti in range(num_templates):
+        num_tables = table_counts[ti % len(table_counts)]
+        template_seed = seed + ti
+        for qi in range(queries_per_template):
+            query_seed = seed*1000 + ti*queries_per_template + qi
+            qreps.append(gen_synthetic_qrep(num_tables, template_seed,
+                query_seed))
+    return qreps
+
+def get_synthetic_column_stats(qreps):
+    '''
+    @ret: column_stats dict, in the same format as computed by
+    Featurizer._update_stats, for every predicate column in qreps.
+    '''
+    column_stats = {}
+    for qrep in qreps:
+        for alias, info in qrep["join_graph"].nodes(data=True):
+            for col in info["pred_cols"]:
+                if col in column_stats:
+                    continue
+                rows = _table_rows(int(info["real_name"].replace("rel", "")))
+                stats = {}
+                stats["total_values"] = rows
+                if col.endswith(".year"):
+                    stats["min_value"] = MIN_YEAR
+                    stats["max_value"] = MAX_YEAR
+                    stats["num_values"] = MAX_YEAR - MIN_YEAR + 1
+                    stats["unique_values"] = [(y,) for y in
+                            range(MIN_YEAR, MAX_YEAR+1)]
+                elif col.endswith(".kind"):
+                    stats["min_value"] = KIND_FMT.format(0)
+                    stats["max_value"] = KIND_FMT.format(NUM_KINDS-1)
+                    stats["num_values"] = NUM_KINDS
+                    stats["unique_values"] = [(KIND_FMT.format(k),) for k in
+                            range(NUM_KINDS)]
+                else:
+                    stats["min_value"] = "a"
+                    stats["max_value"] = "z"
+                    stats["num_values"] = NUM_NAMES
+                    stats["unique_values"] = None
+                column_stats[col] = stats
+    return column_stats
+
+def get_synthetic_featurizer(qreps, featurization_type="combined",
+        **setup_kwargs):
+    '''
+    Featurizer whose column statistics are filled in from the synthetic
+    generator, so update_column_stats does not need to query the DB.
+    '''
+    featurizer = Featurizer(None, None, None, None, None)
+    featurizer.column_stats = get_synthetic_column_stats(qreps)
+    featurizer.update_column_stats(qreps)
+    featurizer.setup(ynormalization="log",
+            featurization_type=featurization_type, **setup_kwargs)
+    featurizer.update_ystats(qreps)
+    return featurizer
+
+class SqliteBackend():
+    '''
+    db backend (see query_representation/db_backends.py) connecting to a
+    sqlite db, e.g., from load_synthetic_sqlite.
+    '''
+    def __init__(self, db_fn):
+        self.db_fn = db_fn
+
+    def connect(self, user, pwd, db_host, port, db_name):
+        return sqlite3.connect(self.db_fn)
+
+def _sqlite_value(col, i, num_rows, rng):
+    if col == "id":
+        return i
+    elif col == "ref_id":
+        return int(rng.randint(0, num_rows // 4))
+    elif col == "kind":
+        return KIND_FMT.format(rng.randint(0, NUM_KINDS))
+    elif col == "year":
+        return int(rng.randint(MIN_YEAR, MAX_YEAR+1))
+    elif col == "name":
+        return "n" + str(i % 7)
+    else:
+        assert False, "no synthetic values for column {}".format(col)
+
+def load_synthetic_sqlite(db_fn, qreps, num_rows=300, columns=SQLITE_COLUMNS):
+    '''
+    Creates every table of qreps in a sqlite db, with num_rows random rows,
+    so the synthetic sqls can actually be executed (without ILIKE, which
+    sqlite does not support).
+    @db_fn: sqlite db file, or ":memory:".
+    @columns: columns of every table, from SQLITE_COLUMN_TYPES.
+    @ret: connection to the db.
+    '''
+    con = sqlite3.connect(db_fn)
+    cursor = con.cursor()
+    rng = np.random.RandomState(0)
+    tables = set()
+    for qrep in qreps:
+        for _, info in qrep["join_graph"].nodes(data=True):
+            tables.add(info["real_name"])
+
+    for table in sorted(tables):
+        cursor.execute("CREATE TABLE {} ({})".format(table, ", ".join(
+            ["{} {}".format(col, SQLITE_COLUMN_TYPES[col]) for col in columns])))
+        rows = []
+        for i in range(num_rows):
+            rows.append(tuple([_sqlite_value(col, i, num_rows, rng)
+                for col in columns]))
+        cursor.executemany("INSERT INTO {} VALUES ({})".format(table,
+            ",".join(["?"]*len(columns))), rows)
+    con.commit()
+    return con
@@ -7,16 +7,21 @@ import json
 import sys
 import xgboost as xgb
 import random
+import copy
+import functools
 import torch
 from collections import defaultdict
 
 from query_representation.utils import *
-from .dataset import QueryDataset, pad_sets, to_variable
+from query_representation.query import load_qrep
+from .dataset import QueryDataset, QueryStream, pad_sets, to_variable, \
+        get_feature_matrix, collate_queries
 from .nets import *
 
 from torch.utils import data
 from torch.nn.utils.clip_grad import clip_grad_norm_
-from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.ensemble import GradientBoostingRegressor, RandomForestRegressor
+from sklearn.model_selection import RandomizedSearchCV
 
 class CardinalityEstimationAlg():
 
@@ -286,23 +291,108 @@ class Random(CardinalityEstimationAlg):
             preds.append(pred_dict)
         return preds
 
+def _iter_chunks(samples, chunk_size):
+    '''
+    @samples: [] qrep dicts, or qrep files.
+    @ret: generator of the chunks of chunk_size qrep dicts.
+    '''
+    for i in range(0, len(samples), chunk_size):
+        chunk = samples[i:i+chunk_size]
+        yield [load_qrep(qrep) if isinstance(qrep, str) else qrep
+                for qrep in chunk]
+
+class QueryMatrixIter(xgb.DataIter):
+    '''
+    Featurizes the samples for xgboost chunk by chunk, so the qreps of the
+    whole workload are never loaded at once. xgboost makes several passes over
+    the chunks; with cache_chunks, each chunk's feature matrix is only
+    computed in the first pass, and kept for the next ones (e.g., for a
+    QuantileDMatrix); otherwise, every pass featurizes them again, so that
+    with a cache_prefix, a DMatrix built from it is kept in external memory
+    (on disk).
+    '''
+    def __init__(self, samples, featurizer, chunk_size, cache_prefix=None,
+            cache_chunks=False):
+        self.samples = samples
+        self.featurizer = featurizer
+        self.chunk_size = chunk_size
+        self.cache_chunks = cache_chunks
+        self.chunks = None
+        # feature matrices of the chunks, after a complete pass
+        self.matrices = None
+        self.pass_matrices = []
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self.matrices is not None:
+            XY = next(self.chunks, None)
+        else:
+            if self.chunks is None:
+                self.chunks = _iter_chunks(self.samples, self.chunk_size)
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                if self.cache_chunks:
+                    self.matrices = self.pass_matrices
+                XY = None
+            else:
+                XY = get_feature_matrix(self.featurizer, chunk)
+                if self.cache_chunks:
+                    self.pass_matrices.append(XY)
+        if XY is None:
+            return False
+        input_data(data=XY[0], label=XY[1])
+        return True
+
+    def reset(self):
+        if self.matrices is not None:
+            self.chunks = iter(self.matrices)
+        else:
+            self.chunks = None
+            self.pass_matrices = []
+
 class XGBoost(CardinalityEstimationAlg):
     def __init__(self, **kwargs):
         for k, val in kwargs.items():
             self.__setattr__(k, val)
 
     def init_dataset(self, samples):
-        ds = QueryDataset(samples, self.featurizer, False)
-        X = ds.X.cpu().numpy()
-        Y = ds.Y.cpu().numpy()
-        X = np.array(X, dtype=np.float32)
-        Y = np.array(Y, dtype=np.float32)
-        del(ds)
-        return X, Y
+        return get_feature_matrix(self.featurizer, samples)
+
+    def init_dmatrix(self, samples):
+        '''
+        @samples: [] qrep dicts; or qrep files, with the hist tree_method, or
+        external_memory.
+        '''
+        chunk_size = getattr(self, "chunk_size", 1000)
+        if getattr(self, "external_memory", False):
+            cache_dir = getattr(self, "cache_dir", "./")
+            if not os.path.exists(cache_dir):
+                make_dir(cache_dir)
+            it = QueryMatrixIter(samples, self.featurizer, chunk_size,
+                    cache_prefix=os.path.join(cache_dir, "xgb_cache"))
+            return xgb.DMatrix(it)
+        elif self.tree_method == "hist":
+            it = QueryMatrixIter(samples, self.featurizer, chunk_size,
+                    cache_chunks=True)
+            return xgb.QuantileDMatrix(it)
+        else:
+            X,Y = self.init_dataset(samples)
+            return xgb.DMatrix(X, label=Y)
+
+    def get_params(self):
+        return {"tree_method": self.tree_method,
+                "objective": "reg:squarederror",
+                "verbosity": 1,
+                "learning_rate": self.lr,
+                "colsample_bytree": 1.0,
+                "subsample": self.subsample,
+                "reg_alpha": 0.0,
+                "max_depth": self.max_depth,
+                "gamma": 0}
 
     def load_model(self, model_dir):
         model_path = model_dir + "/xgb_model.json"
-        self.xgb_model = xgb.XGBRegressor(objective="reg:squarederror")
+        self.xgb_model = xgb.Booster()
         self.xgb_model.load_model(model_path)
         print("*****loaded model*****")
 
@@ -310,9 +400,8 @@ class XGBoost(CardinalityEstimationAlg):
         self.featurizer = kwargs["featurizer"]
         self.training_samples = training_samples
 
-        X,Y = self.init_dataset(training_samples)
-
         if self.grid_search:
+            X,Y = self.init_dataset(training_samples)
             parameters = {'learning_rate':(0.001, 0.01),
                     'n_estimators':(100, 250, 500, 1000),
                     'loss': ['ls'],
@@ -327,27 +416,30 @@ class XGBoost(CardinalityEstimationAlg):
             print(self.xgb_model.best_estimator_)
             print("*******************BEST ESTIMATOR DONE**************")
         else:
-            self.xgb_model = xgb.XGBRegressor(tree_method=self.tree_method,
-                          objective="reg:squarederror",
-                          verbosity=1,
-                          scale_pos_weight=0,
-                          learning_rate=self.lr,
-                          colsample_bytree = 1.0,
-                          subsample = self.subsample,
-                          n_estimators=self.n_estimators,
-                          reg_alpha = 0.0,
-                          max_depth=self.max_depth,
-                          gamma=0)
-            self.xgb_model.fit(X,Y, verbose=1)
+            dtrain = self.init_dmatrix(training_samples)
+            print("training samples: ", dtrain.num_row())
+            self.xgb_model = xgb.train(self.get_params(), dtrain,
+                    num_boost_round=self.n_estimators)
+            del(dtrain)
 
         if hasattr(self, "result_dir") and self.result_dir is not None:
             exp_name = self.get_exp_name()
             exp_dir = os.path.join(self.result_dir, exp_name)
             self.xgb_model.save_model(exp_dir + "/xgb_model.json")
 
+    def predict(self, X):
+        if isinstance(self.xgb_model, xgb.Booster):
+            # multithreaded, without building a DMatrix
+            return self.xgb_model.inplace_predict(X)
+        return self.xgb_model.predict(X)
+
     def test(self, test_samples):
-        X,Y = self.init_dataset(test_samples)
-        pred = self.xgb_model.predict(X)
+        pred = []
+        for chunk in _iter_chunks(test_samples,
+                getattr(self, "chunk_size", 1000)):
+            X,Y = self.init_dataset(chunk)
+            pred.append(self.predict(X))
+        pred = np.concatenate(pred)
         return _format_model_test_output(pred, test_samples, self.featurizer)
 
     def __str__(self):
@@ -359,13 +451,7 @@ class RandomForest(CardinalityEstimationAlg):
             self.__setattr__(k, val)
 
     def init_dataset(self, samples):
-        ds = QueryDataset(samples, self.featurizer, False)
-        X = ds.X.cpu().numpy()
-        Y = ds.Y.cpu().numpy()
-        X = np.array(X, dtype=np.float32)
-        Y = np.array(Y, dtype=np.float32)
-        del(ds)
-        return X, Y
+        return get_feature_matrix(self.featurizer, samples)
 
     def load_model(self, model_dir):
         pass
@@ -379,18 +465,254 @@ class RandomForest(CardinalityEstimationAlg):
         if self.grid_search:
             pass
         else:
-            self.model = RandomForestRegressor(n_jobs=-1, verbose=2, **params)
+            self.model = RandomForestRegressor(n_jobs=-1, verbose=2,
+                    n_estimators=self.n_estimators, max_depth=self.max_depth)
             self.model.fit(X, Y)
 
     def test(self, test_samples):
-        X,Y = self.init_dataset(test_samples)
-        pred = self.model.predict(X)
+        pred = []
+        for chunk in _iter_chunks(test_samples,
+                getattr(self, "chunk_size", 1000)):
+            X,Y = self.init_dataset(chunk)
+            pred.append(self.model.predict(X))
+        pred = np.concatenate(pred)
         # FIXME: why can't we just use get_query_estimates here?
         return _format_model_test_output(pred, test_samples, self.featurizer)
 
     def __str__(self):
         return self.__class__.__name__
 
+def _init_train_loader(alg, training_samples):
+    '''
+    @training_samples: [] qrep dicts; or [] qrep files, which are streamed
+    from disk with a QueryStream, instead of being featurized in memory.
+    @ret: dataset, loader, and the first sample of the dataset.
+    '''
+    if isinstance(training_samples[0], str):
+        ds = QueryStream(training_samples, alg.featurizer,
+                shard_size=getattr(alg, "stream_shard_size", 100),
+                shuffle_buffer_size=getattr(alg, "stream_buffer_size", 20000),
+                load_padded_mscn_feats=getattr(alg, "load_padded_mscn_feats",
+                    False))
+        num_workers = getattr(alg, "stream_num_workers", 0)
+        loader = data.DataLoader(ds, batch_size=alg.mb_size,
+                collate_fn=alg.collate_fn, num_workers=num_workers)
+        print("streaming {} training queries in {} shards, with {} workers"\
+                .format(len(training_samples), len(ds.shards), num_workers))
+        return ds, loader, ds.get_sample()
+
+    assert isinstance(training_samples[0], dict)
+    load_query_together = getattr(alg, "load_query_together", False)
+    ds = _get_dataset(alg, training_samples,
+            load_query_together=load_query_together)
+    if load_query_together:
+        # minibatches of whole queries, with about mb_size subplans
+        batch_size = max(1, int(alg.mb_size / np.mean(ds.idx_lens)))
+        collate_fn = functools.partial(collate_queries,
+                collate_fn=alg.collate_fn)
+        print("training queries: {}, queries per minibatch: {}".format(
+            len(ds), batch_size))
+    else:
+        batch_size = alg.mb_size
+        collate_fn = alg.collate_fn
+        print("training samples: ", len(ds))
+
+    loader = data.DataLoader(ds, batch_size=batch_size, shuffle=True,
+            collate_fn=collate_fn)
+    return ds, loader, ds.get_sample()
+
+def _check_query_offsets(batch, ybatch):
+    '''
+    @batch: from the train loader; with load_query_together, collate_queries
+    adds the (start, len) of each query's subplans in it, which must tile
+    ybatch.
+    '''
+    if len(batch) < 4:
+        return
+    start = 0
+    for qstart, qlen in batch[3]:
+        assert qstart == start and qlen > 0
+        start += qlen
+    assert start == len(ybatch)
+
+def _get_dataset(alg, samples, load_query_together=False,
+        dedup_subplans=False):
+    '''
+    @ret: QueryDataset of samples for alg; if alg.dataset_cache (dict) is set,
+    the datasets are cached there, so algs that share it, and a featurizer,
+    featurize each set of samples once.
+    '''
+    load_padded_mscn_feats = getattr(alg, "load_padded_mscn_feats", False)
+    cache = getattr(alg, "dataset_cache", None)
+    key = (id(alg.featurizer), id(samples), load_query_together,
+            load_padded_mscn_feats, dedup_subplans)
+    if cache is not None and key in cache:
+        return cache[key][-1]
+
+    ds = QueryDataset(samples, alg.featurizer, load_query_together,
+            load_padded_mscn_feats=load_padded_mscn_feats,
+            dedup_subplans=dedup_subplans)
+    if cache is not None:
+        # the featurizer and samples are kept alive with the entry, so their
+        # ids in the key are not reused by other objects
+        cache[key] = (alg.featurizer, samples, ds)
+    return ds
+
+def _init_eval_ds(alg, samples):
+    '''
+    @ret: dataset to evaluate samples with; with alg.dedup_subplans,
+    identical subplans across the queries are featurized, and evaluated, once.
+    '''
+    return _get_dataset(alg, samples,
+            dedup_subplans=getattr(alg, "dedup_subplans", False))
+
+def init_datasets(alg, training_samples, eval_samples):
+    '''
+    Featurizes the datasets that alg (FCNN / MSCN) trains, and evaluates, on
+    into alg.dataset_cache; e.g., before algs sharing the cache are trained in
+    forked processes (see experiments.run_parallel), which then reuse them.
+    @eval_samples: [] of the lists of qreps alg will be tested on.
+    '''
+    if not isinstance(alg, (FCNN, MSCN)):
+        return
+    if len(training_samples) > 0 and isinstance(training_samples[0], dict):
+        _get_dataset(alg, training_samples,
+                load_query_together=getattr(alg, "load_query_together", False))
+    for samples in eval_samples:
+        if len(samples) > 0:
+            _init_eval_ds(alg, samples)
+
+def _eval_preds(alg, ds):
+    '''
+    @ds: from _init_eval_ds.
+    @ret: the predictions for every subplan of the samples of ds, in the order
+    of _format_model_test_output.
+    '''
+    preds = alg._eval_ds(ds)
+    if ds.dedup_subplans:
+        preds = preds[ds.subplan_idxs]
+    return preds
+
+def _eval_test_samples(alg, test_samples):
+    '''
+    @ret: test dataset, and the predictions for every subplan of test_samples.
+    '''
+    testds = _init_eval_ds(alg, test_samples)
+    return testds, _eval_preds(alg, testds)
+
+def _get_qerrors(samples, ests, ckey):
+    '''
+    @ests: as returned by _format_model_test_output.
+    @ret: q-errors of all the subplans; 0 cardinalities count as 1, as in
+    the QError eval function.
+    '''
+    errors = []
+    for sample, sample_ests in zip(samples, ests):
+        for node, est in sample_ests.items():
+            true_card = sample["subset_graph"].nodes()[node][ckey]["actual"]
+            if true_card == 0:
+                true_card += 1
+            if est == 0:
+                est += 1
+            true_card, est = float(true_card), float(est)
+            errors.append(max(est / true_card, true_card / est))
+    return np.array(errors)
+
+def _train_epochs(alg, valqs):
+    '''
+    Runs the max_epochs training epochs of alg (FCNN / MSCN). Every eval_epoch
+    epochs, and after the last one, the mean q-error on valqs (featurized
+    once) is evaluated; the net
+    with the best q-error is kept, and training stops early after
+    early_stopping_patience evaluations without an improvement.
+
+    With alg.checkpoint_dir, the training state is saved there after every
+    evaluation, and an interrupted run resumes from its last checkpoint; a
+    run that stopped early is not trained further, and only restores its best
+    net. Sets alg.best_val_qerr (None without validation).
+    @valqs: [] qrep dicts, or None.
+    '''
+    eval_epoch = getattr(alg, "eval_epoch", None)
+    patience = getattr(alg, "early_stopping_patience", None)
+    checkpoint_dir = getattr(alg, "checkpoint_dir", None)
+    if not eval_epoch or eval_epoch <= 0:
+        eval_epoch = None
+
+    valds = None
+    if eval_epoch is not None and valqs is not None and len(valqs) > 0:
+        valds = _init_eval_ds(alg, valqs)
+
+    start_epoch = 0
+    best_qerr = None
+    best_state = None
+    num_bad_evals = 0
+    checkpoint_fn = None
+    if checkpoint_dir is not None:
+        make_dir(checkpoint_dir)
+        checkpoint_fn = os.path.join(checkpoint_dir, "checkpoint.pt")
+        if os.path.exists(checkpoint_fn):
+            checkpoint = torch.load(checkpoint_fn, map_location=device)
+            alg.net.load_state_dict(checkpoint["net"])
+            alg.optimizer.load_state_dict(checkpoint["optimizer"])
+            start_epoch = checkpoint["epoch"] + 1
+            best_qerr = checkpoint["best_qerr"]
+            best_state = checkpoint["best_net"]
+            num_bad_evals = checkpoint["num_bad_evals"]
+            if checkpoint.get("stopped", False):
+                start_epoch = alg.max_epochs
+                print("training stopped early at epoch: ", checkpoint["epoch"])
+            else:
+                print("resuming training from epoch: ", start_epoch)
+
+    for alg.epoch in range(start_epoch, alg.max_epochs):
+        start = time.time()
+        if isinstance(alg.trainds, QueryStream):
+            alg.trainds.set_epoch(alg.epoch)
+        alg.train_one_epoch()
+        print("train epoch took: ", time.time()-start)
+
+        # the last epoch is always evaluated, and checkpointed, so a run
+        # resumed with more epochs (e.g., the next rung of a search) starts
+        # after it
+        if eval_epoch is None or ((alg.epoch+1) % eval_epoch != 0 and \
+                alg.epoch != alg.max_epochs-1):
+            continue
+
+        stop = False
+        if valds is not None:
+            preds = _eval_preds(alg, valds)
+            ests = _format_model_test_output(preds, valqs, alg.featurizer)
+            qerr = float(np.mean(_get_qerrors(valqs, ests,
+                alg.featurizer.ckey)))
+            print("epoch: {}, val mean q-error: {:.2f}".format(alg.epoch, qerr))
+            if best_qerr is None or qerr < best_qerr:
+                best_qerr = qerr
+                best_state = copy.deepcopy(alg.net.state_dict())
+                num_bad_evals = 0
+            else:
+                num_bad_evals += 1
+                stop = patience is not None and patience > 0 and \
+                        num_bad_evals >= patience
+
+        if checkpoint_fn is not None:
+            checkpoint = {"net": alg.net.state_dict(),
+                    "optimizer": alg.optimizer.state_dict(),
+                    "epoch": alg.epoch, "best_qerr": best_qerr,
+                    "best_net": best_state, "num_bad_evals": num_bad_evals,
+                    "stopped": stop}
+            # write, then rename, so an interruption never corrupts it
+            torch.save(checkpoint, checkpoint_fn + ".tmp")
+            os.replace(checkpoint_fn + ".tmp", checkpoint_fn)
+
+        if stop:
+            print("no improvement in {} evaluations, stopping at epoch: {}"\
+                    .format(num_bad_evals, alg.epoch))
+            break
+
+    alg.best_val_qerr = best_qerr
+    if best_state is not None:
+        alg.net.load_state_dict(best_state)
+        print("best val mean q-error: {:.2f}".format(best_qerr))
 
 class FCNN(CardinalityEstimationAlg):
     def __init__(self, *args, **kwargs):
@@ -409,10 +731,6 @@ class FCNN(CardinalityEstimationAlg):
 
         self.collate_fn = None
 
-    def init_dataset(self, samples):
-        ds = QueryDataset(samples, self.featurizer, False)
-        return ds
-
     def init_net(self, sample):
         net = SimpleRegression(self.num_features, 1,
                 self.num_hidden_layers, self.hidden_layer_size)
@@ -437,7 +755,9 @@ class FCNN(CardinalityEstimationAlg):
 
     def train_one_epoch(self):
 
-        for idx, (xbatch, ybatch,info) in enumerate(self.trainloader):
+        for idx, batch in enumerate(self.trainloader):
+            xbatch, ybatch, info = batch[:3]
+            _check_query_offsets(batch, ybatch)
 
             ybatch = ybatch.to(device, non_blocking=True)
             xbatch = xbatch.to(device, non_blocking=True)
@@ -456,30 +776,23 @@ class FCNN(CardinalityEstimationAlg):
             self.optimizer.step()
 
     def train(self, training_samples, **kwargs):
-        assert isinstance(training_samples[0], dict)
         self.featurizer = kwargs["featurizer"]
         self.training_samples = training_samples
 
-        self.trainds = self.init_dataset(training_samples)
-        self.trainloader = data.DataLoader(self.trainds,
-                batch_size=self.mb_size, shuffle=True,
-                collate_fn=self.collate_fn)
+        self.trainds, self.trainloader, sample = \
+                _init_train_loader(self, training_samples)
 
-        self.num_features = len(self.trainds[0][0])
+        self.num_features = len(sample[0])
         # TODO: initialize self.num_features
-        self.net, self.optimizer = self.init_net(self.trainds[0])
+        self.net, self.optimizer = self.init_net(sample)
 
         model_size = self.num_parameters()
-        print("""training samples: {}, feature length: {}, model size: {},
+        print("""feature length: {}, model size: {},
         hidden_layer_size: {}""".\
-                format(len(self.trainds), self.num_features, model_size,
+                format(self.num_features, model_size,
                     self.hidden_layer_size))
 
-        for self.epoch in range(0,self.max_epochs):
-            # TODO: add periodic evaluation here
-            start = time.time()
-            self.train_one_epoch()
-            print("train epoch took: ", time.time()-start)
+        _train_epochs(self, kwargs.get("valqs", None))
 
     def num_parameters(self):
         def _calc_size(net):
@@ -512,9 +825,7 @@ class FCNN(CardinalityEstimationAlg):
     def test(self, test_samples, **kwargs):
         '''
         '''
-        testds = self.init_dataset(test_samples)
-        preds = self._eval_ds(testds)
-
+        testds, preds = _eval_test_samples(self, test_samples)
         return _format_model_test_output(preds, test_samples, self.featurizer)
 
 def mscn_collate_fn(data):
@@ -587,11 +898,6 @@ class MSCN(CardinalityEstimationAlg):
         else:
             self.collate_fn = mscn_collate_fn
 
-    def init_dataset(self, samples):
-        ds = QueryDataset(samples, self.featurizer, False,
-                load_padded_mscn_feats=self.load_padded_mscn_feats)
-        return ds
-
     def init_net(self, sample):
         net = SetConv(len(sample[0]["table"][0]),
                 len(sample[0]["pred"][0]), len(sample[0]["join"][0]),
@@ -617,8 +923,9 @@ class MSCN(CardinalityEstimationAlg):
         return net, optimizer
 
     def train_one_epoch(self):
-        for idx, (xbatch,ybatch,info) \
-                    in enumerate(self.trainloader):
+        for idx, batch in enumerate(self.trainloader):
+            xbatch, ybatch, info = batch[:3]
+            _check_query_offsets(batch, ybatch)
             ybatch = ybatch.to(device, non_blocking=True)
             pred = self.net(xbatch["table"],xbatch["pred"],xbatch["join"],
                     xbatch["flow"],xbatch["tmask"],xbatch["pmask"],
@@ -641,29 +948,20 @@ class MSCN(CardinalityEstimationAlg):
             self.optimizer.step()
 
     def train(self, training_samples, **kwargs):
-        assert isinstance(training_samples[0], dict)
         self.featurizer = kwargs["featurizer"]
         self.training_samples = training_samples
 
-        self.trainds = self.init_dataset(training_samples)
-        self.trainloader = data.DataLoader(self.trainds,
-                batch_size=self.mb_size, shuffle=True,
-                collate_fn=self.collate_fn)
+        self.trainds, self.trainloader, sample = \
+                _init_train_loader(self, training_samples)
 
         # TODO: initialize self.num_features
-        self.net, self.optimizer = self.init_net(self.trainds[0])
+        self.net, self.optimizer = self.init_net(sample)
 
         model_size = self.num_parameters()
-        print("""training samples: {}, model size: {},
-        hidden_layer_size: {}""".\
-                format(len(self.trainds), model_size,
-                    self.hidden_layer_size))
+        print("""model size: {}, hidden_layer_size: {}""".\
+                format(model_size, self.hidden_layer_size))
 
-        for self.epoch in range(0,self.max_epochs):
-            # TODO: add periodic evaluation here
-            start = time.time()
-            self.train_one_epoch()
-            print("train epoch took: ", time.time()-start)
+        _train_epochs(self, kwargs.get("valqs", None))
 
     def num_parameters(self):
         def _calc_size(net):
@@ -701,7 +999,5 @@ class MSCN(CardinalityEstimationAlg):
     def test(self, test_samples, **kwargs):
         '''
         '''
-        testds = self.init_dataset(test_samples)
-        preds = self._eval_ds(testds)
-
+        testds, preds = _eval_test_samples(self, test_samples)
         return _format_model_test_output(preds, test_samples, self.featurizer)
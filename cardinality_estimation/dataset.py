@@ -7,6 +7,7 @@ import time
 import copy
 
 from query_representation.utils import *
+from query_representation.query import load_qrep
 
 import pdb
 
@@ -76,34 +77,132 @@ def pad_sets(all_table_features, all_pred_features,
         pm.append(predicate_mask)
         jm.append(join_mask)
 
-    tf = to_variable(tf,
-            requires_grad=False).float().squeeze()
-    pf = to_variable(pf,
-            requires_grad=False).float().squeeze()
-    jf = to_variable(jf,
-            requires_grad=False).float().squeeze()
-    extra_dim = len(jf.shape)-1
-
-    tm = to_variable(tm,
-            requires_grad=False).float().squeeze().unsqueeze(extra_dim)
-    pm = to_variable(pm,
-            requires_grad=False).float().squeeze().unsqueeze(extra_dim)
-    jm = to_variable(jm,
-            requires_grad=False).float().squeeze().unsqueeze(extra_dim)
-
-    return tf, pf, jf, tm, pm, jm
+    # batch x num sets x features; only squeezing the batch dimension (for a
+    # single sample), since a whole batch may have sets of length 1, e.g.,
+    # when it only has the single table subplans.
+    ret = []
+    for feats in [tf, pf, jf, tm, pm, jm]:
+        feats = to_variable(np.concatenate(feats),
+                requires_grad=False).float()
+        if len(all_table_features) == 1:
+            feats = feats.squeeze(0)
+        ret.append(feats)
+
+    return tuple(ret)
+
+def get_subplans(qrep):
+    '''
+    @ret: subplans of qrep, in the order of their samples in the datasets.
+    '''
+    node_names = list(qrep["subset_graph"].nodes())
+    if SOURCE_NODE in node_names:
+        node_names.remove(SOURCE_NODE)
+    node_names.sort()
+    return node_names
+
+def get_subplan_sample(featurizer, qrep, node, load_padded_mscn_feats=False,
+        set_idxs=False):
+    '''
+    @ret: x, y of the subplan node of qrep; see get_query_features.
+    '''
+    x,y = featurizer.get_subplan_features(qrep,
+            node, set_idxs=set_idxs and not load_padded_mscn_feats)
+
+    if featurizer.featurization_type == "set" \
+        and load_padded_mscn_feats:
+        tf,pf,jf,tm,pm,jm = \
+            pad_sets([x["table"]], [x["pred"]], [x["join"]],
+                    featurizer.max_tables, featurizer.max_preds,
+                    featurizer.max_joins)
+        x["table"] = tf
+        x["join"] = jf
+        x["pred"] = pf
+        # relevant masks
+        x["tmask"] = tm
+        x["pmask"] = pm
+        x["jmask"] = jm
+
+        # x["flow"] remains the correct vector
+
+    return x,y
+
+def get_query_features(featurizer, qrep, dataset_qidx, query_idx,
+        load_padded_mscn_feats=False, set_idxs=False):
+    '''
+    @qrep: qrep dict.
+    @set_idxs: see Featurizer.get_subplan_features; ignored with
+    load_padded_mscn_feats.
+    @ret: X, Y, sample_info for each subplan of qrep, sorted by the subplans.
+    '''
+    X = []
+    Y = []
+    sample_info = []
+
+    # now, we will generate the actual feature vectors over all the
+    # subplans. Order matters --- dataset idx will be specified based on
+    # order.
+    node_names = get_subplans(qrep)
+
+    for node_idx, node in enumerate(node_names):
+        x,y = get_subplan_sample(featurizer, qrep, node,
+                load_padded_mscn_feats, set_idxs)
+        X.append(x)
+        Y.append(y)
+
+        cur_info = {}
+        cur_info["num_tables"] = len(node)
+        cur_info["dataset_idx"] = dataset_qidx + node_idx
+        cur_info["query_idx"] = query_idx
+        sample_info.append(cur_info)
+
+    return X,Y,sample_info
+
+def get_feature_matrix(featurizer, samples):
+    '''
+    @samples: [] qrep dicts.
+    @ret: X, Y float32 arrays, with a row for each subplan of samples (in the
+    order of QueryDataset); the feature vectors are written directly into the
+    preallocated X, without the intermediate lists, and tensors, of
+    QueryDataset. Only for the combined featurization.
+    '''
+    assert featurizer.featurization_type == "combined"
+    num_subplans = sum([len(get_subplans(qrep)) for qrep in samples])
+    X = None
+    Y = np.zeros(num_subplans, dtype=np.float32)
+    idx = 0
+    for qrep in samples:
+        for node in get_subplans(qrep):
+            x,y = featurizer.get_subplan_features(qrep, node)
+            if X is None:
+                X = np.zeros((num_subplans, len(x)), dtype=np.float32)
+            X[idx] = x
+            Y[idx] = y
+            idx += 1
+
+    if X is None:
+        X = np.zeros((0, 0), dtype=np.float32)
+    return X, Y
 
 class QueryDataset(data.Dataset):
     def __init__(self, samples, featurizer,
-            load_query_together, load_padded_mscn_feats=False):
+            load_query_together, load_padded_mscn_feats=False,
+            dedup_subplans=False):
         '''
         @samples: [] sqlrep query dictionaries, which represent a query and all
         of its subplans.
         @load_query_together: each sample will be a list of all the feature
-        vectors belonging to all the subplans of a query.
+        vectors belonging to all the subplans of a query; the subplans of
+        query i are the samples start_idxs[i] : start_idxs[i]+idx_lens[i], and
+        minibatches of queries are built with collate_queries.
+        @dedup_subplans: subplans with the same Featurizer.get_subplan_key,
+        e.g., shared by queries of the same template, are featurized once, and
+        are a single sample; self.subplan_idxs maps each subplan of samples
+        (in order) to its sample idx. Meant for evaluation, where the
+        predictions of the samples are fanned out to all the subplans.
         '''
         self.load_query_together = load_query_together
         self.load_padded_mscn_feats = load_padded_mscn_feats
+        self.dedup_subplans = dedup_subplans
 
         self.featurizer = featurizer
 
@@ -112,60 +211,27 @@ class QueryDataset(data.Dataset):
         self.minv = self.featurizer.min_val
         self.maxv = self.featurizer.max_val
         self.feattype = self.featurizer.featurization_type
+        # unpadded set features are stored as indices into the feature rows
+        # shared by all the subplans of a query, and built in __getitem__
+        self.set_idxs = self.feattype == "set" and not load_padded_mscn_feats
 
         # TODO: we may want to avoid this, and convert them on the fly. Just
         # keep some indexing information around.
 
+        assert not (load_query_together and dedup_subplans)
         self.X, self.Y, self.info = self._get_feature_vectors(samples)
-        self.num_samples = len(self.X)
+        if self.load_query_together:
+            self.num_samples = len(self.start_idxs)
+        else:
+            self.num_samples = len(self.X)
 
     def _get_query_features(self, qrep, dataset_qidx,
             query_idx):
         '''
         @qrep: qrep dict.
         '''
-        X = []
-        Y = []
-        sample_info = []
-
-        # now, we will generate the actual feature vectors over all the
-        # subplans. Order matters --- dataset idx will be specified based on
-        # order.
-        node_names = list(qrep["subset_graph"].nodes())
-        if SOURCE_NODE in node_names:
-            node_names.remove(SOURCE_NODE)
-        node_names.sort()
-
-        for node_idx, node in enumerate(node_names):
-            x,y = self.featurizer.get_subplan_features(qrep,
-                    node)
-
-            if self.featurizer.featurization_type == "set" \
-                and self.load_padded_mscn_feats:
-                tf,pf,jf,tm,pm,jm = \
-                    pad_sets([x["table"]], [x["pred"]], [x["join"]],
-                            self.featurizer.max_tables, self.featurizer.max_preds,
-                            self.featurizer.max_joins)
-                x["table"] = tf
-                x["join"] = jf
-                x["pred"] = pf
-                # relevant masks
-                x["tmask"] = tm
-                x["pmask"] = pm
-                x["jmask"] = jm
-
-                # x["flow"] remains the correct vector
-
-            X.append(x)
-            Y.append(y)
-
-            cur_info = {}
-            cur_info["num_tables"] = len(node)
-            cur_info["dataset_idx"] = dataset_qidx + node_idx
-            cur_info["query_idx"] = query_idx
-            sample_info.append(cur_info)
-
-        return X,Y,sample_info
+        return get_query_features(self.featurizer, qrep, dataset_qidx,
+                query_idx, self.load_padded_mscn_feats, self.set_idxs)
 
     def _get_feature_vectors(self, samples):
         '''
@@ -177,13 +243,20 @@ class QueryDataset(data.Dataset):
         Y = []
         sample_info = []
         qidx = 0
+        self.start_idxs = []
+        self.idx_lens = []
 
-        for i, qrep in enumerate(samples):
-            x,y,cur_info = self._get_query_features(qrep, qidx, i)
-            qidx += len(y)
-            X += x
-            Y += y
-            sample_info += cur_info
+        if self.dedup_subplans:
+            X, Y, sample_info = self._get_dedup_samples(samples)
+        else:
+            for i, qrep in enumerate(samples):
+                x,y,cur_info = self._get_query_features(qrep, qidx, i)
+                self.start_idxs.append(qidx)
+                self.idx_lens.append(len(y))
+                qidx += len(y)
+                X += x
+                Y += y
+                sample_info += cur_info
 
         print("Extracting features took: ", time.time() - start)
 
@@ -197,18 +270,184 @@ class QueryDataset(data.Dataset):
 
         return X,Y,sample_info
 
+    def _get_dedup_samples(self, samples):
+        '''
+        @ret: X, Y, sample_info of the unique subplans of samples; sets
+        self.subplan_idxs, and self.dedup_ratio (#subplans / #unique subplans).
+        '''
+        X = []
+        Y = []
+        sample_info = []
+        self.subplan_idxs = []
+        # subplan key : sample idx
+        memo = {}
+
+        for i, qrep in enumerate(samples):
+            for node in get_subplans(qrep):
+                key = self.featurizer.get_subplan_key(qrep, node)
+                if key not in memo:
+                    memo[key] = len(X)
+                    x,y = get_subplan_sample(self.featurizer, qrep, node,
+                            self.load_padded_mscn_feats, self.set_idxs)
+                    X.append(x)
+                    Y.append(y)
+                    cur_info = {}
+                    cur_info["num_tables"] = len(node)
+                    cur_info["dataset_idx"] = len(sample_info)
+                    cur_info["query_idx"] = i
+                    sample_info.append(cur_info)
+                self.subplan_idxs.append(memo[key])
+
+        self.dedup_ratio = len(self.subplan_idxs) / float(max(len(X), 1))
+        print("unique subplans: {}, total subplans: {}, dedup ratio: {:.2f}"\
+                .format(len(X), len(self.subplan_idxs), self.dedup_ratio))
+        return X,Y,sample_info
+
     def __len__(self):
         return self.num_samples
 
+    def _get_sample(self, index):
+        '''
+        @ret: x, y, info of the subplan at index.
+        '''
+        if self.set_idxs:
+            rows, idxs = self.X[index]
+            return self.featurizer.get_set_features(rows, idxs), \
+                    self.Y[index], self.info[index]
+        else:
+            return self.X[index], self.Y[index], self.info[index]
+
+    def get_sample(self):
+        '''
+        @ret: the first subplan sample, e.g., to infer the feature shapes.
+        '''
+        return self._get_sample(0)
+
     def __getitem__(self, index):
         '''
         '''
         if self.load_query_together:
-            assert False, "needs to be implemented"
             start_idx = self.start_idxs[index]
             end_idx = start_idx + self.idx_lens[index]
             if self.feattype == "combined":
+                # contiguous slices of the subplans of the query
                 return self.X[start_idx:end_idx], self.Y[start_idx:end_idx], \
                         self.info[start_idx:end_idx]
+            return [self._get_sample(i) for i in range(start_idx, end_idx)]
         else:
-            return self.X[index], self.Y[index], self.info[index]
+            return self._get_sample(index)
+
+def collate_queries(batch, collate_fn=None):
+    '''
+    @batch: [] QueryDataset items with load_query_together, i.e., all the
+    subplans of a query.
+    @collate_fn: collate function of the subplan samples; None for the
+    default one.
+    @ret: minibatch of all the subplans of the queries, in order, so the
+    subplans of each query are contiguous; followed by [] of the (start, len)
+    of each query's subplans in it.
+    '''
+    offsets = []
+    start = 0
+    for query_samples in batch:
+        if isinstance(query_samples, list):
+            qlen = len(query_samples)
+        else:
+            qlen = len(query_samples[1])
+        offsets.append((start, qlen))
+        start += qlen
+
+    if not isinstance(batch[0], list):
+        # combined features, already stacked for each query
+        infos = []
+        for _, _, info in batch:
+            infos += info
+        return torch.cat([x for x, _, _ in batch]), \
+                torch.cat([y for _, y, _ in batch]), infos, offsets
+
+    samples = [sample for query_samples in batch for sample in query_samples]
+    if collate_fn is None:
+        collate_fn = data.default_collate
+    x, y, info = collate_fn(samples)
+    return x, y, info, offsets
+
+class QueryStream(data.IterableDataset):
+    def __init__(self, qfns, featurizer, shard_size=100,
+            shuffle_buffer_size=20000, load_padded_mscn_feats=False,
+            seed=1234):
+        '''
+        Streams the featurized subplans of the qreps in qfns, without ever
+        holding all of them in memory, so workloads larger than memory can be
+        trained on.
+
+        The qfns are split into shards of shard_size queries; when iterated
+        by a DataLoader with num_workers > 0, each worker process loads, and
+        featurizes, its own shards. The samples are shuffled through a buffer
+        of shuffle_buffer_size samples (per worker), and the order of the
+        shards is reshuffled every epoch (see set_epoch). So memory is bounded
+        by one shard, and the buffer, per worker.
+
+        @qfns: [] qrep pickle files, as saved by save_qrep.
+        '''
+        self.qfns = qfns
+        self.featurizer = featurizer
+        self.shard_size = shard_size
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.load_padded_mscn_feats = load_padded_mscn_feats
+        self.seed = seed
+        self.epoch = 0
+
+        self.shards = []
+        for i in range(0, len(qfns), shard_size):
+            self.shards.append(qfns[i:i+shard_size])
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _to_sample(self, x, y, info):
+        if self.featurizer.featurization_type == "combined":
+            x = torch.from_numpy(np.array(x, dtype=np.float32))
+        return x, torch.tensor(y).float(), info
+
+    def _iter_shard(self, shard, rng):
+        qreps = [load_qrep(qfn) for qfn in shard]
+        for qi in rng.permutation(len(qreps)):
+            X, Y, info = get_query_features(self.featurizer, qreps[qi], 0, qi,
+                    self.load_padded_mscn_feats)
+            for i in range(len(X)):
+                yield self._to_sample(X[i], Y[i], info[i])
+
+    def get_sample(self):
+        '''
+        @ret: the first sample of the stream; used to initialize the nets.
+        '''
+        qrep = load_qrep(self.qfns[0])
+        X, Y, info = get_query_features(self.featurizer, qrep, 0, 0,
+                self.load_padded_mscn_feats)
+        return self._to_sample(X[0], Y[0], info[0])
+
+    def __iter__(self):
+        worker_info = data.get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        # same shard order in all the workers, so they split the shards
+        shard_order = np.random.RandomState(self.seed + self.epoch).\
+                permutation(len(self.shards))
+        rng = np.random.RandomState(self.seed + self.epoch*num_workers \
+                + worker_id + 1)
+
+        buf = []
+        for si in shard_order[worker_id::num_workers]:
+            for sample in self._iter_shard(self.shards[si], rng):
+                if len(buf) < self.shuffle_buffer_size:
+                    buf.append(sample)
+                    continue
+                idx = rng.randint(0, len(buf))
+                yield buf[idx]
+                buf[idx] = sample
+
+        for idx in rng.permutation(len(buf)):
+            yield buf[idx]
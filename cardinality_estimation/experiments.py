@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import traceback
+import multiprocessing as mp
+from queue import Empty
+import numpy as np
+import torch
+
+'''
+Runs several jobs (e.g., training + testing a configured model) in parallel
+forked processes, each pinned to its own disjoint set of CPUs. The processes
+are forked, so they share everything the parent has already loaded, or
+featurized (e.g., the qreps, and the QueryDatasets in an alg.dataset_cache),
+without copying it, or recomputing it, per job.
+'''
+
+def get_cpu_sets(num_sets):
+    '''
+    @ret: [] of num_sets disjoint lists of the available CPUs; if there are
+    fewer CPUs than num_sets, the CPUs are shared round robin.
+    '''
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(mp.cpu_count()))
+
+    if len(cpus) < num_sets:
+        return [[cpus[i % len(cpus)]] for i in range(num_sets)]
+    return [list(cpu_set) for cpu_set in np.array_split(cpus, num_sets)]
+
+def _run_job(fn, job_args, cpus, job_idx, queue):
+    try:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+        torch.set_num_threads(len(cpus))
+        queue.put((job_idx, fn(*job_args), None))
+    except Exception:
+        queue.put((job_idx, None, traceback.format_exc()))
+
+def run_parallel(fn, all_job_args, num_parallel):
+    '''
+    @fn: function, run as fn(*job_args) for each job_args of all_job_args;
+    its return value must be picklable.
+    @num_parallel: number of jobs running at a time; each of them gets
+    1/num_parallel of the CPUs. 1 runs the jobs in this process.
+    @ret: [] of the return values of the jobs, in order.
+    '''
+    if num_parallel <= 1:
+        return [fn(*job_args) for job_args in all_job_args]
+
+    ctx = mp.get_context("fork")
+    cpu_sets = get_cpu_sets(num_parallel)
+    results = [None]*len(all_job_args)
+    for wave_start in range(0, len(all_job_args), num_parallel):
+        start = time.time()
+        queue = ctx.Queue()
+        procs = []
+        wave = list(range(wave_start,
+            min(wave_start+num_parallel, len(all_job_args))))
+        for i, job_idx in enumerate(wave):
+            proc = ctx.Process(target=_run_job, args=(fn,
+                all_job_args[job_idx], cpu_sets[i], job_idx, queue))
+            proc.start()
+            procs.append(proc)
+
+        # drain the queue before joining, since large results block the
+        # children until they are read
+        errors = []
+        pending = dict(zip(wave, procs))
+        while len(pending) > 0:
+            dead = []
+            try:
+                outputs = [queue.get(timeout=1.0)]
+            except Empty:
+                # a child that died (e.g., killed by the OOM killer) never
+                # puts its output; the ones that put it just before exiting
+                # are drained first
+                dead = [job_idx for job_idx, proc in pending.items()
+                        if not proc.is_alive()]
+                if len(dead) == 0:
+                    continue
+                outputs = []
+                while True:
+                    try:
+                        outputs.append(queue.get(timeout=0.1))
+                    except Empty:
+                        break
+
+            for job_idx, result, error in outputs:
+                results[job_idx] = result
+                if error is not None:
+                    errors.append(error)
+                pending.pop(job_idx)
+            for job_idx in dead:
+                if job_idx in pending:
+                    errors.append("job {} died, with exitcode: {}".format(
+                        job_idx, pending.pop(job_idx).exitcode))
+        for proc in procs:
+            proc.join()
+
+        if len(errors) > 0:
+            for error in errors:
+                print(error, file=sys.stderr)
+            assert False, "{} parallel jobs failed".format(len(errors))
+
+        print("jobs {} - {} took: {}".format(wave[0], wave[-1],
+            time.time()-start))
+
+    return results
+
+def _loss_key(loss):
+    # configs without a loss (e.g., never evaluated) rank last
+    if loss is None or np.isnan(loss):
+        return float("inf")
+    return loss
+
+def successive_halving(configs, run_fn, min_epochs, max_epochs, eta=3,
+        num_parallel=1):
+    '''
+    Successive halving over configs: all the configs are trained for
+    min_epochs, then only the best 1/eta of them continue, for eta times as
+    many epochs, and so on until max_epochs, or a single config, is left.
+    @run_fn: run_fn(config_idx, config, num_epochs) trains the config up to
+    num_epochs in total (resuming from where its previous rung stopped, e.g.,
+    with the FCNN / MSCN checkpoint_dir), and returns its validation loss;
+    None, or NaN, ranks last.
+    The configs of a rung are run with run_parallel.
+    @ret: idx of the best config, and {config_idx : {num_epochs : loss}}.
+    '''
+    assert min_epochs >= 1 and eta >= 2
+    alive = list(range(len(configs)))
+    history = {}
+    num_epochs = min(min_epochs, max_epochs)
+    while True:
+        losses = run_parallel(run_fn, [(i, configs[i], num_epochs)
+            for i in alive], num_parallel)
+        for i, loss in zip(alive, losses):
+            history.setdefault(i, {})[num_epochs] = loss
+        alive.sort(key=lambda i: _loss_key(history[i][num_epochs]))
+
+        print("rung with {} epochs, {} configs:".format(num_epochs,
+            len(alive)))
+        for i in alive:
+            print("    {}: {}, loss: {}".format(i, configs[i],
+                history[i][num_epochs]))
+
+        if num_epochs >= max_epochs or len(alive) == 1:
+            break
+        alive = alive[0:max(1, len(alive) // eta)]
+        num_epochs = min(num_epochs*eta, max_epochs)
+
+    return alive[0], history
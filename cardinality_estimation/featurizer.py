@@ -3,6 +3,7 @@ import pdb
 import time
 import random
 from query_representation.utils import *
+from .sketches import get_column_stats, get_selectivity
 
 import time
 from collections import OrderedDict, defaultdict
@@ -24,6 +25,7 @@ MIN_TEMPLATE = "SELECT {COL} FROM {TABLE} WHERE {COL} IS NOT NULL ORDER BY {COL}
 MAX_TEMPLATE = "SELECT {COL} FROM {TABLE} WHERE {COL} IS NOT NULL ORDER BY {COL} DESC LIMIT 1"
 UNIQUE_VALS_TEMPLATE = "SELECT DISTINCT {COL} FROM {FROM_CLAUSE}"
 UNIQUE_COUNT_TEMPLATE = "SELECT COUNT(*) FROM (SELECT DISTINCT {COL} from {FROM_CLAUSE}) AS t"
+ALL_VALS_TEMPLATE = "SELECT {COL} FROM {FROM_CLAUSE}"
 
 INDEX_LIST_CMD = """
 select
@@ -69,11 +71,47 @@ def qrep_to_df(qrep):
     '''
     pass
 
+def get_num_paths(subsetg, dest):
+    '''
+    @ret: node : number of paths from dest to node in the subset graph (a
+    DAG), counted in a single pass over its topological order. Same as
+    len(list(nx.all_simple_paths(subsetg, dest, node))), which is 0 for
+    node == dest.
+    '''
+    num_paths = {}
+    for node in nx.topological_sort(subsetg):
+        if node == dest:
+            num_paths[node] = 1
+            continue
+        num_paths[node] = 0
+        for pred in subsetg.predecessors(node):
+            num_paths[node] += num_paths[pred]
+    num_paths[dest] = 0
+    return num_paths
+
+def _get_structure_key(subsetg, join_graph):
+    '''
+    @ret: key of the subplans, and the edges, of the subset graph and the join
+    graph; the structural flow features only depend on these.
+    '''
+    join_edges = [tuple(sorted(edge)) for edge in join_graph.edges()]
+    return deterministic_hash(str(sorted(subsetg.nodes())) + \
+            str(sorted(subsetg.edges())) + str(sorted(join_edges)))
+
 class Featurizer():
-    def __init__(self, user, pwd, db_name, db_host ,port):
+    def __init__(self, user, pwd, db_name, db_host ,port, db_backend=None,
+            column_sketches=False):
         '''
+        @db_backend: None connects to PostgreSQL; else a backend from
+        query_representation/db_backends.py
+        @column_sketches: the column stats are computed in a single scan of
+        each column, which also builds its histogram / distinct count /
+        frequency sketches (see sketches.py); used with
+        setup(sketch_features=True).
         '''
         self.user = user
+        self.column_sketches = column_sketches
+        self.db_backend = db_backend
         self.pwd = pwd
         self.db_host = db_host
         self.port = port
@@ -140,8 +178,14 @@ class Featurizer():
     def execute(self, sql):
         '''
         '''
-        con = pg.connect(user=self.user, host=self.db_host, port=self.port,
-                password=self.pwd, database=self.db_name)
+        # featurizers cached before db_backend was added will not have it
+        db_backend = getattr(self, "db_backend", None)
+        if db_backend is not None:
+            con = db_backend.connect(self.user, self.pwd, self.db_host,
+                    self.port, self.db_name)
+        else:
+            con = pg.connect(user=self.user, host=self.db_host, port=self.port,
+                    password=self.pwd, database=self.db_name)
         cursor = con.cursor()
 
         try:
@@ -203,6 +247,10 @@ class Featurizer():
             if self.heuristic_features:
                 pred_len += 1
 
+            # for the selectivity estimate from the column's sketches
+            if self.sketch_features:
+                pred_len += 1
+
             # FIXME: special casing "id" not in col to avoid columns like
             # it.id; very specific to CEB workloads.
             if is_float(info["min_value"]) and is_float(info["max_value"]) \
@@ -283,6 +331,10 @@ class Featurizer():
                 # feature
                 pred_len += 1
 
+            # for the selectivity estimate from the column's sketches
+            if self.sketch_features:
+                pred_len += 1
+
             # FIXME: special casing "id" not in col to avoid columns like
             # it.id; very specific to CEB workloads.
             if is_float(info["min_value"]) and is_float(info["max_value"]) \
@@ -334,6 +386,7 @@ class Featurizer():
             feat_rel_pg_ests=True, feat_join_graph_neighbors=True,
             feat_rel_pg_ests_onehot=True,
             feat_pg_est_one_hot=True,
+            sketch_features=False,
             cost_model=None, sample_bitmap=False, sample_bitmap_num=1000,
             sample_bitmap_buckets=1000,
             featkey=None):
@@ -393,6 +446,12 @@ class Featurizer():
             self.__setattr__(k, val)
             arg_key += str(val)
         self.featkey = str(deterministic_hash(arg_key))
+        # template : structural flow features, see get_flow_features
+        self.flow_cache = {}
+        # last query's shared set features, see get_query_set_rows
+        self.set_rows_cache = None
+        # (value, num_buckets) : bucket, see _get_bucket
+        self.bucket_cache = {}
 
         # let's figure out the feature len based on db.stats
         assert self.featurizer is None
@@ -504,6 +563,11 @@ class Featurizer():
         col_info = self.column_stats[col]
         min_val = float(col_info["min_value"])
         max_val = float(col_info["max_value"])
+        sketches = self._get_sketches(col)
+        if sketches is not None:
+            hist = sketches["histogram"]
+        else:
+            hist = None
 
         assert isinstance(val, list)
         for vi, v in enumerate(val):
@@ -516,13 +580,50 @@ class Featurizer():
                 else:
                     v = max_val
 
-            # use min-max normalization for continuous features
             cur_val = float(v)
+            if hist is not None:
+                # fraction of the column's values <= v
+                pfeats[pred_idx_start+vi] = hist.cdf(cur_val)
+                continue
+
+            # use min-max normalization for continuous features
             norm_val = (cur_val - min_val) / (max_val - min_val)
             norm_val = max(norm_val, 0.00)
             norm_val = min(norm_val, 1.00)
             pfeats[pred_idx_start+vi] = norm_val
 
+    def _get_sketches(self, col):
+        if not getattr(self, "sketch_features", False):
+            return None
+        return self.column_stats[col].get("sketches", None)
+
+    def _get_sketch_selectivity(self, col, cmp_op, val):
+        '''
+        @ret: selectivity of the predicate estimated from the column's
+        sketches; 0.0 if it can not be estimated.
+        '''
+        sketches = self._get_sketches(col)
+        if sketches is None:
+            return 0.0
+        sel = get_selectivity(sketches, cmp_op, val)
+        if sel is None:
+            return 0.0
+        return sel
+
+    def _get_bucket(self, val, num_buckets):
+        '''
+        @val: string.
+        @ret: deterministic_hash(val) % num_buckets; memoized, since the same
+        predicate values / n-grams repeat in every subplan, and query, that
+        uses them.
+        '''
+        if not hasattr(self, "bucket_cache"):
+            self.bucket_cache = {}
+        key = (val, num_buckets)
+        if key not in self.bucket_cache:
+            self.bucket_cache[key] = deterministic_hash(val) % num_buckets
+        return self.bucket_cache[key]
+
     def _handle_categorical_feature(self, pfeats, pred_idx_start,
             col, val):
         '''
@@ -532,7 +633,7 @@ class Featurizer():
         num_buckets = min(self.max_discrete_featurizing_buckets,
                 col_info["num_values"])
         for v in val:
-            pred_idx = deterministic_hash(str(v)) % num_buckets
+            pred_idx = self._get_bucket(str(v), num_buckets)
             pfeats[pred_idx_start+pred_idx] = 1.00
 
     def _get_pg_est(self, subpinfo):
@@ -559,23 +660,23 @@ class Featurizer():
             pred_idx_start += num_buckets
 
         regex_val = val[0].replace("%","")
-        pred_idx = deterministic_hash(regex_val) % num_buckets
+        pred_idx = self._get_bucket(regex_val, num_buckets)
         pfeats[pred_idx_start+pred_idx] = 1.00
         for v in regex_val:
-            pred_idx = deterministic_hash(str(v)) % num_buckets
+            pred_idx = self._get_bucket(str(v), num_buckets)
             pfeats[pred_idx_start+pred_idx] = 1.00
 
         if self.ilike_bigrams:
             for i,v in enumerate(regex_val):
                 if i != len(regex_val)-1:
-                    pred_idx = deterministic_hash(v+regex_val[i+1]) % num_buckets
+                    pred_idx = self._get_bucket(v+regex_val[i+1], num_buckets)
                     pfeats[pred_idx_start+pred_idx] = 1.00
 
         if self.ilike_trigrams:
             for i,v in enumerate(regex_val):
                 if i < len(regex_val)-2:
-                    pred_idx = deterministic_hash(v+regex_val[i+1]+ \
-                            regex_val[i+2]) % num_buckets
+                    pred_idx = self._get_bucket(v+regex_val[i+1]+ \
+                            regex_val[i+2], num_buckets)
                     pfeats[pred_idx_start+pred_idx] = 1.00
 
         pfeats[pred_idx_start + num_buckets] = len(regex_val)
@@ -584,24 +685,34 @@ class Featurizer():
         if bool(re.search(r'\d', regex_val)):
             pfeats[pred_idx_start + num_buckets + 1] = 1
 
-    def get_subplan_features_set(self, qrep, subplan):
+    def get_query_set_rows(self, qrep):
         '''
+        The table, predicate and join feature vectors of an alias (or join
+        edge) are the same in every subplan containing it (except the
+        subplan's pg estimate in the predicate features); so these are
+        computed once per query, and every subplan of the query is
+        represented by indices into these rows (see get_subplan_set_idxs).
+        The rows of the last featurized query are cached.
+
         @ret: {}
-            key: table,pred,join etc.
-            val: [[feats1], [feats2], ...]
-            Note that there can be a variable number of arrays depending on the
-            subplan we're trying to featurize.
+            table, pred, join: 2d arrays, with a row for each alias / join
+            edge; pred rows have the subplan's pg estimate slot set to 0.
+            table_idx, pred_idx: alias : row; join_idx: join_str : row.
+            Aliases / joins missing in the featurizer have no row.
         '''
-        assert isinstance(subplan, tuple)
-        featdict = {}
+        cache = getattr(self, "set_rows_cache", None)
+        if cache is not None and cache[0] is qrep:
+            return cache[1]
+
         subsetgraph = qrep["subset_graph"]
         joingraph = qrep["join_graph"]
+        aliases = list(joingraph.nodes())
+        aliases.sort()
 
-        alltablefeats = []
+        tablefeats = []
+        table_idx = {}
         if self.table_features:
-            ## table features
-            # loop over each node, update the tfeats bitvector
-            for alias in subplan:
+            for alias in aliases:
                 tfeats = np.zeros(self.table_features_len)
                 # need to find its real table name from the join_graph
                 table = joingraph.nodes()[alias]["real_name"]
@@ -610,40 +721,31 @@ class Featurizer():
                     continue
                 # Note: same table might be set to 1.0 twice, in case of aliases
                 tfeats[self.table_featurizer[table]] = 1.00
-                alltablefeats.append(tfeats)
+                table_idx[alias] = len(tablefeats)
+                tablefeats.append(tfeats)
 
-        featdict["table"] = alltablefeats
-
-        alljoinfeats = []
+        joinfeats = []
+        join_idx = {}
         if self.join_features:
-            ## join features
-            seenjoins = set()
-            for alias1 in subplan:
-                for alias2 in subplan:
-                    ekey = (alias1, alias2)
-                    if ekey in joingraph.edges():
-                        join_str = joingraph.edges()[ekey]["join_condition"]
-                        if join_str in seenjoins:
-                            continue
-                        seenjoins.add(join_str)
-                        jfeats  = np.zeros(len(self.joins))
-                        keys = join_str.split("=")
-                        keys.sort()
-                        keys = ",".join(keys)
-                        if keys not in self.join_featurizer:
-                            print("join_str: {} not found in featurizer".format(join_str))
-                            continue
-                        jfeats[self.join_featurizer[keys]] = 1.00
-                        alljoinfeats.append(jfeats)
-
-            if len(alljoinfeats) == 0:
-                alljoinfeats.append(np.zeros(len(self.joins)))
-
-        featdict["join"] = alljoinfeats
+            for edge in joingraph.edges():
+                join_str = joingraph.edges()[edge]["join_condition"]
+                if join_str in join_idx:
+                    continue
+                jfeats  = np.zeros(len(self.joins))
+                keys = join_str.split("=")
+                keys.sort()
+                keys = ",".join(keys)
+                if keys not in self.join_featurizer:
+                    print("join_str: {} not found in featurizer".format(join_str))
+                    continue
+                jfeats[self.join_featurizer[keys]] = 1.00
+                join_idx[join_str] = len(joinfeats)
+                joinfeats.append(jfeats)
 
-        allpredfeats = []
+        predfeats = []
+        pred_idx = {}
         if self.pred_features:
-            for alias in subplan:
+            for alias in aliases:
                 aliasinfo = joingraph.nodes()[alias]
                 if len(aliasinfo["pred_cols"]) == 0:
                     continue
@@ -690,35 +792,128 @@ class Featurizer():
                         self._handle_categorical_feature(pfeats, pred_idx_start,
                                 col, val)
 
-                # add the appropriate postgresql estimate for this table in the
-                # subplan; Note that the last elements are reserved for the
-                # heuristic estimates for both continuous / categorical
-                # features
+                # the slot before the heuristic estimates (if any) is
+                # reserved for the selectivity estimate from the sketches
+                if self.sketch_features:
+                    sel_idx = -3 if self.heuristic_features else -1
+                    assert pfeats[sel_idx] == 0.0
+                    pfeats[sel_idx] = self._get_sketch_selectivity(col,
+                            cmp_op, val)
+
+                # add the appropriate postgresql estimate for this table; Note
+                # that the last elements are reserved for the heuristic
+                # estimates for both continuous / categorical features; the
+                # last one is the subplan's estimate, set in
+                # get_set_features
                 if self.heuristic_features:
                     node_key = tuple([alias])
                     alias_est = self._get_pg_est(subsetgraph.nodes()[node_key])
                     assert pfeats[-1] == 0.0
                     assert pfeats[-2] == 0.0
                     pfeats[-2] = alias_est
-                    subp_est = self._get_pg_est(subsetgraph.nodes()[subplan])
-                    pfeats[-1] = subp_est
 
-                allpredfeats.append(pfeats)
+                pred_idx[alias] = len(predfeats)
+                predfeats.append(pfeats)
 
-            if len(allpredfeats) == 0:
-                allpredfeats.append(np.zeros(self.max_pred_len))
+        rows = {}
+        rows["table"] = np.array(tablefeats).reshape(len(tablefeats),
+                self.table_features_len)
+        rows["join"] = np.array(joinfeats).reshape(len(joinfeats),
+                len(self.joins))
+        rows["pred"] = np.array(predfeats).reshape(len(predfeats),
+                self.max_pred_len)
+        rows["table_idx"] = table_idx
+        rows["join_idx"] = join_idx
+        rows["pred_idx"] = pred_idx
 
-        featdict["pred"] = allpredfeats
-        flow_features = []
+        self.set_rows_cache = (qrep, rows)
+        return rows
+
+    def get_subplan_set_idxs(self, qrep, subplan):
+        '''
+        @ret: {}
+            table, pred, join: indices of the subplan's rows in
+            get_query_set_rows(qrep), in the same order as
+            get_subplan_features_set.
+            pred_est: the subplan's pg estimate (None, if not used).
+            flow: flow features of the subplan.
+        '''
+        assert isinstance(subplan, tuple)
+        rows = self.get_query_set_rows(qrep)
+        joingraph = qrep["join_graph"]
+
+        idxs = {}
+        idxs["table"] = [rows["table_idx"][alias] for alias in subplan
+                if alias in rows["table_idx"]]
+        idxs["pred"] = [rows["pred_idx"][alias] for alias in subplan
+                if alias in rows["pred_idx"]]
+
+        joins = []
+        seenjoins = set()
+        for alias1 in subplan:
+            for alias2 in subplan:
+                ekey = (alias1, alias2)
+                if ekey in joingraph.edges():
+                    join_str = joingraph.edges()[ekey]["join_condition"]
+                    if join_str in seenjoins:
+                        continue
+                    seenjoins.add(join_str)
+                    if join_str in rows["join_idx"]:
+                        joins.append(rows["join_idx"][join_str])
+        idxs["join"] = joins
+
+        idxs["pred_est"] = None
+        if self.heuristic_features:
+            idxs["pred_est"] = self._get_pg_est(
+                    qrep["subset_graph"].nodes()[subplan])
 
+        flow_features = []
         if self.flow_features:
             flow_features = self.get_flow_features(subplan,
                     qrep["subset_graph"], qrep["template_name"],
                     qrep["join_graph"])
-        featdict["flow"] = flow_features
+        idxs["flow"] = flow_features
+
+        return idxs
+
+    def get_set_features(self, rows, idxs):
+        '''
+        @rows, idxs: as returned by get_query_set_rows, get_subplan_set_idxs.
+        @ret: same as get_subplan_features_set.
+        '''
+        featdict = {}
+        featdict["table"] = [rows["table"][i] for i in idxs["table"]]
+
+        alljoinfeats = [rows["join"][i] for i in idxs["join"]]
+        if self.join_features and len(alljoinfeats) == 0:
+            alljoinfeats.append(np.zeros(len(self.joins)))
+        featdict["join"] = alljoinfeats
+
+        allpredfeats = []
+        for i in idxs["pred"]:
+            pfeats = rows["pred"][i].copy()
+            if idxs["pred_est"] is not None:
+                pfeats[-1] = idxs["pred_est"]
+            allpredfeats.append(pfeats)
+        if self.pred_features and len(allpredfeats) == 0:
+            allpredfeats.append(np.zeros(self.max_pred_len))
+        featdict["pred"] = allpredfeats
 
+        featdict["flow"] = idxs["flow"]
         return featdict
 
+    def get_subplan_features_set(self, qrep, subplan):
+        '''
+        @ret: {}
+            key: table,pred,join etc.
+            val: [[feats1], [feats2], ...]
+            Note that there can be a variable number of arrays depending on the
+            subplan we're trying to featurize.
+        '''
+        rows = self.get_query_set_rows(qrep)
+        idxs = self.get_subplan_set_idxs(qrep, subplan)
+        return self.get_set_features(rows, idxs)
+
     def get_subplan_features_combined(self, qrep, subplan):
         assert isinstance(subplan, tuple)
         featvectors = []
@@ -803,6 +998,13 @@ class Featurizer():
 
                 # remaining values after the cmp_op feature
                 num_pred_vals = num_vals - len(self.cmp_ops)
+                # selectivity estimate from the sketches, before the pg_est
+                if self.sketch_features:
+                    sel_idx = pred_idx_start + num_pred_vals - 1 - \
+                            int(self.heuristic_features)
+                    assert pfeats[sel_idx] == 0.0
+                    pfeats[sel_idx] = self._get_sketch_selectivity(col,
+                            cmp_op, val)
                 # add the appropriate postgresql estimate for this table in the
                 # subplan
                 if self.heuristic_features:
@@ -829,10 +1031,13 @@ class Featurizer():
         feat = np.concatenate(featvectors)
         return feat
 
-    def get_subplan_features(self, qrep, node):
+    def get_subplan_features(self, qrep, node, set_idxs=False):
         '''
         @subsetg:
         @node: subplan in the subsetgraph;
+        @set_idxs: for set featurization, x is (rows, idxs) as returned by
+        get_query_set_rows, get_subplan_set_idxs, instead of the feature
+        vectors; get_set_features(rows, idxs) returns the feature vectors.
         @ret: []
             will depend on if self.featurization_type == set or combined;
         '''
@@ -843,6 +1048,9 @@ class Featurizer():
         if self.featurization_type == "combined":
             x = self.get_subplan_features_combined(qrep,
                     node)
+        elif self.featurization_type == "set" and set_idxs:
+            x = (self.get_query_set_rows(qrep),
+                    self.get_subplan_set_idxs(qrep, node))
         elif self.featurization_type == "set":
             x = self.get_subplan_features_set(qrep,
                     node)
@@ -860,6 +1068,27 @@ class Featurizer():
 
         return x,y
 
+    def get_subplan_key(self, qrep, node):
+        '''
+        @node: subplan in the subsetgraph.
+        @ret: hashable key, which is the same for subplans with the same
+        features, and true cardinality, in any query: the subplan's sql (which
+        has its tables, joins and predicates in sorted order), and the query
+        dependent parts of its features (heuristic estimates, flow features).
+        '''
+        subsetg = qrep["subset_graph"]
+        key = [nx_graph_to_query(qrep["join_graph"].subgraph(node))]
+        if self.heuristic_features:
+            for alias in node:
+                key.append(subsetg.nodes()[tuple([alias])][self.ckey]["expected"])
+            key.append(subsetg.nodes()[node][self.ckey]["expected"])
+
+        if self.flow_features:
+            key.append(self.get_flow_features(node, subsetg,
+                qrep["template_name"], qrep["join_graph"]).tobytes())
+
+        return tuple(key)
+
     def get_onehot_bucket(self, num_buckets, base, val):
         assert val >= 1.0
         for i in range(num_buckets):
@@ -868,99 +1097,171 @@ class Featurizer():
 
         return num_buckets
 
+    def _get_neighbors(self, node, join_graph):
+        '''
+        @ret: [(alias, table idx)] of the join graph neighbors of node, with
+        spots in the table featurizer.
+        '''
+        neighbors = list(nx.node_boundary(join_graph, node))
+        neighbors.sort()
+        ret = []
+        for al in neighbors:
+            if al not in self.aliases:
+                # possible, for instance with set featurization - we don't
+                # reserve spots for all possible columns / tables in the
+                # unseen set
+                continue
+            table = self.aliases[al]
+            ret.append((al, self.table_featurizer[table]))
+        return ret
+
+    def _get_template_flow_features(self, subsetg, template_name, join_graph):
+        '''
+        The flow features which only depend on the structure of the
+        template's subset graph / join graph (degrees, number of tables and
+        paths, join graph neighbors) are the same for all its queries; so
+        these are computed once per template, as a matrix with a row for each
+        subplan.
+        @ret: node_idx (subplan : row), the matrix, and the join graph
+        neighbors (see _get_neighbors) of each subplan.
+        '''
+        if not hasattr(self, "flow_cache"):
+            self.flow_cache = {}
+        cache = self.flow_cache.get(template_name, None)
+        # the subplans of a query share its subset graph, so its structure is
+        # only compared once per query
+        if cache is not None and cache[4] is subsetg:
+            return cache[0:3]
+        structure_key = _get_structure_key(subsetg, join_graph)
+        if cache is not None and cache[3] == structure_key:
+            self.flow_cache[template_name] = cache[0:4] + (subsetg,)
+            return cache[0:3]
+
+        nodes = [node for node in subsetg.nodes() if node != SOURCE_NODE]
+        node_idx = {}
+        neighbors = {}
+        feats = np.zeros((len(nodes), self.num_flow_features),
+                dtype=np.float32)
+        for i, node in enumerate(nodes):
+            node_idx[node] = i
+            neighbors[node] = self._get_neighbors(node, join_graph)
+            self._set_flow_features(feats[i], node, subsetg, template_name,
+                    neighbors[node], True)
+
+        # a different structure under the same template name replaces it
+        self.flow_cache[template_name] = (node_idx, feats, neighbors,
+                structure_key, subsetg)
+        return node_idx, feats, neighbors
+
     def get_flow_features(self, node, subsetg,
             template_name, join_graph):
         assert node != SOURCE_NODE
+        node_idx, feats, neighbors = self._get_template_flow_features(subsetg,
+                template_name, join_graph)
+
+        if node in node_idx:
+            flow_features = feats[node_idx[node]].copy()
+            node_neighbors = neighbors[node]
+        else:
+            flow_features = np.zeros(self.num_flow_features, dtype=np.float32)
+            node_neighbors = self._get_neighbors(node, join_graph)
+            self._set_flow_features(flow_features, node, subsetg,
+                    template_name, node_neighbors, True)
+
+        self._set_flow_features(flow_features, node, subsetg, template_name,
+                node_neighbors, False)
+        return flow_features
+
+    def _set_flow_features(self, flow_features, node, subsetg,
+            template_name, neighbors, structural):
+        '''
+        @structural: if True, only sets the features that depend on the
+        template's structure; else, only the ones that depend on the query's
+        estimates / costs. Both go over the same layout (cur_idx).
+        '''
         ckey = "cardinality"
-        flow_features = np.zeros(self.num_flow_features, dtype=np.float32)
         cur_idx = 0
         # incoming edges
-        in_degree = subsetg.in_degree(node)
-        flow_features[cur_idx + in_degree] = 1.0
+        if structural:
+            in_degree = subsetg.in_degree(node)
+            flow_features[cur_idx + in_degree] = 1.0
         cur_idx += self.max_in_degree+1
         # outgoing edges
-        out_degree = subsetg.out_degree(node)
-        flow_features[cur_idx + out_degree] = 1.0
+        if structural:
+            out_degree = subsetg.out_degree(node)
+            flow_features[cur_idx + out_degree] = 1.0
         cur_idx += self.max_out_degree+1
         # num tables
         max_tables = len(self.aliases)
         nt = len(node)
         # assert nt <= max_tables
-        flow_features[cur_idx + nt] = 1.0
+        if structural:
+            flow_features[cur_idx + nt] = 1.0
         cur_idx += max_tables
 
         # precomputed based stuff
         if self.feat_num_paths:
-            if node in self.template_info[template_name]:
-                num_paths = self.template_info[template_name][node]["num_paths"]
-            else:
-                num_paths = 0
+            if structural:
+                if node in self.template_info[template_name]:
+                    num_paths = self.template_info[template_name][node]["num_paths"]
+                else:
+                    num_paths = 0
 
-            # assuming min num_paths = 0, min-max normalization
-            flow_features[cur_idx] = num_paths / self.max_paths
+                # assuming min num_paths = 0, min-max normalization
+                flow_features[cur_idx] = num_paths / self.max_paths
             cur_idx += 1
 
         if self.feat_pg_costs and self.heuristic_features and \
                 self.cost_model is not None:
-            in_edges = subsetg.in_edges(node)
-            in_cost = 0.0
-            for edge in in_edges:
-                in_cost += subsetg[edge[0]][edge[1]][self.cost_model + "pg_cost"]
-            # normalized pg cost
-            flow_features[cur_idx] = in_cost / subsetg.graph[self.cost_model + "total_cost"]
+            if not structural:
+                in_edges = subsetg.in_edges(node)
+                in_cost = 0.0
+                for edge in in_edges:
+                    in_cost += subsetg[edge[0]][edge[1]][self.cost_model + "pg_cost"]
+                # normalized pg cost
+                flow_features[cur_idx] = in_cost / subsetg.graph[self.cost_model + "total_cost"]
             cur_idx += 1
 
         if self.feat_tolerance:
-            tol = subsetg.nodes()[node]["tolerance"]
-            tol_idx = int(np.log10(tol))
-            assert tol_idx <= 4
-            flow_features[cur_idx + tol_idx-1] = 1.0
+            if not structural:
+                tol = subsetg.nodes()[node]["tolerance"]
+                tol_idx = int(np.log10(tol))
+                assert tol_idx <= 4
+                flow_features[cur_idx + tol_idx-1] = 1.0
             cur_idx += 4
 
         if self.feat_flows and self.heuristic_features:
-            in_edges = subsetg.in_edges(node)
-            in_flows = 0.0
-            for edge in in_edges:
-                in_flows += subsetg[edge[0]][edge[1]]["pg_flow"]
-            # normalized pg flow
-            flow_features[cur_idx] = in_flows
+            if not structural:
+                in_edges = subsetg.in_edges(node)
+                in_flows = 0.0
+                for edge in in_edges:
+                    in_flows += subsetg[edge[0]][edge[1]]["pg_flow"]
+                # normalized pg flow
+                flow_features[cur_idx] = in_flows
             cur_idx += 1
 
         if self.feat_pg_path:
-            if "pg_path" in subsetg.nodes()[node]:
+            if not structural and "pg_path" in subsetg.nodes()[node]:
                 flow_features[cur_idx] = 1.0
 
         if self.feat_join_graph_neighbors:
-            # neighbors = nx.node_boundary(join_graph, node)
-            neighbors = list(nx.node_boundary(join_graph, node))
-            neighbors.sort()
-
-            for al in neighbors:
-                if al not in self.aliases:
-                    # possible, for instance with set featurization - we don't
-                    # reserve spots for all possible columns / tables in the
-                    # unseen set
-                    continue
-                table = self.aliases[al]
-                tidx = self.table_featurizer[table]
-                flow_features[cur_idx + tidx] = 1.0
+            if structural:
+                for al, tidx in neighbors:
+                    flow_features[cur_idx + tidx] = 1.0
             cur_idx += len(self.table_featurizer)
 
+        if structural:
+            return
+
         if self.feat_rel_pg_ests and self.heuristic_features \
                 and self.cost_model is not None:
             total_cost = subsetg.graph[self.cost_model+"total_cost"]
             pg_est = subsetg.nodes()[node][ckey]["expected"]
             flow_features[cur_idx] = pg_est / total_cost
             cur_idx += 1
-            neighbors = list(nx.node_boundary(join_graph, node))
-            neighbors.sort()
 
             # neighbors in join graph
-            for al in neighbors:
-                if al not in self.aliases:
-                    continue
-                table = self.aliases[al]
-                tidx = self.table_featurizer[table]
+            for al, tidx in neighbors:
                 ncard = subsetg.nodes()[tuple([al])][ckey]["expected"]
                 # TODO: should this be normalized? how?
                 flow_features[cur_idx + tidx] = pg_est / ncard
@@ -980,16 +1281,8 @@ class Featurizer():
             flow_features[cur_idx+bucket] = 1.0
             cur_idx += self.PG_EST_BUCKETS
 
-            # neighbors = nx.node_boundary(join_graph, node)
-            neighbors = list(nx.node_boundary(join_graph, node))
-            neighbors.sort()
-
             # neighbors in join graph
-            for al in neighbors:
-                if al not in self.aliases:
-                    continue
-                table = self.aliases[al]
-                tidx = self.table_featurizer[table]
+            for al, tidx in neighbors:
                 ncard = subsetg.nodes()[tuple([al])][ckey]["expected"]
                 # TODO: should this be normalized? how?
                 # flow_features[cur_idx + tidx] = pg_est / ncard
@@ -1018,8 +1311,6 @@ class Featurizer():
                 flow_features[cur_idx+self.PG_EST_BUCKETS] = 1.0
             cur_idx += self.PG_EST_BUCKETS
 
-        return flow_features
-
     def unnormalize(self, y):
         if self.ynormalization == "log":
             est_card = np.exp((y + \
@@ -1091,6 +1382,9 @@ class Featurizer():
         info = {}
         tmp_name = qrep["template_name"]
 
+        if self.feat_num_paths and tmp_name not in self.template_info:
+            all_num_paths = get_num_paths(subsetg, dest)
+
         for node in subsetg.nodes():
             in_degree = subsetg.in_degree(node)
             if in_degree > self.max_in_degree:
@@ -1107,8 +1401,7 @@ class Featurizer():
             # paths from node -> dest, but edges are reversed in our
             # representation
             if self.feat_num_paths:
-                all_paths = nx.all_simple_paths(subsetg, dest, node)
-                num_paths = len(list(all_paths))
+                num_paths = all_num_paths[node]
                 if num_paths > self.max_paths:
                     self.max_paths = num_paths
                 info[node]["num_paths"] = num_paths
@@ -1136,6 +1429,14 @@ class Featurizer():
             unique_vals_query = UNIQUE_VALS_TEMPLATE.format(FROM_CLAUSE = table,
                                                             COL = column)
 
+            if getattr(self, "column_sketches", False):
+                all_vals_query = ALL_VALS_TEMPLATE.format(FROM_CLAUSE = table,
+                        COL = column)
+                column_stats[column] = get_column_stats(
+                        [out[0] for out in self.execute(all_vals_query)])
+                self.column_stats.update(column_stats)
+                continue
+
             # TODO: move to using cached_execute
             column_stats[column] = {}
             column_stats[column]["min_value"] = self.execute(min_query)[0][0]
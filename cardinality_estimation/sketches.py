@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+
+'''
+Compact per column statistics, built in a single scan over a column's values
+(see Featurizer._update_stats with column_sketches=True), and stored with the
+rest of the column stats:
+
+    - equi-depth histogram: NUM_HIST_BINS+1 bounds, for CDF based range
+      features on numeric columns.
+    - HyperLogLog: distinct value counts, for columns whose distinct values
+      are too many to be stored.
+    - count-min sketch: frequency estimates of values, for the selectivity of
+      equality / IN predicates.
+
+The values are hashed with pandas' vectorized 64 bit hash over their str(), so
+values from the DB, and from the predicates in the sqls, hash the same.
+'''
+
+NUM_HIST_BINS = 100
+HLL_P = 12
+CMS_WIDTH = 2048
+CMS_DEPTH = 4
+# 16 byte keys, one per hash function
+HASH_KEYS = ["ceb0hash0sketch0", "ceb1hash1sketch1", "ceb2hash2sketch2",
+        "ceb3hash3sketch3", "ceb4hash4sketch4"]
+# same cutoff as the DISTINCT values queries in Featurizer._update_stats
+MAX_UNIQUE_VALUES = 5000
+
+def hash_values(vals, hash_key=HASH_KEYS[0]):
+    '''
+    @ret: np.uint64 array of the hashes of str(v) for v in vals.
+    '''
+    vals = np.array([str(v) for v in vals], dtype=object)
+    return pd.util.hash_array(vals, hash_key=hash_key, categorize=False)
+
+def _leading_zeros(x):
+    '''
+    @x: np.uint64 array.
+    @ret: number of leading zero bits of each element (63 for 0).
+    '''
+    x = x.copy()
+    nlz = np.zeros(len(x), dtype=np.int64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        mask = x < (np.uint64(1) << np.uint64(64-shift))
+        nlz[mask] += shift
+        x[mask] = x[mask] << np.uint64(shift)
+    return nlz
+
+class HyperLogLog():
+    def __init__(self, p=HLL_P):
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def add(self, vals):
+        if len(vals) == 0:
+            return
+        hashes = hash_values(vals)
+        idxs = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        ranks = np.minimum(_leading_zeros(hashes << np.uint64(self.p)) + 1,
+                64 - self.p + 1)
+        np.maximum.at(self.registers, idxs, ranks.astype(np.uint8))
+
+    def count(self):
+        m = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / m)
+        est = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(
+            np.float64)))
+        num_zeros = np.sum(self.registers == 0)
+        if est <= 2.5*m and num_zeros > 0:
+            # linear counting for small cardinalities
+            est = m * np.log(m / num_zeros)
+        return int(round(est))
+
+class CountMinSketch():
+    def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH):
+        self.table = np.zeros((depth, width), dtype=np.int64)
+        self.total = 0
+
+    def _buckets(self, vals, d):
+        return (hash_values(vals, HASH_KEYS[d+1]) % \
+                np.uint64(self.table.shape[1])).astype(np.int64)
+
+    def add(self, vals):
+        if len(vals) == 0:
+            return
+        for d in range(self.table.shape[0]):
+            np.add.at(self.table[d], self._buckets(vals, d), 1)
+        self.total += len(vals)
+
+    def estimate(self, vals):
+        '''
+        @ret: array of the (over-)estimated counts of each of vals.
+        '''
+        if len(vals) == 0:
+            return np.zeros(0, dtype=np.int64)
+        ests = [self.table[d][self._buckets(vals, d)] for d in
+                range(self.table.shape[0])]
+        return np.min(ests, axis=0)
+
+class EquiDepthHistogram():
+    def __init__(self, vals, num_bins=NUM_HIST_BINS):
+        '''
+        @vals: numeric values (without NULLs).
+        '''
+        vals = np.array(vals, dtype=np.float64)
+        self.quantiles = np.linspace(0.0, 1.0, num_bins+1)
+        if len(vals) == 0:
+            self.bounds = np.zeros(num_bins+1)
+        else:
+            self.bounds = np.quantile(vals, self.quantiles)
+
+    def cdf(self, val):
+        '''
+        @ret: estimated fraction of values <= val.
+        '''
+        return float(np.interp(float(val), self.bounds, self.quantiles))
+
+def _is_float(val):
+    try:
+        float(val)
+        return True
+    except:
+        return False
+
+def get_column_stats(values, num_bins=NUM_HIST_BINS):
+    '''
+    @values: all the values of a column (including NULLs, as None).
+    @ret: the column stats of Featurizer._update_stats (min_value, max_value,
+    num_values, total_values, unique_values), and their sketches; all from
+    this single pass over the values.
+    '''
+    non_null = [v for v in values if v is not None]
+    stats = {}
+    stats["total_values"] = len(values)
+    sketches = {}
+    sketches["hll"] = HyperLogLog()
+    sketches["hll"].add(non_null)
+    sketches["cms"] = CountMinSketch()
+    sketches["cms"].add(non_null)
+    sketches["histogram"] = None
+
+    if len(non_null) == 0:
+        stats["min_value"] = None
+        stats["max_value"] = None
+    else:
+        stats["min_value"] = min(non_null)
+        stats["max_value"] = max(non_null)
+        if _is_float(stats["min_value"]) and _is_float(stats["max_value"]) \
+                and all([_is_float(v) for v in non_null]):
+            sketches["histogram"] = EquiDepthHistogram(non_null, num_bins)
+
+    stats["num_values"] = sketches["hll"].count()
+    if stats["num_values"] <= MAX_UNIQUE_VALUES:
+        uniques = set(non_null)
+        stats["num_values"] = len(uniques)
+        # same format as the output of SELECT DISTINCT
+        unique_values = [(v,) for v in sorted(uniques)]
+        if len(non_null) < len(values):
+            unique_values.append((None,))
+        stats["unique_values"] = unique_values
+    else:
+        stats["unique_values"] = None
+
+    stats["sketches"] = sketches
+    return stats
+
+def get_selectivity(sketches, pred_type, val):
+    '''
+    @sketches: as in get_column_stats.
+    @pred_type, val: as in join_graph's pred_types, pred_vals.
+    @ret: estimated selectivity of the predicate, among the non-NULL values;
+    or None if it can not be estimated from the sketches.
+    '''
+    cms = sketches["cms"]
+    if cms.total == 0:
+        return None
+    if pred_type == "lt":
+        hist = sketches["histogram"]
+        if hist is None:
+            return None
+        lower = 0.0 if val[0] is None else hist.cdf(val[0])
+        upper = 1.0 if val[1] is None else hist.cdf(val[1])
+        return max(upper - lower, 0.0)
+    if pred_type in ["eq", "in"]:
+        if not isinstance(val, list):
+            val = [val]
+        val = [v for v in val if v is not None and v != "NULL"]
+        count = np.sum(cms.estimate(val))
+        return min(float(count) / cms.total, 1.0)
+    return None
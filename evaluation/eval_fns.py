@@ -219,13 +219,19 @@ class PostgresPlanCost(EvalFunc):
 
     def eval(self, qreps, preds, user="imdb",pwd="password",
             db_name="imdb", db_host="localhost", port=5432, num_processes=-1,
-            result_dir=None, cost_model="cm1", **kwargs):
+            result_dir=None, cost_model="cm1", db_backend=None, pool=None,
+            **kwargs):
         ''''
+        @pool: multiprocessing pool to use, e.g., one shared by all the
+        evaluations of an experiment; otherwise, one is created (see
+        num_processes) for this call.
         @kwargs:
             cost_model: this is just a convenient key to specify the PostgreSQL
             configuration to use. You can implement new versions in the function
             set_cost_model. e.g., cm1: disable materialization and parallelism, and
             enable all other flags.
+            db_backend: None to use PostgreSQL, or a backend from
+            query_representation/db_backends.py, e.g., the local stand-in.
         @ret:
             pg_costs
             Further, the following are saved in the result logs
@@ -237,15 +243,17 @@ class PostgresPlanCost(EvalFunc):
         assert isinstance(preds, list)
         assert isinstance(qreps[0], dict)
 
-        if num_processes == -1:
-            pool = mp.Pool(int(mp.cpu_count()))
-        elif num_processes == -2:
-            pool = None
-        else:
-            pool = mp.Pool(num_processes)
+        own_pool = pool is None
+        if own_pool:
+            if num_processes == -1:
+                pool = mp.Pool(int(mp.cpu_count()))
+            elif num_processes == -2:
+                pool = None
+            else:
+                pool = mp.Pool(num_processes)
 
         ppc = PPC(cost_model, user, pwd, db_host,
-                port, db_name)
+                port, db_name, db_backend=db_backend)
 
         est_cardinalities = []
         true_cardinalities = []
@@ -284,23 +292,29 @@ class PostgresPlanCost(EvalFunc):
                 est_cardinalities=est_cardinalities,
                 result_dir=result_dir)
 
-        if pool is not None:
+        if own_pool and pool is not None:
             pool.close()
         return costs
 
 class SimplePlanCost(EvalFunc):
     def eval(self, qreps, preds, cost_model="C",
-            num_processes=-1, **kwargs):
+            num_processes=-1, pool=None, **kwargs):
+        '''
+        @pool: as in PostgresPlanCost.eval.
+        '''
         assert isinstance(qreps, list)
         assert isinstance(preds, list)
         assert isinstance(qreps[0], dict)
 
-        if num_processes == -1:
-            pool = mp.Pool(int(mp.cpu_count()))
-        else:
-            pool = mp.Pool(num_processes)
+        own_pool = pool is None
+        if own_pool:
+            if num_processes == -1:
+                pool = mp.Pool(int(mp.cpu_count()))
+            else:
+                pool = mp.Pool(num_processes)
 
         pc = PlanCost(cost_model)
         costs, opt_costs = pc.compute_costs(qreps, preds, pool=pool)
-        pool.close()
+        if own_pool:
+            pool.close()
         return costs
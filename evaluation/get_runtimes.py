@@ -6,15 +6,26 @@ import psycopg2 as pg
 import time
 import subprocess as sp
 import os
+import threading
+import klepto
 import pandas as pd
+import numpy as np
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import sys
 sys.path.append(".")
 from query_representation.utils import *
+from query_representation.db_backends import get_db_backend, DB_BACKENDS, \
+        ALIAS_RE
 import pdb
 from cost_model import *
 
 TIMEOUT_CONSTANT = 909
+RUNTIME_COLUMNS = ["qname", "runtime", "exp_analyze", "runtime_p95",
+        "trials", "op_times"]
+CACHE_STATES = ["none", "warm", "cold"]
+# tries, 1 second apart, to reconnect after a restart
+RECONNECT_TRIES = 60
 
 def read_flags():
     parser = argparse.ArgumentParser()
@@ -41,27 +52,69 @@ def read_flags():
             default="password")
     parser.add_argument("--port", type=str, required=False,
             default=5432)
+    parser.add_argument("--db_backend", type=str, required=False,
+            default="postgres", help="""postgres OR local; local is the
+            in-process stand-in of query_representation/db_backends.py,
+            e.g., to try out the runtime collection without a DB.""")
 
-    return parser.parse_args()
+    parser.add_argument("--num_sessions", type=int, required=False,
+            default=1, help="""number of concurrent DB sessions executing
+            the sqls; each session is opened once, and reused.""")
+    parser.add_argument("--exclusive", type=int, required=False,
+            default=0, help="""1: execute one sql at a time, whatever the
+            num_sessions, so concurrent queries do not distort the
+            timings.""")
+    parser.add_argument("--plan_cache_dir", type=str, required=False,
+            default="./.lc_cache/runtimes", help="""runtimes of every hinted
+            sql executed, under the cost model; sqls with the same hinted
+            plan, e.g., from other result dirs, are not executed again. Empty
+            to disable.""")
 
-def execute_sql(sql, cost_model="cm1",
-        explain=False,
-        materialize=False, timeout=900000):
-    '''
-    '''
+    parser.add_argument("--warmup_runs", type=int, required=False,
+            default=0, help="""executions of each sql before its timed
+            trials, which are not recorded.""")
+    parser.add_argument("--num_trials", type=int, required=False,
+            default=1, help="""timed executions of each sql; its runtime is
+            their median, and runtime_p95 their 95th percentile.""")
+    parser.add_argument("--cache_state", type=str, required=False,
+            default="none", help="""buffer cache state before each trial;
+            none: whatever the previous sqls left; warm: pg_prewarm the
+            tables of the sql; cold: restart (see --restart_cmd) and
+            reconnect; cold uses a single session.""")
+    parser.add_argument("--restart_cmd", type=str, required=False,
+            default=None, help="""shell command run for cold trials, e.g.,
+            to restart postgres, and drop the OS page cache; required for
+            cold trials, except with the local backend, which simulates
+            it.""")
+    parser.add_argument("--local_io_latency", type=float, required=False,
+            default=0.0, help="""local backend: seconds to read a table not
+            in its simulated buffer cache.""")
 
-    if explain:
-        sql = sql.replace("explain (format json)", "explain (analyze,costs, format json)")
-    else:
-        sql = sql.replace("explain (format json)", "")
+    return parser.parse_args()
 
-    con = pg.connect(port=args.port,dbname=args.db_name,
-            user=args.user,password=args.pwd,host="localhost")
+def get_backend():
+    if args.db_backend == "local":
+        return get_db_backend(args.db_backend,
+                io_latency=args.local_io_latency)
+    return get_db_backend(args.db_backend)
 
-    # TODO: clear cache
+def get_session(cost_model, timeout, db_backend=None):
+    '''
+    @db_backend: from get_backend; otherwise, a new one is created.
+    @ret: DB connection with the session settings used to execute the hinted
+    sqls; it is in autocommit mode, so the settings persist across all the
+    sqls executed on it, including the ones that fail.
+    '''
+    if db_backend is None:
+        db_backend = get_backend()
+    con = db_backend.connect(args.user, args.pwd, args.db_host, args.port,
+            args.db_name)
+    con.autocommit = True
 
     cursor = con.cursor()
     cursor.execute("LOAD 'pg_hint_plan';")
+    if args.cache_state == "warm":
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_prewarm")
     cursor.execute("SET geqo_threshold = {}".format(32))
     set_cost_model(cursor, cost_model)
 
@@ -71,7 +124,27 @@ def execute_sql(sql, cost_model="cm1",
     cursor.execute("SET join_collapse_limit = {}".format(32))
     cursor.execute("SET from_collapse_limit = {}".format(32))
     cursor.execute("SET statement_timeout = {}".format(timeout))
+    cursor.close()
+    return con
+
+def execute_sql(sql, cost_model="cm1",
+        explain=False,
+        materialize=False, timeout=900000, con=None):
+    '''
+    @con: session from get_session; otherwise, a new one is opened, and
+    closed, for this sql.
+    '''
 
+    if explain:
+        sql = sql.replace("explain (format json)", "explain (analyze,costs, format json)")
+    else:
+        sql = sql.replace("explain (format json)", "")
+
+    own_con = con is None
+    if own_con:
+        con = get_session(cost_model, timeout)
+
+    cursor = con.cursor()
     start = time.time()
 
     try:
@@ -84,7 +157,8 @@ def execute_sql(sql, cost_model="cm1",
             print(e)
             print(sql)
             cursor.close()
-            con.close()
+            if own_con:
+                con.close()
             return None, timeout/1000 + 9.0
         else:
             print("failed because of timeout!")
@@ -97,29 +171,189 @@ def execute_sql(sql, cost_model="cm1",
             else:
                 sql = "explain (format json) " + sql
 
-            set_cost_model(cursor, cost_model, materialize)
+            set_cost_model(cursor, cost_model)
             cursor.execute("SET join_collapse_limit = {}".format(1))
             cursor.execute("SET from_collapse_limit = {}".format(1))
             cursor.execute(sql)
             explain_output = cursor.fetchall()
+            # restore the session settings for the next sqls
+            cursor.execute("SET join_collapse_limit = {}".format(32))
+            cursor.execute("SET from_collapse_limit = {}".format(32))
             cursor.close()
-            con.close()
+            if own_con:
+                con.close()
             return explain_output, (timeout/1000) + 9.0
 
     explain_output = cursor.fetchall()
     end = time.time()
+    cursor.close()
+    if own_con:
+        con.close()
 
     print("took {} seconds".format(end-start))
     sys.stdout.flush()
 
     return explain_output, end-start
 
-def main():
-    def add_runtime_row(qname, rt, exp_analyze):
-        cur_runtimes["qname"].append(qname)
-        cur_runtimes["runtime"].append(rt)
-        cur_runtimes["exp_analyze"].append(exp_analyze)
+def get_plan_key(sql, cost_model):
+    '''
+    @sql: exec_sql, whose pg_hint_plan hints fix its plan.
+    @ret: key of the plan executed for sql, under cost_model, on the
+    db_backend, and timed with the warmup_runs, num_trials and cache_state;
+    the local backend's simulated runtimes also depend on its io latency.
+    '''
+    backend = args.db_backend
+    if args.db_backend == "local":
+        backend += str(args.local_io_latency)
+    timing = "{}-{}-{}".format(args.warmup_runs, max(args.num_trials, 1),
+            args.cache_state)
+    return deterministic_hash(backend + timing + args.db_name + cost_model + \
+            " ".join(sql.split()))
 
+def get_tables(sql):
+    '''
+    @ret: [] of the tables in the FROM clause of sql.
+    '''
+    tables = []
+    for real_name, _ in ALIAS_RE.findall(sql):
+        if real_name not in tables:
+            tables.append(real_name)
+    return tables
+
+def get_op_times(exp_analyze):
+    '''
+    @exp_analyze: output of EXPLAIN (ANALYZE, FORMAT JSON).
+    @ret: [] of the plan's operators, in pre-order, with their actual rows,
+    loops, and times (ms); total_time includes their children, self_time
+    does not. None if exp_analyze has no actual times, e.g., after a timeout.
+    '''
+    try:
+        plan = exp_analyze[0][0][0]["Plan"]
+    except (TypeError, IndexError, KeyError):
+        return None
+    if "Actual Total Time" not in plan:
+        return None
+
+    op_times = []
+    def _add_op(node):
+        loops = node.get("Actual Loops", 1)
+        total_time = node["Actual Total Time"]*loops
+        children = node.get("Plans", [])
+        child_time = sum([child["Actual Total Time"]*child.get("Actual Loops", 1)
+            for child in children if "Actual Total Time" in child])
+        op_times.append({"node_type": node["Node Type"],
+            "relation": node.get("Alias", node.get("Relation Name", None)),
+            "rows": node["Actual Rows"], "loops": loops,
+            "total_time": total_time,
+            "self_time": max(total_time - child_time, 0.0)})
+        for child in children:
+            if "Actual Total Time" in child:
+                _add_op(child)
+
+    _add_op(plan)
+    return op_times
+
+class SessionPool():
+    '''
+    Executes the sqls on num_sessions threads; each thread opens its session
+    (see get_session) once, and reuses it for all its sqls, unless it is
+    reopened for cold trials.
+    '''
+    def __init__(self, num_sessions, cost_model, timeout, db_backend=None):
+        self.cost_model = cost_model
+        self.timeout = timeout
+        self.db_backend = db_backend
+        self.local = threading.local()
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=num_sessions)
+
+    def _connect(self, retries=1):
+        for i in range(retries):
+            try:
+                con = get_session(self.cost_model, self.timeout,
+                        self.db_backend)
+                break
+            except pg.OperationalError:
+                if i == retries-1:
+                    raise
+                time.sleep(1)
+        self.local.con = con
+        with self.lock:
+            self.sessions.append(con)
+
+    def _set_cache_state(self, sql):
+        if args.cache_state == "warm":
+            cursor = self.local.con.cursor()
+            for table in get_tables(sql):
+                cursor.execute("SELECT pg_prewarm('{}')".format(table))
+            cursor.close()
+        elif args.cache_state == "cold":
+            self.local.con.close()
+            self.db_backend.restart(args.restart_cmd)
+            self._connect(RECONNECT_TRIES)
+
+    def _execute(self, sql):
+        '''
+        @ret: {} with the RUNTIME_COLUMNS (except qname) of sql: warmup_runs
+        untimed executions, and num_trials timed ones, each after setting
+        the cache_state; after a timeout, no more trials are run.
+        '''
+        if not hasattr(self.local, "con"):
+            self._connect()
+        timeout_rt = self.timeout/1000 + 9.0
+
+        for _ in range(args.warmup_runs):
+            _, rt = execute_sql(sql, cost_model=self.cost_model,
+                    explain=False, timeout=self.timeout, con=self.local.con)
+            if rt >= timeout_rt:
+                break
+
+        trials = []
+        for _ in range(max(args.num_trials, 1)):
+            self._set_cache_state(sql)
+            exp_analyze, rt = execute_sql(sql, cost_model=self.cost_model,
+                    explain=args.explain, timeout=self.timeout,
+                    con=self.local.con)
+            trials.append(rt)
+            if rt >= timeout_rt:
+                break
+
+        return {"runtime": float(np.median(trials)),
+                "runtime_p95": float(np.percentile(trials, 95)),
+                "trials": trials, "exp_analyze": exp_analyze,
+                "op_times": get_op_times(exp_analyze)}
+
+    def submit(self, sql):
+        return self.executor.submit(self._execute, sql)
+
+    def close(self):
+        self.executor.shutdown()
+        for con in self.sessions:
+            con.close()
+
+def append_runtimes(rt_fn, rows):
+    '''
+    appends the rows ({} with RUNTIME_COLUMNS) to the runtimes csv, so it is
+    never rewritten.
+    '''
+    df = pd.DataFrame(rows, columns=RUNTIME_COLUMNS)
+    df.to_csv(rt_fn, mode="a", header=not os.path.exists(rt_fn), index=False)
+
+def get_stored_runtimes(rt_fn):
+    '''
+    @ret: the runtimes csv; one with older columns is rewritten once with the
+    RUNTIME_COLUMNS, so the rows appended to it line up.
+    '''
+    if not os.path.exists(rt_fn):
+        return pd.DataFrame(columns=RUNTIME_COLUMNS)
+    runtimes = pd.read_csv(rt_fn)
+    if list(runtimes.columns) != RUNTIME_COLUMNS:
+        runtimes = runtimes.reindex(columns=RUNTIME_COLUMNS)
+        runtimes.to_csv(rt_fn, index=False)
+    return runtimes
+
+def main():
     cost_model = args.cost_model
     costs_fn = os.path.join(args.result_dir, args.costs_fn)
 
@@ -131,40 +365,80 @@ def main():
     rt_fn = os.path.join(args.result_dir, "Runtimes.csv")
 
     # go in order and execute runtimes...
-    if os.path.exists(rt_fn):
-        runtimes = pd.read_csv(rt_fn)
-    else:
-        runtimes = None
+    runtimes = get_stored_runtimes(rt_fn)
+    # the last stored runtime of each query
+    stored_rts = dict(zip(runtimes["qname"].values, runtimes["runtime"].values))
 
-    if runtimes is None:
-        columns = ["qname", "runtime", "exp_analyze"]
-        runtimes = pd.DataFrame(columns=columns)
-
-    cur_runtimes = defaultdict(list)
+    if args.plan_cache_dir != "":
+        plan_cache = klepto.archives.dir_archive(args.plan_cache_dir,
+                cached=True, serialized=True).archive
+    else:
+        plan_cache = {}
 
+    # plan key : [qnames]
+    to_execute = {}
+    sqls = {}
     for i,row in costs.iterrows():
-        if row["qname"] in runtimes["qname"].values:
-            # what is the stored value for this key?
-            rt_df = runtimes[runtimes["qname"] == row["qname"]]
-            stored_rt = rt_df["runtime"].values[0]
-            if stored_rt == TIMEOUT_CONSTANT and args.rerun_timeouts:
+        qname = row["qname"]
+        if qname in stored_rts:
+            if stored_rts[qname] == TIMEOUT_CONSTANT and args.rerun_timeouts:
                 print("going to rerun timed out query")
             else:
-                print("skipping {} with stored runtime".format(row["qname"]))
+                print("skipping {} with stored runtime".format(qname))
                 continue
 
-        exp_analyze, rt = execute_sql(row["exec_sql"],
-                cost_model=cost_model,
-                explain=args.explain,
-                timeout=args.timeout)
+        plan_key = get_plan_key(row["exec_sql"], cost_model)
+        if plan_key in plan_cache and not (args.rerun_timeouts and \
+                plan_cache[plan_key]["runtime"] == TIMEOUT_CONSTANT):
+            cached = plan_cache[plan_key]
+            print("{} has the same plan as an executed query".format(qname))
+            # entries cached before the repeated trials only have one runtime
+            append_runtimes(rt_fn, [{"qname": qname,
+                "runtime": cached["runtime"],
+                "exp_analyze": cached["exp_analyze"],
+                "runtime_p95": cached.get("runtime_p95", cached["runtime"]),
+                "trials": cached.get("trials", [cached["runtime"]]),
+                "op_times": cached.get("op_times",
+                    get_op_times(cached["exp_analyze"]))}])
+            continue
 
-        add_runtime_row(row["qname"], rt, exp_analyze)
+        # queries with the same plan are only executed once
+        if plan_key not in to_execute:
+            to_execute[plan_key] = []
+            sqls[plan_key] = row["exec_sql"]
+        to_execute[plan_key].append(qname)
 
-        rts = cur_runtimes["runtime"]
+    assert args.cache_state in CACHE_STATES
+    # otherwise, the cold trials would silently run with warm caches
+    assert args.cache_state != "cold" or args.restart_cmd is not None or \
+            args.db_backend == "local", "cold cache_state needs a restart_cmd"
+    # a restart would abort the sqls running on the other sessions
+    if args.exclusive or args.cache_state == "cold":
+        num_sessions = 1
+    else:
+        num_sessions = args.num_sessions
+    print("executing {} plans, with {} sessions".format(len(to_execute),
+        num_sessions))
+    pool = SessionPool(num_sessions, cost_model, args.timeout, get_backend())
+    futures = {}
+    for plan_key in to_execute:
+        futures[pool.submit(sqls[plan_key])] = plan_key
+
+    rts = []
+    for future in as_completed(futures):
+        plan_key = futures[future]
+        result = future.result()
+        rt = result["runtime"]
+        # results are only written from this thread
+        plan_cache[plan_key] = result
+        append_runtimes(rt_fn, [dict(result, qname=qname)
+            for qname in to_execute[plan_key]])
+
+        rts.append(rt)
         print("#Queries:{}, AvgRt: {}".format(len(rts),
             sum(rts) / len(rts)))
-        df = pd.concat([runtimes, pd.DataFrame(cur_runtimes)], ignore_index=True)
-        df.to_csv(rt_fn, index=False)
+
+    pool.close()
 
 if __name__ == "__main__":
     args = read_flags()
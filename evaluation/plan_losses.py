@@ -189,7 +189,7 @@ def _get_pg_plancost(query, est_cardinalities, true_cardinalities,
 
 def compute_cost_pg_single(queries, join_graphs, true_cardinalities,
         est_cardinalities, opt_costs, user, pwd, db_host, port, db_name,
-        use_qplan_cache, cost_model):
+        use_qplan_cache, cost_model, db_backend=None):
     '''
     Just a wrapper function around the PPC methods --- separate
     function so we can call it using multiprocessing. See
@@ -197,14 +197,19 @@ def compute_cost_pg_single(queries, join_graphs, true_cardinalities,
 
     @use_qplan_cache: query plans for the same query can be repeated often;
     Setting this to true uses a cache across runs for such plans.
+    @db_backend: see query_representation/db_backends.py; None connects to
+    PostgreSQL.
     '''
-    # some weird effects between different installations
-    try:
-        con = pg.connect(port=port,dbname=db_name,
-                user=user,password=pwd, host=db_host)
-    except:
-        con = pg.connect(port=port,dbname=db_name,
-                user=user,password=pwd)
+    if db_backend is not None:
+        con = db_backend.connect(user, pwd, db_host, port, db_name)
+    else:
+        # some weird effects between different installations
+        try:
+            con = pg.connect(port=port,dbname=db_name,
+                    user=user,password=pwd, host=db_host)
+        except:
+            con = pg.connect(port=port,dbname=db_name,
+                    user=user,password=pwd)
 
     # FIXME: always use this?
     if use_qplan_cache:
@@ -241,11 +246,14 @@ def compute_cost_pg_single(queries, join_graphs, true_cardinalities,
 
 class PPC():
 
-    def __init__(self, cost_model, user, pwd, db_host, port, db_name):
+    def __init__(self, cost_model, user, pwd, db_host, port, db_name,
+            db_backend=None):
         '''
         @cost_model: str.
+        @db_backend: None, or a backend from query_representation/db_backends.py
         '''
         self.cost_model = cost_model
+        self.db_backend = db_backend
         self.user = user
         self.pwd = pwd
         self.db_host = db_host
@@ -308,7 +316,7 @@ class PPC():
                     true_cardinalities, est_cardinalities, opt_costs,
                     self.user,
                     self.pwd, self.db_host, self.port, self.db_name, False,
-                    self.cost_model)]
+                    self.cost_model, self.db_backend)]
             batch_size = len(sqls)
         else:
             num_processes = pool._processes
@@ -324,7 +332,8 @@ class PPC():
                     est_cardinalities[start_idx:end_idx],
                     opt_costs[start_idx:end_idx],
                     self.user, self.pwd, self.db_host,
-                    self.port, self.db_name, use_qplan_cache, self.cost_model))
+                    self.port, self.db_name, use_qplan_cache, self.cost_model,
+                    self.db_backend))
 
             all_costs = pool.starmap(compute_cost_pg_single, par_args)
 
@@ -4,24 +4,34 @@ from query_representation.query import *
 from evaluation.eval_fns import *
 from cardinality_estimation.featurizer import *
 from cardinality_estimation.algs import *
+from cardinality_estimation.experiments import run_parallel, \
+        successive_halving
+from query_representation.db_backends import get_db_backend
 
 import glob
+import itertools
 import argparse
 import random
+import multiprocessing as mp
+import functools
 import klepto
 from sklearn.model_selection import train_test_split
 import pdb
 import copy
 
-def eval_alg(alg, eval_funcs, qreps, samples_type):
+def eval_alg(alg, eval_funcs, qreps, samples_type, db_backend=None,
+        ests=None, pool=None):
     '''
+    @ests: alg's estimates for qreps, if they have already been computed.
+    @pool: multiprocessing pool shared by the plan cost evaluations.
     '''
     np.set_printoptions(formatter={'float': lambda x: "{0:0.3f}".format(x)})
 
     start = time.time()
     alg_name = alg.__str__()
     exp_name = alg.get_exp_name()
-    ests = alg.test(qreps)
+    if ests is None:
+        ests = alg.test(qreps)
 
     for efunc in eval_funcs:
         rdir = None
@@ -34,7 +44,7 @@ def eval_alg(alg, eval_funcs, qreps, samples_type):
                 result_dir=rdir, user = args.user, db_name = args.db_name,
                 db_host = args.db_host, port = args.port,
                 num_processes = args.num_eval_processes,
-                alg_name = alg_name)
+                alg_name = alg_name, db_backend = db_backend, pool = pool)
 
         print("{}, {}, {}, #samples: {}, {}: mean: {}, median: {}, 99p: {}"\
                 .format(args.db_name, samples_type, alg, len(errors),
@@ -45,6 +55,15 @@ def eval_alg(alg, eval_funcs, qreps, samples_type):
 
     print("all loss computations took: ", time.time()-start)
 
+def get_checkpoint_dir(alg):
+    '''
+    @ret: the alg's own dir in args.checkpoint_dir, so several algs trained
+    together never resume from, or overwrite, each other's checkpoints.
+    '''
+    if args.checkpoint_dir is None:
+        return None
+    return os.path.join(args.checkpoint_dir, alg)
+
 def get_alg(alg):
     if alg == "saved":
         assert args.model_dir is not None
@@ -65,11 +84,15 @@ def get_alg(alg):
         return RandomForest(grid_search = False,
                 n_estimators = 100,
                 max_depth = 10,
-                lr = 0.01)
+                lr = 0.01,
+                chunk_size = args.tree_chunk_size)
     elif alg == "xgb":
         return XGBoost(grid_search=False, tree_method="hist",
                        subsample=1.0, n_estimators = 100,
-                       max_depth=10, lr = 0.01)
+                       max_depth=10, lr = 0.01,
+                       chunk_size = args.tree_chunk_size,
+                       external_memory = args.external_memory,
+                       cache_dir = args.external_memory_dir)
     elif alg == "fcnn":
         return FCNN(max_epochs = args.max_epochs, lr=args.lr,
                 mb_size = args.mb_size,
@@ -78,10 +101,16 @@ def get_alg(alg):
                 result_dir = args.result_dir,
                 num_hidden_layers=args.num_hidden_layers,
                 eval_epoch = args.eval_epoch,
+                early_stopping_patience = args.early_stopping_patience,
+                checkpoint_dir = get_checkpoint_dir(alg),
                 optimizer_name=args.optimizer_name,
                 clip_gradient=args.clip_gradient,
                 loss_func_name = args.loss_func_name,
-                hidden_layer_size = args.hidden_layer_size)
+                hidden_layer_size = args.hidden_layer_size,
+                stream_shard_size = args.stream_shard_size,
+                stream_buffer_size = args.stream_buffer_size,
+                stream_num_workers = args.stream_num_workers,
+                dedup_subplans = args.dedup_subplans)
     elif alg == "mscn":
         return MSCN(max_epochs = args.max_epochs, lr=args.lr,
                 load_padded_mscn_feats = args.load_padded_mscn_feats,
@@ -91,10 +120,16 @@ def get_alg(alg):
                 result_dir = args.result_dir,
                 num_hidden_layers=args.num_hidden_layers,
                 eval_epoch = args.eval_epoch,
+                early_stopping_patience = args.early_stopping_patience,
+                checkpoint_dir = get_checkpoint_dir(alg),
                 optimizer_name=args.optimizer_name,
                 clip_gradient=args.clip_gradient,
                 loss_func_name = args.loss_func_name,
-                hidden_layer_size = args.hidden_layer_size)
+                hidden_layer_size = args.hidden_layer_size,
+                stream_shard_size = args.stream_shard_size,
+                stream_buffer_size = args.stream_buffer_size,
+                stream_num_workers = args.stream_num_workers,
+                dedup_subplans = args.dedup_subplans)
 
     else:
         assert False
@@ -182,22 +217,36 @@ def get_query_fns():
 
     return train_qfns, test_qfns, val_qfns
 
-def load_qdata(fns):
-    qreps = []
+def iter_qdata(fns):
     for qfn in fns:
         qrep = load_qrep(qfn)
         # TODO: can do checks like no queries with zero cardinalities etc.
-        qreps.append(qrep)
         template_name = os.path.basename(os.path.dirname(qfn))
         qrep["name"] = os.path.basename(qfn)
         qrep["template_name"] = template_name
+        yield qrep
 
-    return qreps
+def load_qdata(fns):
+    return list(iter_qdata(fns))
 
-def get_featurizer(trainqs, valqs, testqs):
-    featkey = deterministic_hash("db-" + args.query_dir + \
+def all_qdata(trainqs, valqs, testqs):
+    '''
+    @trainqs: [] qreps, or [] qrep files when streaming the training data.
+    @ret: iterator over all the qreps, loading the training qreps one at a
+    time if needed.
+    '''
+    if len(trainqs) > 0 and isinstance(trainqs[0], str):
+        trainqs = iter_qdata(trainqs)
+    return itertools.chain(trainqs, valqs, testqs)
+
+def get_featkey():
+    return deterministic_hash("db-" + args.query_dir + \
                 args.query_templates + args.algs \
-                + args.train_test_split_kind)
+                + args.train_test_split_kind + str(args.column_sketches))
+
+def get_featurizer(trainqs, valqs, testqs, db_backend=None,
+        feat_type="combined"):
+    featkey = get_featkey()
     misc_cache = klepto.archives.dir_archive("./misc_cache",
             cached=True, serialized=True)
     found_feats = featkey in misc_cache.archive and not args.regen_featstats
@@ -208,14 +257,11 @@ def get_featurizer(trainqs, valqs, testqs):
         featurizer = misc_cache.archive[featkey]
     else:
         featurizer = Featurizer(args.user, args.pwd, args.db_name,
-                args.db_host, args.port)
-        featurizer.update_column_stats(trainqs+valqs+testqs)
+                args.db_host, args.port, db_backend=db_backend,
+                column_sketches=args.column_sketches)
+        featurizer.update_column_stats(all_qdata(trainqs, valqs, testqs))
         misc_cache.archive[featkey] = featurizer
-
-    if args.algs == "mscn":
-        feat_type = "set"
-    else:
-        feat_type = "combined"
+    featurizer.db_backend = db_backend
 
     # Look at the various keyword arguments to setup() to change the
     # featurization behavior; e.g., include certain features etc.
@@ -223,46 +269,219 @@ def get_featurizer(trainqs, valqs, testqs):
     # collected in the featurizer.update_column_stats call; Therefore, we don't
     # include this in the cached version
     featurizer.setup(ynormalization=args.ynormalization,
-            featurization_type=feat_type)
-    featurizer.update_ystats(trainqs+valqs+testqs)
+            featurization_type=feat_type,
+            sketch_features=args.column_sketches)
+    featurizer.update_ystats(all_qdata(trainqs, valqs, testqs))
 
     return featurizer
 
+def train_and_test(alg, featurizer, trainqs, valqs, testqs, samples):
+    '''
+    @samples: [] of (samples_type, qreps) to test alg on.
+    @ret: {samples_type : alg's estimates}.
+    '''
+    alg.train(trainqs, valqs=valqs, testqs=testqs,
+            featurizer=featurizer, result_dir=args.result_dir)
+    ests = {}
+    for samples_type, qreps in samples:
+        ests[samples_type] = alg.test(qreps)
+    return ests
+
+def get_eval_pool(eval_fns):
+    '''
+    @ret: the multiprocessing pool shared by all the plan cost evaluations, or
+    None if they do not need one.
+    '''
+    if not any([isinstance(efn, (PostgresPlanCost, SimplePlanCost))
+            for efn in eval_fns]):
+        return None
+    if args.num_eval_processes == -1:
+        return mp.Pool(int(mp.cpu_count()))
+    elif args.num_eval_processes == -2:
+        return None
+    return mp.Pool(args.num_eval_processes)
+
+SEARCH_PARAMS = ["lr", "mb_size", "hidden_layer_size", "num_hidden_layers",
+        "weight_decay", "loss_func_name"]
+
+def get_search_configs():
+    '''
+    @ret: [] of up to args.search_num_configs configs, i.e., dicts with values
+    for SEARCH_PARAMS, sampled from the values given by the --search_* flags
+    (or the value of the corresponding flag, if it is not given).
+    '''
+    all_vals = []
+    for param in SEARCH_PARAMS:
+        vals = getattr(args, "search_" + param)
+        default = getattr(args, param)
+        if vals is None:
+            all_vals.append([default])
+        else:
+            all_vals.append([type(default)(v) for v in vals.split(",")])
+
+    configs = [dict(zip(SEARCH_PARAMS, vals)) for vals in
+            itertools.product(*all_vals)]
+    rng = random.Random(args.seed)
+    rng.shuffle(configs)
+    return configs[0:args.search_num_configs]
+
+def get_search_alg(config_idx, config, num_epochs):
+    '''
+    @ret: the alg of args.algs with config, which trains up to num_epochs,
+    checkpointing in its own dir of args.search_dir; the dir is keyed by all
+    the alg's settings, and the data it is trained on, so a search with other
+    flags never resumes from it.
+    '''
+    alg = get_alg(args.algs)
+    kwargs = copy.copy(alg.kwargs)
+    kwargs.update(config)
+    kwargs.pop("checkpoint_dir")
+    kwargs.pop("max_epochs")
+    config_key = deterministic_hash(str(get_featkey()) + args.ynormalization + \
+            str(args.seed) + str(args.test_size) + str(args.val_size) + \
+            str(sorted(kwargs.items())))
+    kwargs["max_epochs"] = num_epochs
+    kwargs["checkpoint_dir"] = os.path.join(args.search_dir,
+            "config" + str(config_idx) + "-" + str(config_key))
+    return alg.__class__(**kwargs)
+
+def train_search_config(featurizer, dataset_cache, trainqs, valqs,
+        config_idx, config, num_epochs):
+    alg = get_search_alg(config_idx, config, num_epochs)
+    alg.dataset_cache = dataset_cache
+    alg.train(trainqs, valqs=valqs, featurizer=featurizer)
+    return alg.best_val_qerr
+
+def search(trainqs, valqs, testqs, db_backend):
+    '''
+    Searches over the configs of get_search_configs for args.algs (fcnn /
+    mscn) with successive halving on the validation mean q-error; the
+    queries are loaded, and featurized, once for all the configs, and the
+    configs of each rung are trained in args.parallel_algs processes. The best
+    config is then evaluated.
+    '''
+    assert args.algs in ["fcnn", "mscn"], "can only search fcnn / mscn configs"
+    assert len(valqs) > 0, "search needs validation queries (--val_size)"
+    assert args.eval_epoch > 0
+    configs = get_search_configs()
+    print("searching over {} configs".format(len(configs)))
+
+    feat_type = "set" if args.algs == "mscn" else "combined"
+    featurizer = get_featurizer(trainqs, valqs, testqs,
+            db_backend=db_backend, feat_type=feat_type)
+    dataset_cache = {}
+    alg = get_search_alg(0, configs[0], args.max_epochs)
+    alg.featurizer = featurizer
+    alg.dataset_cache = dataset_cache
+    init_datasets(alg, trainqs, [valqs, testqs])
+
+    run_fn = functools.partial(train_search_config, featurizer,
+            dataset_cache, trainqs, valqs)
+    best_idx, history = successive_halving(configs, run_fn,
+            args.search_min_epochs, args.max_epochs, eta=args.search_eta,
+            num_parallel=args.parallel_algs)
+    num_epochs = max(history[best_idx].keys())
+    print("best config: {}, val mean q-error: {:.3f}, after {} epochs".format(
+        configs[best_idx], history[best_idx][num_epochs], num_epochs))
+
+    # with 0 epochs, train only restores the best net from its checkpoint
+    alg = get_search_alg(best_idx, configs[best_idx], 0)
+    alg.dataset_cache = dataset_cache
+    alg.train(trainqs, valqs=valqs, featurizer=featurizer)
+    assert alg.best_val_qerr == history[best_idx][num_epochs]
+
+    eval_fns = []
+    for efn in args.eval_fns.split(","):
+        eval_fns.append(get_eval_fn(efn))
+    pool = get_eval_pool(eval_fns)
+    for samples_type, qreps in [("val", valqs), ("test", testqs)]:
+        if len(qreps) > 0:
+            eval_alg(alg, eval_fns, qreps, samples_type, db_backend,
+                    pool=pool)
+    if pool is not None:
+        pool.close()
+
 def main():
 
     train_qfns, test_qfns, val_qfns = get_query_fns()
+    algs = []
+    for alg_name in args.algs.split(","):
+        algs.append(get_alg(alg_name))
 
-    trainqs = load_qdata(train_qfns)
+    if args.stream_train:
+        # the training qreps are loaded from disk shard by shard, while
+        # training, so they never all need to be in memory
+        assert all([isinstance(alg, (FCNN, MSCN)) for alg in algs]), \
+                "only nns can stream training data"
+        trainqs = train_qfns
+    else:
+        trainqs = load_qdata(train_qfns)
 
     # Note: can be quite memory intensive to load them all; might want to just
     # keep around the qfns and load them as needed
     valqs = load_qdata(val_qfns)
     testqs = load_qdata(test_qfns)
 
-    # only needs featurizer for learned models
-    if args.algs in ["xgb", "fcnn", "mscn"]:
-        featurizer = get_featurizer(trainqs, valqs, testqs)
+    if args.db_backend == "local":
+        # answers the DB queries from the cardinalities stored in the qreps
+        db_backend = get_db_backend("local",
+                qreps=all_qdata(trainqs, valqs, testqs))
     else:
-        featurizer = None
-
-    algs = []
-    for alg_name in args.algs.split(","):
-        algs.append(get_alg(alg_name))
+        db_backend = None
+
+    if args.search_num_configs > 0:
+        search(trainqs, valqs, testqs, db_backend)
+        return
+
+    samples = []
+    if not args.stream_train:
+        samples.append(("train", trainqs))
+    if len(valqs) > 0:
+        samples.append(("val", valqs))
+    if len(testqs) > 0:
+        samples.append(("test", testqs))
+
+    # only needs featurizer for learned models; one per featurization type,
+    # and the datasets featurized with it are shared by all the algs
+    featurizers = {}
+    alg_featurizers = []
+    dataset_cache = {}
+    for alg in algs:
+        if not isinstance(alg, (XGBoost, RandomForest, FCNN, MSCN)):
+            alg_featurizers.append(None)
+            continue
+        feat_type = "set" if isinstance(alg, MSCN) else "combined"
+        if feat_type not in featurizers:
+            featurizers[feat_type] = get_featurizer(trainqs, valqs, testqs,
+                    db_backend=db_backend, feat_type=feat_type)
+        alg_featurizers.append(featurizers[feat_type])
+        alg.dataset_cache = dataset_cache
+
+    if args.parallel_algs > 1:
+        # featurize once, in this process, so the forked processes training
+        # the algs share the features
+        for alg, featurizer in zip(algs, alg_featurizers):
+            alg.featurizer = featurizer
+            init_datasets(alg, trainqs, [qreps for _, qreps in samples])
+            # so the result dirs of the algs are named in this process
+            alg.get_exp_name()
+
+    all_ests = run_parallel(train_and_test,
+            [(alg, featurizer, trainqs, valqs, testqs, samples)
+                for alg, featurizer in zip(algs, alg_featurizers)],
+            args.parallel_algs)
 
     eval_fns = []
     for efn in args.eval_fns.split(","):
         eval_fns.append(get_eval_fn(efn))
 
-    for alg in algs:
-        alg.train(trainqs, valqs=valqs, testqs=testqs,
-                featurizer=featurizer, result_dir=args.result_dir)
-        eval_alg(alg, eval_fns, trainqs, "train")
-
-        if len(valqs) > 0:
-            eval_alg(alg, eval_fns, valqs, "val")
-
-        if len(testqs) > 0:
-            eval_alg(alg, eval_fns, testqs, "test")
+    pool = get_eval_pool(eval_fns)
+    for alg, ests in zip(algs, all_ests):
+        for samples_type, qreps in samples:
+            eval_alg(alg, eval_fns, qreps, samples_type, db_backend,
+                    ests=ests[samples_type], pool=pool)
+    if pool is not None:
+        pool.close()
 
 def read_flags():
     parser = argparse.ArgumentParser()
@@ -280,6 +499,11 @@ def read_flags():
             default="password")
     parser.add_argument("--port", type=int, required=False,
             default=5432)
+    parser.add_argument("--db_backend", type=str, required=False,
+            default="postgres", help="""postgres OR local. local uses an
+            in-process stand-in for PostgreSQL, which answers the queries
+            from the stored cardinalities, so PPC etc. can be run without a
+            DB (the resulting costs are not PostgreSQL's costs).""")
 
     parser.add_argument("--result_dir", type=str, required=False,
             default="results")
@@ -304,6 +528,27 @@ def read_flags():
             default=0.2)
     parser.add_argument("--algs", type=str, required=False,
             default="postgres")
+    parser.add_argument("--search_num_configs", type=int, required=False,
+            default=0, help="""> 0: instead of training args.algs (fcnn /
+            mscn) once, search over these many configs of it with successive
+            halving, see main.search.""")
+    parser.add_argument("--search_min_epochs", type=int, required=False,
+            default=1, help="""epochs every config is trained for, before
+            the first halving.""")
+    parser.add_argument("--search_eta", type=int, required=False,
+            default=3, help="""only the best 1/eta configs are trained for
+            eta times as many epochs after each rung.""")
+    parser.add_argument("--search_dir", type=str, required=False,
+            default="./search/", help="""checkpoints of the configs, in dirs
+            keyed by their settings; a search with the same flags resumes
+            from them.""")
+    for param in SEARCH_PARAMS:
+        parser.add_argument("--search_" + param, type=str, required=False,
+                default=None, help="""comma separated values of {} to
+                search over.""".format(param))
+    parser.add_argument("--parallel_algs", type=int, required=False,
+            default=1, help="""number of the algs to train, and test, at a
+            time in parallel processes, each on its own set of CPUs.""")
     parser.add_argument("--eval_fns", type=str, required=False,
             default="qerr,ppc,plancost")
 
@@ -312,17 +557,55 @@ def read_flags():
             default=1)
     parser.add_argument("--ynormalization", type=str, required=False,
             default="log")
+    parser.add_argument("--column_sketches", type=int, required=False,
+            default=0, help="""1: column stats are collected in one scan per
+            column, which also builds equi-depth histograms, HyperLogLog and
+            count-min sketches; these give CDF based range features, and a
+            selectivity estimate feature for each predicate.""")
 
     ## NN training features
     parser.add_argument("--load_padded_mscn_feats", type=int, required=False,
             default=0, help="""loads all the mscn features with padded zeros in memory -- speeds up training, but can take too much RAM.""")
 
+    parser.add_argument("--stream_train", type=int, required=False,
+            default=0, help="""1: the training queries are loaded, and
+            featurized, shard by shard while training (fcnn / mscn), instead
+            of all being held in memory.""")
+    parser.add_argument("--stream_shard_size", type=int, required=False,
+            default=100, help="""number of queries per shard when
+            streaming.""")
+    parser.add_argument("--stream_buffer_size", type=int, required=False,
+            default=20000, help="""number of subplans in the shuffle buffer
+            (per worker) when streaming.""")
+    parser.add_argument("--stream_num_workers", type=int, required=False,
+            default=2, help="""worker processes featurizing the shards when
+            streaming.""")
+    parser.add_argument("--tree_chunk_size", type=int, required=False,
+            default=1000, help="""number of queries featurized at a time
+            for the feature matrices of xgb / rf.""")
+    parser.add_argument("--external_memory", type=int, required=False,
+            default=0, help="""xgb trains from an external memory DMatrix,
+            cached on disk, instead of holding the features in memory.""")
+    parser.add_argument("--external_memory_dir", type=str, required=False,
+            default="./xgb_cache/")
+    parser.add_argument("--dedup_subplans", type=int, required=False,
+            default=1, help="""featurize, and evaluate, identical subplans
+            of the test queries only once.""")
+
     parser.add_argument("--weight_decay", type=float, required=False,
             default=0.0)
     parser.add_argument("--max_epochs", type=int,
             required=False, default=10)
     parser.add_argument("--eval_epoch", type=int,
             required=False, default=1)
+    parser.add_argument("--early_stopping_patience", type=int,
+            required=False, default=5, help="""stop training after these many
+            evaluations (every eval_epoch epochs) without an improvement of the
+            mean q-error on the validation queries; 0 to never stop early.""")
+    parser.add_argument("--checkpoint_dir", type=str, required=False,
+            default=None, help="""save the training state of each alg in its
+            subdir here after every evaluation, and resume from it if it
+            exists.""")
     parser.add_argument("--mb_size", type=int, required=False,
             default=1024)
 
@@ -5,11 +5,11 @@ sys.path.append(".")
 import pdb
 import random
 import klepto
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
 import multiprocessing
 import toml
 # from db_utils.query_storage import *
-from utils.utils import *
+from query_representation.utils import *
 import json
 import pickle
 
@@ -19,46 +19,137 @@ from query_representation.query import *
 from query_gen.query_generator import *
 import time
 import glob
+import math
 
-def verify_queries(query_strs):
-    all_queries = []
+# number of queries EXPLAINed over one connection by a worker
+VERIFY_BATCH_SIZE = 100
+# with a cardinality band, generate and verify at most these many rounds of
+# candidates per template
+MAX_GEN_ROUNDS = 10
+# plan nodes above the joins; their row estimates are not the estimated
+# cardinality of the join
+NON_JOIN_NODES = ["Aggregate", "Sort", "Incremental Sort", "Limit", "Gather",
+        "Gather Merge", "Group", "Unique", "WindowAgg", "Result"]
+
+def get_plan_cardinality(plan):
+    '''
+    @plan: "Plan" of the EXPLAIN (FORMAT JSON) output.
+    @ret: estimated number of rows of the joins in the plan.
+    '''
+    while plan["Node Type"] in NON_JOIN_NODES and "Plans" in plan:
+        plan = plan["Plans"][0]
+    return plan["Plan Rows"]
+
+def explain_queries(query_strs, user, db_host, port, pwd, db_name):
+    '''
+    runs EXPLAIN for a batch of queries over a single connection; called in
+    the worker processes of verify_queries.
+    @ret: [estimated cardinality, or None if EXPLAIN failed] for each query.
+    '''
+    con = pg.connect(user=user, host=db_host, port=port,
+            password=pwd, database=db_name)
+    cursor = con.cursor()
+    outputs = []
     for cur_sql in query_strs:
-        start = time.time()
-        test_sql = "EXPLAIN " + cur_sql
-        output = cached_execute_query(test_sql, args.user,
-                args.db_host, args.port, args.pwd, args.db_name,
-                100, "./qgen_cache", None)
-        if len(output) == 0:
-            print("zero query: ", test_sql)
-            continue
-        else:
-            print("query len: {}, time: {}".format(len(output),
-                time.time()-start))
-        all_queries.append(cur_sql)
+        try:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + cur_sql)
+            explain = cursor.fetchall()
+            outputs.append(get_plan_cardinality(explain[0][0][0]["Plan"]))
+        except Exception as e:
+            print("EXPLAIN failed: ", e)
+            con.rollback()
+            outputs.append(None)
+    cursor.close()
+    con.close()
+    return outputs
+
+def verify_queries(query_strs, card_band=None):
+    '''
+    EXPLAINs the queries in batches of VERIFY_BATCH_SIZE, in parallel, and
+    drops the ones that fail.
+    @card_band: None, or (min, max); drops the queries whose estimated
+    cardinality is outside it.
+    '''
+    start = time.time()
+    batches = [query_strs[i:i+VERIFY_BATCH_SIZE] for i in
+            range(0, len(query_strs), VERIFY_BATCH_SIZE)]
+    par_args = [(batch, args.user, args.db_host, args.port, args.pwd,
+        args.db_name) for batch in batches]
+    num_processes = min(get_num_processes(), max(len(par_args), 1))
+    if num_processes > 1:
+        with Pool(processes = num_processes) as pool:
+            outputs = pool.starmap(explain_queries, par_args)
+    else:
+        outputs = [explain_queries(*a) for a in par_args]
+
+    all_queries = []
+    num_outside = 0
+    for batch, batch_outputs in zip(batches, outputs):
+        for cur_sql, est in zip(batch, batch_outputs):
+            if est is None:
+                print("zero query: ", cur_sql)
+                continue
+            if card_band is not None and \
+                    (est < card_band[0] or est > card_band[1]):
+                num_outside += 1
+                continue
+            all_queries.append(cur_sql)
+
+    print("verified {} queries in {} seconds, outside cardinality band: {}".format(
+        len(query_strs), time.time()-start, num_outside))
     return all_queries
 
-def remove_doubles(query_strs):
-    newq = []
-    seen_samples = set()
-    for q in query_strs:
-        if q in seen_samples:
-            print(q)
-            continue
-        seen_samples.add(q)
-        newq.append(q)
-    return newq
+def get_card_band(query_template):
+    '''
+    @ret: (min, max) estimated cardinality of the queries to keep; from
+    card_band in the [base_sql] section of the template, or from --min_card,
+    --max_card. None to keep all the queries.
+    '''
+    if "card_band" in query_template["base_sql"]:
+        band = query_template["base_sql"]["card_band"]
+        assert len(band) == 2
+        return (float(band[0]), float(band[1]))
+    if args.min_card is None and args.max_card is None:
+        return None
+    min_card = args.min_card if args.min_card is not None else 0
+    max_card = args.max_card if args.max_card is not None else float("inf")
+    return (min_card, max_card)
+
+def get_num_processes():
+    if args.num_processes == -1:
+        return cpu_count()
+    return args.num_processes
 
 def gen_queries(query_template, num_samples, args):
     '''
     @query_template: dict, or str, as used by QueryGenerator2 or
     QueryGenerator.
+    @ret: verified queries. If the template has a cardinality band (see
+    get_card_band), candidates are generated in rounds, --card_oversample
+    times the number of queries still needed, until num_samples of them are
+    estimated to be inside the band, or after MAX_GEN_ROUNDS rounds.
     '''
     qg = QueryGenerator(query_template, args.user, args.db_host, args.port,
-		args.pwd, args.db_name)
+		args.pwd, args.db_name, num_processes=get_num_processes(),
+        seed=args.random_seed)
+    card_band = get_card_band(query_template)
+    if card_band is None:
+        return verify_queries(qg.gen_queries(num_samples))
+
+    gen_sqls = []
+    seen = set()
+    for _ in range(MAX_GEN_ROUNDS):
+        num_needed = num_samples - len(gen_sqls)
+        if num_needed <= 0:
+            break
+        candidates = qg.gen_queries(int(math.ceil(num_needed*args.card_oversample)))
+        candidates = [c for c in candidates if deterministic_hash(c) not in seen]
+        for c in candidates:
+            seen.add(deterministic_hash(c))
+        gen_sqls += verify_queries(candidates, card_band)[0:num_needed]
 
-    gen_sqls = qg.gen_queries(num_samples)
-    gen_sqls = remove_doubles(gen_sqls)
-    # TODO: remove queries that evaluate to zero
+    print("cardinality band: {}, generated {} queries, from {} candidates".format(
+        card_band, len(gen_sqls), len(seen)))
     return gen_sqls
 
 def main():
@@ -74,10 +165,7 @@ def main():
 
         template = toml.load(fn)
         query_strs = gen_queries(template, args.num_samples_per_template, args)
-
-        query_strs = verify_queries(query_strs)
-        query_strs = remove_doubles(query_strs)
-        print("after verifying, and removing doubles: ", len(query_strs))
+        print("after verifying: ", len(query_strs))
 
         for i, sql in enumerate(query_strs):
             qrep = parse_sql(sql)
@@ -109,8 +197,22 @@ def read_flags():
             default=1)
     parser.add_argument("--random_seed", type=int, required=False,
             default=2112)
+    parser.add_argument("--num_processes", type=int, required=False,
+            default=-1, help="""processes used for executing the sampling
+            sqls, and EXPLAINing the generated queries; -1 uses all cpus.""")
+    parser.add_argument("--min_card", type=float, required=False,
+            default=None, help="""only keep queries with a PostgreSQL estimated
+            cardinality of at least this; card_band = [min, max] in the
+            [base_sql] section of a template overrides --min_card and
+            --max_card.""")
+    parser.add_argument("--max_card", type=float, required=False,
+            default=None)
+    parser.add_argument("--card_oversample", type=float, required=False,
+            default=2.0, help="""candidates generated for each query still
+            needed, when a cardinality band is used.""")
 
     return parser.parse_args()
 
-args = read_flags()
-main()
+if __name__ == "__main__":
+    args = read_flags()
+    main()
@@ -0,0 +1,115 @@
+import numpy as np
+
+'''
+Samplers for the predicate values of QueryGenerator templates, built once for
+the output of each sampling sql, so every query only needs a few vectorized
+numpy draws.
+'''
+
+class InSampler():
+    '''
+    samples the values of IN predicates from the rows of a sampling sql.
+    '''
+    def __init__(self, output):
+        self.output = output
+        # num_quantiles : (starts, ends) of the quantile partitions
+        self.partitions = {}
+
+    def get_partitions(self, num_quantiles):
+        if num_quantiles not in self.partitions:
+            chunk_len = int(len(self.output) / num_quantiles)
+            starts = np.arange(num_quantiles)*chunk_len
+            self.partitions[num_quantiles] = (starts, starts + chunk_len)
+        return self.partitions[num_quantiles]
+
+    def sample(self, rng, pred_group):
+        '''
+        @ret: list of sampled rows, or None if the chosen partition is empty.
+        '''
+        num_samples = rng.randint(pred_group["min_samples"],
+                pred_group["max_samples"]+1)
+
+        if pred_group["sampling_method"] == "quantile":
+            starts, ends = self.get_partitions(pred_group["num_quantiles"])
+            curp = rng.randint(0, len(starts))
+            lo, hi = starts[curp], ends[curp]
+            if hi == lo:
+                return None
+            if hi - lo <= num_samples:
+                idxs = rng.randint(lo, hi, size=num_samples)
+            else:
+                idxs = lo + rng.choice(hi - lo, size=num_samples,
+                        replace=False)
+        else:
+            idxs = rng.randint(0, len(self.output), size=num_samples)
+
+        return [self.output[i] for i in idxs]
+
+class IlikeSampler():
+    '''
+    samples the '%prefix%' filters of ILIKE predicates from the token counts
+    (trie) of a sampling sql.
+
+    A prefix of length L (min_chars <= L <= max_chars) of a token has the
+    estimated size: sum of the counts of the tokens starting with it. The
+    prefixes, their sizes, and their sampling weights are precomputed for
+    each (min_chars, max_chars), so choosing a filter in a target size band is
+    a mask and a draw from the CDF of the weights in it. The weights are the
+    same as choosing a token (uniformly, or by its count, with equal
+    probability), and then a prefix length uniformly.
+    '''
+    def __init__(self, trie):
+        self.tokens = list(trie.keys())
+        self.counts = np.array(list(trie.values()), dtype=np.float64)
+        self.lens = np.array([len(t) for t in self.tokens], dtype=np.int64)
+        # (min_chars, max_chars) : (prefixes, sizes, weights)
+        self.prefixes = {}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def get_prefixes(self, min_chars, max_chars):
+        key = (min_chars, max_chars)
+        if key in self.prefixes:
+            return self.prefixes[key]
+
+        all_prefixes = []
+        all_sizes = []
+        all_weights = []
+        if len(self.tokens) > 0:
+            tok_weights = 0.5 / len(self.tokens) + \
+                    0.5 * self.counts / self.counts.sum()
+            num_lens = np.minimum(self.lens, max_chars) - min_chars + 1
+            for L in range(min_chars, max_chars+1):
+                idxs = np.nonzero(self.lens >= L)[0]
+                if len(idxs) == 0:
+                    break
+                prefixes = [self.tokens[i][0:L] for i in idxs]
+                uniq, inv = np.unique(prefixes, return_inverse=True)
+                all_prefixes.append(uniq)
+                all_sizes.append(np.bincount(inv,
+                    weights=self.counts[idxs]))
+                all_weights.append(np.bincount(inv,
+                    weights=tok_weights[idxs] / num_lens[idxs]))
+
+        if len(all_prefixes) == 0:
+            ret = (np.array([], dtype=str), np.zeros(0), np.zeros(0))
+        else:
+            ret = (np.concatenate(all_prefixes), np.concatenate(all_sizes),
+                    np.concatenate(all_weights))
+        self.prefixes[key] = ret
+        return ret
+
+    def sample(self, rng, min_chars, max_chars, min_target, max_target):
+        '''
+        @ret: (prefix, estimated size), with min_target < size < max_target;
+        or (None, None) if there is no such prefix.
+        '''
+        prefixes, sizes, weights = self.get_prefixes(min_chars, max_chars)
+        mask = np.logical_and(sizes > min_target, sizes < max_target)
+        if not mask.any():
+            return None, None
+        cdf = np.cumsum(weights[mask])
+        idx = np.searchsorted(cdf, rng.random_sample()*cdf[-1], side="right")
+        idx = min(idx, len(cdf)-1)
+        return str(prefixes[mask][idx]), sizes[mask][idx]
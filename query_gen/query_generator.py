@@ -1,19 +1,83 @@
 # from db_utils.utils import *
-from utils.utils import *
+from query_representation.utils import *
 import pdb
 from nltk.tokenize import word_tokenize
 import pygtrie
 import klepto
-import random
+import time
+import numpy as np
+from multiprocessing import Pool
+from query_gen.predicate_samplers import InSampler, IlikeSampler
 
 ILIKE_PRED_FMT = "'%{ILIKE_PRED}%'"
+SAMPLING_CACHE_DIR = "./.lc_cache/sql_outputs/"
+# ILIKE sampling sqls with values with more tokens than this are not used
+MAX_ILIKE_TOKENS = 150
+# stop generating if these many consecutive rounds do not produce any query
+MAX_EMPTY_ROUNDS = 100
+
+def build_ilike_trie(output):
+    '''
+    @output: rows of a sampling sql; the first column is the text column.
+    @ret: CharTrie of token : number of occurrences, or None if a value has
+    more than MAX_ILIKE_TOKENS tokens.
+    '''
+    tokens = []
+    for out in output:
+        if out[0] is None:
+            continue
+        cur_tokens = word_tokenize(out[0].lower())
+        if len(cur_tokens) > MAX_ILIKE_TOKENS:
+            return None
+        tokens += cur_tokens
+
+    trie = pygtrie.CharTrie()
+    for token in tokens:
+        if token in trie:
+            trie[token] += 1
+        else:
+            trie[token] = 1
+    return trie
+
+def run_sampling_sql(sql, pred_type, user, db_host, port, pwd, db_name):
+    '''
+    executes the sampling sql of a predicate group; called in the worker
+    processes of QueryGenerator.precompute_sampling_outputs.
+    @ret: output of sql, or, for ILIKE predicates, the trie built from it;
+    None if the sql failed, or its output can not be used.
+    '''
+    output = cached_execute_query(sql, user, db_host, port, pwd, db_name,
+            100, SAMPLING_CACHE_DIR, None)
+    if output is None:
+        return None
+    if pred_type.lower() == "ilike":
+        return build_ilike_trie(output)
+    return output
+
+class PartialQuery():
+    '''
+    state of a query being generated, so it can be resumed once the sampling
+    sql of its current predicate group has been executed.
+    '''
+    def __init__(self, templated_preds):
+        self.templated_preds = templated_preds
+        self.group_idx = 0
+        self.pred_vals = {}
+        # chosen alternative, and sampling sql, of the current group
+        self.pred_group = None
+        self.cur_sql = None
+
 class QueryGenerator():
     '''
     Generates sql queries based on a template.
     TODO: explain rules etc.
     '''
     def __init__(self, query_template, user, db_host, port,
-            pwd, db_name):
+            pwd, db_name, num_processes=1, seed=2112):
+        '''
+        @num_processes: number of sampling sqls executed in parallel.
+        @seed: for the predicate samplers.
+        '''
         self.user = user
         self.pwd = pwd
         self.db_host = db_host
@@ -23,8 +87,14 @@ class QueryGenerator():
         self.base_sql = query_template["base_sql"]["sql"]
         self.templates = query_template["templates"]
         self.sampling_outputs = {}
-        self.ilike_output_size = {}
-        self.bad_sqls = []
+        # hash of sampling sql : InSampler / IlikeSampler for its output
+        self.samplers = {}
+        self.rng = np.random.RandomState(seed)
+        self.bad_sqls = set()
+        self.num_processes = num_processes
+        # if True, _gen_query_str returns a PartialQuery, instead of executing
+        # sampling sqls that have not been executed yet
+        self.defer_sampling = False
         self.trie_archive = klepto.archives.dir_archive("./qgen_tries/",
                 cached=True, serialized=True)
 
@@ -112,28 +182,118 @@ class QueryGenerator():
 
             pred_vals[key] = pred_str
 
-    def _gen_query_str(self, templated_preds):
+    def get_sampling_sqls(self):
+        '''
+        @ret: [(sql, pred_type)] of the sampling sqls, in all the templates,
+        that do not depend on other predicates.
+        '''
+        sqls = []
+        for template in self.templates:
+            for pred_group in template["predicates"]:
+                if "multi" in pred_group:
+                    groups = pred_group["multi"]
+                else:
+                    groups = [pred_group]
+                for group in groups:
+                    if "sql" not in group["type"] or group["dependencies"]:
+                        continue
+                    if group["type"] == "sqls":
+                        cur_sqls = group["sqls"]
+                    else:
+                        cur_sqls = [group["sql"]]
+                    for cur_sql in cur_sqls:
+                        if (cur_sql, group["pred_type"]) not in sqls:
+                            sqls.append((cur_sql, group["pred_type"]))
+        return sqls
+
+    def _set_sampling_output(self, cur_sql, pred_type, output):
+        cur_key = deterministic_hash(cur_sql)
+        if output is None:
+            self.bad_sqls.add(cur_sql)
+            return
+        self.sampling_outputs[cur_key] = output
+        if pred_type.lower() == "ilike":
+            self.samplers[cur_key] = IlikeSampler(output)
+        else:
+            self.samplers[cur_key] = InSampler(output)
+
+    def precompute_sampling_outputs(self, sqls):
+        '''
+        executes the given sampling sqls, using num_processes processes, and
+        stores their outputs (or tries, for ILIKE predicates) for
+        _gen_query_str.
+        @sqls: [(sql, pred_type)]
+        '''
+        start = time.time()
+        todo = []
+        for cur_sql, pred_type in sqls:
+            cur_key = deterministic_hash(cur_sql)
+            if cur_key in self.sampling_outputs or cur_sql in self.bad_sqls:
+                continue
+            if pred_type.lower() == "ilike" and \
+                    cur_key in self.trie_archive.archive:
+                self._set_sampling_output(cur_sql, pred_type,
+                        self.trie_archive.archive[cur_key])
+                continue
+            if (cur_sql, pred_type) not in todo:
+                todo.append((cur_sql, pred_type))
+
+        par_args = [(cur_sql, pred_type, self.user, self.db_host, self.port,
+            self.pwd, self.db_name) for cur_sql, pred_type in todo]
+        if self.num_processes > 1 and len(par_args) > 1:
+            with Pool(processes = min(self.num_processes, len(par_args))) as pool:
+                outputs = pool.starmap(run_sampling_sql, par_args)
+        else:
+            outputs = [run_sampling_sql(*a) for a in par_args]
+
+        for (cur_sql, pred_type), output in zip(todo, outputs):
+            if pred_type.lower() == "ilike" and output is not None:
+                self.trie_archive.archive[deterministic_hash(cur_sql)] = output
+            self._set_sampling_output(cur_sql, pred_type, output)
+
+        if len(todo) > 0:
+            print("executed {} sampling sqls in {} seconds".format(len(todo),
+                time.time()-start))
+
+    def _gen_query_str(self, templated_preds, partial=None):
         '''
         @templated_preds
+        @partial: PartialQuery returned by an earlier call, to resume.
 
         Modifies the base sql to plug in newer values at all the unspecified
         values.
             Handling of NULLs:
+
+        @ret: sql string, or None if the query could not be generated. If
+        defer_sampling is set, and the sampling sql of a predicate group has
+        not been executed yet, returns a PartialQuery instead.
         '''
+        if partial is None:
+            partial = PartialQuery(templated_preds)
         # dictionary that is used to keep track of the column values that have
         # already been selected so far.
-        pred_vals = {}
+        pred_vals = partial.pred_vals
 
         # for each group, select appropriate predicates
-        for pred_group in templated_preds:
-            if "multi" in pred_group:
+        for group_idx in range(partial.group_idx, len(templated_preds)):
+            pred_group = templated_preds[group_idx]
+            if partial.pred_group is not None:
+                # resuming this group
+                pred_group = partial.pred_group
+                partial.pred_group = None
+            elif "multi" in pred_group:
                 # multiple predicate conditions, choose any one
-                pred_group = random.choice(pred_group["multi"])
+                pred_group = pred_group["multi"][self.rng.randint(0,
+                    len(pred_group["multi"]))]
             if "sql" in pred_group["type"]:
                 # cur_sql will be the sql used to sample for this predicate
                 # value
-                if pred_group["type"] == "sqls":
-                    cur_sql = random.choice(pred_group["sqls"])
+                if partial.cur_sql is not None:
+                    cur_sql = partial.cur_sql
+                    partial.cur_sql = None
+                elif pred_group["type"] == "sqls":
+                    cur_sql = pred_group["sqls"][self.rng.randint(0,
+                        len(pred_group["sqls"]))]
                 else:
                     cur_sql = pred_group["sql"]
 
@@ -144,133 +304,61 @@ class QueryGenerator():
 
                 # get possible values to use
                 cur_key = deterministic_hash(cur_sql)
-                if cur_key in self.sampling_outputs:
-                    output = self.sampling_outputs[cur_key]
-                else:
+                if cur_key not in self.sampling_outputs:
                     if cur_sql in self.bad_sqls:
                         return None
-                    output = cached_execute_query(cur_sql, self.user,
-                            self.db_host, self.port, self.pwd, self.db_name,
-                            100, "./.lc_cache/sql_outputs/", None)
-                    if pred_group["pred_type"].lower() == "ilike":
-                        cur_sql_key = deterministic_hash(cur_sql)
-                        if cur_sql_key in self.trie_archive.archive:
-                            print(cur_sql)
-                            print("found in archive")
-                            trie = self.trie_archive.archive[cur_sql_key]
-                        else:
-                            print("going to tokenize: ", cur_sql)
-                            tokens = []
-                            for out in output:
-                                if out[0] is None:
-                                    continue
-                                cur_tokens = word_tokenize(out[0].lower())
-                                if len(cur_tokens) > 150:
-                                    print("too many tokens in column: ",
-                                            pred_group["columns"][0], pred_vals)
-                                    self.bad_sqls.append(cur_sql)
-                                    return None
-                                tokens += cur_tokens
-
-                            print("going to make a trie..")
-                            trie = pygtrie.CharTrie()
-                            for token in tokens:
-                                if token in trie:
-                                    trie[token] += 1
-                                else:
-                                    trie[token] = 1
-                            self.trie_archive.archive[cur_sql_key] = trie
-
-                        self.sampling_outputs[cur_key] = trie
-
-                        output_keys = []
-                        weights = []
-                        for k,v in trie.items():
-                            output_keys.append(k)
-                            weights.append(v)
-
-                        self.ilike_output_size[cur_key] = (output_keys, weights)
-
-                        output = trie
-                    else:
-                        self.sampling_outputs[cur_key] = output
+                    if self.defer_sampling:
+                        partial.group_idx = group_idx
+                        partial.pred_group = pred_group
+                        partial.cur_sql = cur_sql
+                        return partial
+                    self.precompute_sampling_outputs([(cur_sql,
+                        pred_group["pred_type"])])
+                    if cur_key not in self.sampling_outputs:
+                        return None
+                output = self.sampling_outputs[cur_key]
 
                 if len(output) == 0:
                     # no point in doing shit
                     return None
 
+                sampler = self.samplers[cur_key]
                 if pred_group["pred_type"].lower() == "in":
-                    # now use one of the different sampling methods
-                    num_samples = random.randint(pred_group["min_samples"],
-                            pred_group["max_samples"])
-
-                    if pred_group["sampling_method"] == "quantile":
-                        num_quantiles = pred_group["num_quantiles"]
-                        curp = random.randint(0, num_quantiles-1)
-                        chunk_len = int(len(output) / num_quantiles)
-                        tmp_output = output[curp*chunk_len: (curp+1)*chunk_len]
-                        if len(tmp_output) == 0:
-                            # really shouldn't be happenning right?
-                            return None
-
-                        if len(tmp_output) <= num_samples:
-                            samples = [random.choice(tmp_output) for _ in
-                                    range(num_samples)]
-                        else:
-                            samples = random.sample(tmp_output, num_samples)
-
-                        self._update_sql_in(samples,
-                                pred_group, pred_vals)
-
-                    else:
-                        samples = [random.choice(output) for _ in
-                                range(num_samples)]
-                        self._update_sql_in(samples,
-                                pred_group, pred_vals)
+                    samples = sampler.sample(self.rng, pred_group)
+                    if samples is None:
+                        # really shouldn't be happenning right?
+                        return None
+                    self._update_sql_in(samples,
+                            pred_group, pred_vals)
 
                 elif pred_group["pred_type"].lower() == "ilike":
-                    assert isinstance(output, pygtrie.CharTrie)
+                    assert isinstance(sampler, IlikeSampler)
 
                     # Note: the trie will only provide a lower-bound on the
                     # number of matches, since ILIKE predicates would also
                     # consider substrings. But this seems to be enough for our
                     # purposes, as we will avoid queries that zero out
-                    output_keys, weights = self.ilike_output_size[cur_key]
-                    if len(output_keys) <= 1:
+                    weights = sampler.counts
+                    if len(weights) <= 1:
                         return None
 
                     # choose min_target, max_target for regex matches.
                     if "thresholds" in pred_group:
                         threshs = pred_group["thresholds"]
-                        idx = random.randint(0, len(threshs)-1)
+                        idx = self.rng.randint(0, len(threshs))
                         min_target = threshs[idx]
                         if idx+1 == len(threshs):
                             max_target = 100000000000
                         else:
                             max_target = threshs[idx+1]
                     else:
-                        if random.random() > 0.5:
-                            cur_partition = random.randint(0, pred_group["num_quantiles"]-1)
-                            min_percentile = 100.0 / pred_group["num_quantiles"] * cur_partition
-                            max_percentile = 100.0 / pred_group["num_quantiles"] * (cur_partition+1)
-                            min_target = max(pred_group["min_count"],
-                                    np.percentile(weights, min_percentile))
-                            max_target = np.percentile(weights, max_percentile)
-                        else:
-                            num_rows = sum(weights)
-                            partition_size = num_rows / pred_group["num_quantiles"]
-                            cur_partition = random.randint(0, pred_group["num_quantiles"]-1)
-                            min_target = max(pred_group["min_count"],
-                                    cur_partition*partition_size)
-                            max_target = (cur_partition+1)*partition_size
-
-                            cur_partition = random.randint(0, pred_group["num_quantiles"]-1)
-
-                            min_percentile = 100.0 / pred_group["num_quantiles"] * cur_partition
-                            max_percentile = 100.0 / pred_group["num_quantiles"] * (cur_partition+1)
-                            min_target = max(pred_group["min_count"],
-                                    np.percentile(weights, min_percentile))
-                            max_target = np.percentile(weights, max_percentile)
+                        num_quantiles = pred_group["num_quantiles"]
+                        cur_partition = self.rng.randint(0, num_quantiles)
+                        min_percentile = 100.0 / num_quantiles * cur_partition
+                        max_percentile = 100.0 / num_quantiles * (cur_partition+1)
+                        min_target = max(pred_group["min_count"],
+                                np.percentile(weights, min_percentile))
+                        max_target = np.percentile(weights, max_percentile)
 
                     if min_target > max_target:
                         print("min target {} > max target {}".format(min_target,
@@ -280,31 +368,9 @@ class QueryGenerator():
                     print("col: {}, min: {}, max: {}".format(pred_group["columns"],
                         min_target, max_target))
 
-                    ilike_pred = None
-                    for i in range(1000):
-                        i += 1
-                        if i % 1000 == 0:
-                            print(i)
-                        if i % 2 == 0:
-                            # just choose randomly, more likely to find
-                            # relevant one
-                            key = random.choice(output_keys)
-                        else:
-                            key = random.choices(population=output_keys,
-                                    weights=weights, k=1)[0]
-                        if len(key) < pred_group["min_chars"]:
-                            continue
-
-                        max_filter_len = min(len(key), pred_group["max_chars"])
-                        num_chars = random.randint(pred_group["min_chars"],
-                                max_filter_len)
-                        ilike_pred = key[0:num_chars]
-                        est_size = sum(output[ilike_pred:])
-                        if est_size > min_target and est_size < max_target:
-                            break
-                        else:
-                            ilike_pred = None
-
+                    ilike_pred, est_size = sampler.sample(self.rng,
+                            pred_group["min_chars"], pred_group["max_chars"],
+                            min_target, max_target)
                     if ilike_pred is None:
                         # print("did not find an appropriate predicate for ",
                                 # pred_group["columns"])
@@ -328,7 +394,7 @@ class QueryGenerator():
                         col = columns[0]
                         assert len(pred_group["keys"]) == 2
                         options = pred_group["options"]
-                        pred_choice = random.choice(options)
+                        pred_choice = options[self.rng.randint(0, len(options))]
                         assert len(pred_choice) == 2
                         lower_key = pred_group["keys"][0]
                         upper_key = pred_group["keys"][1]
@@ -367,7 +433,7 @@ class QueryGenerator():
 
                     else:
                         options = pred_group["options"]
-                        pred_choice = random.choice(options)
+                        pred_choice = options[self.rng.randint(0, len(options))]
                         if "replace" in pred_group:
                             # assert len(pred_choice) == 1
                             assert len(pred_group["keys"]) == 1
@@ -388,23 +454,55 @@ class QueryGenerator():
 
     def gen_queries(self, num_samples, column_stats=None):
         '''
+        Generates the queries in rounds: every round starts enough candidate
+        queries (or resumes the ones waiting for sampling sqls), and then the
+        sampling sqls the candidates are waiting for are executed together,
+        in parallel. Duplicate queries are dropped as they are generated.
         @ret: [sql queries]
         '''
         print("going to generate ", num_samples)
         start = time.time()
         all_query_strs = []
+        seen = set()
 
+        self.precompute_sampling_outputs(self.get_sampling_sqls())
+        self.defer_sampling = True
+        partials = []
+        num_started = 0
+        empty_rounds = 0
         while len(all_query_strs) < num_samples:
-            for template in self.templates:
-                query_str = self._gen_query_str(template["predicates"])
-                if query_str is not None:
+            candidates = partials
+            partials = []
+            num_new = num_samples - len(all_query_strs) - len(candidates)
+            for _ in range(max(num_new, 0)):
+                template = self.templates[num_started % len(self.templates)]
+                num_started += 1
+                candidates.append(PartialQuery(template["predicates"]))
+
+            num_before = len(all_query_strs)
+            for cand in candidates:
+                query_str = self._gen_query_str(cand.templated_preds, cand)
+                if isinstance(query_str, PartialQuery):
+                    partials.append(query_str)
+                elif query_str is not None:
+                    query_hash = deterministic_hash(query_str)
+                    if query_hash in seen:
+                        continue
+                    seen.add(query_hash)
                     all_query_strs.append(query_str)
-                    print(query_str)
-                    # pdb.set_trace()
-                else:
-                    pass
-                    # print("query str was None")
 
+            if len(partials) > 0:
+                self.precompute_sampling_outputs([(p.cur_sql,
+                    p.pred_group["pred_type"]) for p in partials])
+            if len(all_query_strs) == num_before and len(partials) == 0:
+                empty_rounds += 1
+                if empty_rounds >= MAX_EMPTY_ROUNDS:
+                    print("could not generate more queries")
+                    break
+            else:
+                empty_rounds = 0
+
+        self.defer_sampling = False
         print("{} took {} seconds to generate".format(len(all_query_strs),
             time.time()-start))
         return all_query_strs
@@ -0,0 +1,536 @@
+import psycopg2 as pg
+import re
+import time
+import subprocess as sp
+import math
+import numpy as np
+
+from query_representation.utils import *
+from evaluation.plan_losses import PG_HINT_JOINS, PG_HINT_SCANS
+
+'''
+Pluggable DB backends. Every place that talks to the DB (PPC, the featurizer's
+column statistics, the cardinality scripts) only needs a DB-API style
+connection: con.cursor(), cursor.execute(sql), cursor.fetchall(),
+cursor.close(), con.commit(), con.close(). So a backend is just an object with
+a connect(...) method returning such a connection.
+
+    postgres: psycopg2 connections to a live PostgreSQL instance.
+    local: deterministic, in-process stand-in, that answers the queries we
+    issue from stored cardinalities / column statistics, and EXPLAIN (FORMAT
+    JSON) queries with synthetic plans built from the pg_hint_plan Rows(...)
+    hints. This lets us run / profile the PPC machinery (hint generation,
+    get_pg_join_order, get_leading_hint, caching, pooling) without a DB.
+    It also simulates a buffer cache (io_latency, pg_prewarm, restart), and
+    EXPLAIN ANALYZE, for the runtime collection in evaluation/get_runtimes.py.
+
+Usage:
+    db_backend = get_db_backend("local", qreps=qreps)
+    ppc = get_eval_fn("ppc")
+    ppc.eval(qreps, preds, db_backend=db_backend, ...)
+'''
+
+DB_BACKENDS = ["postgres", "local"]
+
+# used for queries the local backend does not know about
+LOCAL_FALLBACK_MAX_CARD = 1000000
+
+## simple cost model used for the synthetic plans of the local backend
+SEQ_SCAN_COST = 1.0
+INDEX_SCAN_COST = 2.0
+HASH_BUILD_COST = 2.0
+CPU_TUPLE_COST = 0.01
+# simulated EXPLAIN ANALYZE times
+LOCAL_MS_PER_COST = 0.001
+
+HINT_CMNT_RE = re.compile(r"/\*\+(.*?)\*/", re.DOTALL)
+HINT_ROWS_RE = re.compile(r"Rows\(([^#\)]*)#\s*([^\)\s]+)\s*\)")
+HINT_JOIN_RE = re.compile(r"\b(NestLoop|HashJoin|MergeJoin)\(([^\)]*)\)")
+HINT_SCAN_RE = re.compile(
+        r"\b(SeqScan|IndexScan|IndexOnlyScan|BitmapScan|TidScan)\((\w+)\)")
+PREWARM_RE = re.compile(r"pg_prewarm\(\s*'(\w+)'", re.IGNORECASE)
+ALIAS_RE = re.compile(r"\b(\w+)\s+as\s+(\w+)\b", re.IGNORECASE)
+NO_RESULT_STMTS = ["set", "load", "rollback", "begin", "commit", "reset",
+        "create", "drop", "analyze", "vacuum"]
+
+def get_db_backend(name, **kwargs):
+    '''
+    @name: postgres or local.
+    @kwargs: passed to the backend's constructor.
+    '''
+    if name == "postgres":
+        return PostgresBackend(**kwargs)
+    elif name == "local":
+        return LocalBackend(**kwargs)
+    else:
+        assert False, "db backend {} not supported".format(name)
+
+def _sql_key(sql):
+    sql = " ".join(sql.split())
+    sql = sql.strip().rstrip(";").strip()
+    return deterministic_hash(sql)
+
+class PostgresBackend():
+    def __init__(self):
+        pass
+
+    def connect(self, user, pwd, db_host, port, db_name):
+        # some weird effects between different installations
+        try:
+            con = pg.connect(port=port, dbname=db_name,
+                    user=user, password=pwd, host=db_host)
+        except:
+            con = pg.connect(port=port, dbname=db_name,
+                    user=user, password=pwd)
+        return con
+
+    def restart(self, restart_cmd=None):
+        '''
+        @restart_cmd: shell command, e.g., to restart PostgreSQL, and drop the
+        OS page cache, so the next queries start with cold caches.
+        '''
+        if restart_cmd is not None:
+            sp.run(restart_cmd, shell=True, check=True)
+
+    def __str__(self):
+        return "postgres"
+
+class LocalConnection():
+    def __init__(self, backend):
+        self.backend = backend
+
+    def cursor(self, *args, **kwargs):
+        return LocalCursor(self.backend)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+class LocalCursor():
+    def __init__(self, backend):
+        self.backend = backend
+        self.results = None
+        self.rowcount = -1
+
+    def execute(self, sql, *args):
+        self.results = self.backend.execute(sql)
+        self.rowcount = len(self.results)
+
+    def fetchall(self):
+        assert self.results is not None, "no results to fetch"
+        return self.results
+
+    def fetchone(self):
+        assert self.results is not None, "no results to fetch"
+        if len(self.results) == 0:
+            return None
+        return self.results[0]
+
+    def close(self):
+        self.results = None
+
+class LocalBackend():
+    def __init__(self, qreps=None, column_stats=None, latency=0.0,
+            ckey="cardinality", io_latency=0.0):
+        '''
+        @qreps: the cardinalities of every subplan in these are stored, and
+        returned for the COUNT(*) / EXPLAIN queries on those subplans.
+        @column_stats: dict, in the format of Featurizer.column_stats; used to
+        answer the min / max / distinct value queries on those columns.
+        @latency: seconds to sleep for each executed query, to simulate the
+        round trip to the DB server.
+        @io_latency: seconds to sleep for each table an executed query reads,
+        which is not in the simulated buffer cache; tables are cached once
+        read, or pg_prewarm'ed, until restart.
+        '''
+        self.latency = latency
+        self.io_latency = io_latency
+        # tables in the simulated buffer cache
+        self.buffers = set()
+        self.ckey = ckey
+        # key: _sql_key(subplan sql); val: {actual: , expected: }
+        self.cardinalities = {}
+        self.column_stats = {}
+        self.num_queries = 0
+
+        if qreps is not None:
+            self.add_qreps(qreps)
+        if column_stats is not None:
+            self.column_stats.update(column_stats)
+
+    def __str__(self):
+        return "local"
+
+    def restart(self, restart_cmd=None):
+        '''
+        simulates a restart with cold caches.
+        '''
+        self.buffers = set()
+
+    def _read_tables(self, sql):
+        for real_name, _ in ALIAS_RE.findall(sql):
+            if real_name in self.buffers:
+                continue
+            if self.io_latency > 0:
+                time.sleep(self.io_latency)
+            self.buffers.add(real_name)
+
+    def connect(self, user=None, pwd=None, db_host=None, port=None,
+            db_name=None):
+        return LocalConnection(self)
+
+    def add_qreps(self, qreps):
+        for qrep in qreps:
+            join_graph = qrep["join_graph"]
+            for node, info in qrep["subset_graph"].nodes().items():
+                if node == SOURCE_NODE or self.ckey not in info:
+                    continue
+                sql = nx_graph_to_query(join_graph.subgraph(node))
+                self.cardinalities[_sql_key(sql)] = dict(info[self.ckey])
+
+    def execute(self, sql):
+        '''
+        @ret: list of tuples, as returned by cursor.fetchall().
+        '''
+        self.num_queries += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        hints = " ".join(HINT_CMNT_RE.findall(sql))
+        query = HINT_CMNT_RE.sub(" ", sql).strip()
+        lquery = query.lower()
+        words = lquery.split()
+        if len(words) == 0 or words[0] in NO_RESULT_STMTS:
+            return []
+
+        if "pg_prewarm(" in lquery:
+            for table in PREWARM_RE.findall(query):
+                self.buffers.add(table)
+            return [(0,)]
+
+        explain_opts = lquery[0:lquery.find("select")]
+        analyze = words[0] == "explain" and "analyze" in explain_opts
+        if words[0] != "explain" or analyze:
+            self._read_tables(query)
+
+        if words[0] == "explain":
+            if "format json" in explain_opts:
+                return self._explain_json(query, hints, analyze)
+            return self._explain_text(query)
+
+        col_res = self._column_stats_query(query)
+        if col_res is not None:
+            return col_res
+
+        if "count(*)" in lquery:
+            return [(self._get_card(query, "actual"),)]
+
+        return []
+
+    def _get_card(self, sql, card_type):
+        key = _sql_key(sql)
+        if key in self.cardinalities \
+                and card_type in self.cardinalities[key]:
+            return self.cardinalities[key][card_type]
+        # deterministic value for unknown queries
+        return (key % LOCAL_FALLBACK_MAX_CARD) + 1
+
+    def _column_stats_query(self, sql):
+        '''
+        answers the queries issued by Featurizer._update_stats.
+        @ret: None if sql is not one of those.
+        '''
+        lsql = " ".join(sql.lower().split())
+        if "order by" in lsql and "limit 1" in lsql:
+            col = lsql[lsql.find("order by")+9:].split()[0]
+            stats = self._find_stats(col)
+            key = "min_value" if " asc " in lsql else "max_value"
+            if stats is not None:
+                return [(stats[key],)]
+            return [(_sql_key(col) % LOCAL_FALLBACK_MAX_CARD,)]
+
+        if "select count(*) from (select distinct" in lsql:
+            col = lsql.split("select distinct")[1].split()[0]
+            stats = self._find_stats(col)
+            if stats is not None:
+                return [(stats["num_values"],)]
+            return [(self._get_card(sql, "actual"),)]
+
+        if lsql.startswith("select distinct"):
+            col = lsql.split()[2]
+            stats = self._find_stats(col)
+            if stats is not None and stats["unique_values"] is not None:
+                return list(stats["unique_values"])
+            return []
+
+        if lsql.startswith("select count(*) from") and "where" not in lsql:
+            aliases = ALIAS_RE.findall(lsql)
+            if len(aliases) == 1:
+                stats = self._find_stats(aliases[0][1] + ".")
+                if stats is not None:
+                    return [(stats["total_values"],)]
+
+        return None
+
+    def _find_stats(self, col):
+        for cname, stats in self.column_stats.items():
+            if cname.lower() == col or (col.endswith(".") and \
+                    cname.lower().startswith(col)):
+                return stats
+        return None
+
+    def _explain_text(self, sql):
+        query = sql[sql.lower().find("select"):]
+        rows = self._get_card(query, "expected")
+        output = []
+        output.append(("Aggregate  (cost={:.2f}..{:.2f} rows=1 width=8)".format(
+            rows*SEQ_SCAN_COST, rows*SEQ_SCAN_COST + 1.0),))
+        output.append(("  ->  Seq Scan  (cost=0.00..{:.2f} rows={} width=0)"\
+                .format(rows*SEQ_SCAN_COST, int(rows)),))
+        return output
+
+    def _parse_hints(self, hints):
+        cards = {}
+        for aliases, card in HINT_ROWS_RE.findall(hints):
+            cards[frozenset(aliases.split())] = float(card)
+
+        inv_joins = {v:k for k,v in PG_HINT_JOINS.items()}
+        join_ops = {}
+        for op, aliases in HINT_JOIN_RE.findall(hints):
+            join_ops[frozenset(aliases.split())] = inv_joins[op]
+
+        inv_scans = {v:k for k,v in PG_HINT_SCANS.items()}
+        scan_ops = {}
+        for op, alias in HINT_SCAN_RE.findall(hints):
+            scan_ops[alias] = inv_scans[op]
+
+        leading = None
+        lidx = hints.find("Leading(")
+        if lidx != -1:
+            leading = _parse_leading(hints[lidx+len("Leading"):])
+
+        return cards, join_ops, scan_ops, leading
+
+    def _explain_json(self, sql, hints, analyze=False):
+        query = sql[sql.lower().find("select"):]
+        cards, join_ops, scan_ops, leading = self._parse_hints(hints)
+        real_names = {}
+        for real_name, alias in ALIAS_RE.findall(query):
+            real_names[alias] = real_name
+
+        if len(cards) == 0:
+            # no Rows hints: we do not know the subplan cardinalities, so
+            # just use a left deep plan with the stored estimate at the top.
+            aliases = list(real_names.keys())
+            for alias in aliases:
+                cards[frozenset([alias])] = 1.0
+            cards[frozenset(aliases)] = float(self._get_card(query,
+                "expected"))
+            leading = aliases[0]
+            for alias in aliases[1:]:
+                leading = [leading, alias]
+
+        planner = LocalPlanner(cards, join_ops, scan_ops, real_names)
+        if leading is not None:
+            plan = planner.plan_from_tree(leading)
+        else:
+            plan = planner.best_plan()
+
+        agg = {}
+        agg["Node Type"] = "Aggregate"
+        agg["Strategy"] = "Plain"
+        agg["Startup Cost"] = plan["Total Cost"]
+        agg["Total Cost"] = plan["Total Cost"] + CPU_TUPLE_COST*plan["Plan Rows"]
+        agg["Plan Rows"] = 1
+        agg["Plan Width"] = 8
+        agg["Plans"] = [plan]
+        explain = {"Plan" : agg}
+        if analyze:
+            _add_actuals(agg)
+            explain["Planning Time"] = 0.0
+            explain["Execution Time"] = agg["Actual Total Time"]
+        return [([explain],)]
+
+def _add_actuals(plan):
+    '''
+    EXPLAIN ANALYZE fields of the synthetic plans: the plan's rows, and times
+    in ms proportional to its costs.
+    '''
+    plan["Actual Startup Time"] = plan["Startup Cost"]*LOCAL_MS_PER_COST
+    plan["Actual Total Time"] = plan["Total Cost"]*LOCAL_MS_PER_COST
+    plan["Actual Rows"] = plan["Plan Rows"]
+    plan["Actual Loops"] = 1
+    for child in plan.get("Plans", []):
+        _add_actuals(child)
+
+def _parse_leading(hint):
+    '''
+    @hint: string starting with the Leading hint's parenthesis, e.g.,
+    "((a b) c) ...".
+    @ret: nested lists of aliases, each list being a binary join.
+    '''
+    tokens = re.findall(r"\(|\)|[^\s\(\)]+", hint)
+    def _parse(idx):
+        items = []
+        while idx < len(tokens):
+            tok = tokens[idx]
+            if tok == "(":
+                item, idx = _parse(idx+1)
+                items.append(item)
+            elif tok == ")":
+                return _fold(items), idx+1
+            else:
+                items.append(tok)
+                idx += 1
+        return _fold(items), idx
+
+    def _fold(items):
+        if len(items) == 1:
+            return items[0]
+        tree = items[0]
+        for item in items[1:]:
+            tree = [tree, item]
+        return tree
+
+    tree, _ = _parse(1)
+    return tree
+
+class LocalPlanner():
+    '''
+    Builds PostgreSQL style (FORMAT JSON) plans from the hinted cardinalities,
+    using a simple cost model; the join order is chosen with a left deep
+    dynamic program over the hinted subplans, unless a Leading hint is given.
+    '''
+    def __init__(self, cards, join_ops, scan_ops, real_names):
+        '''
+        @cards: frozenset(aliases) : rows
+        @join_ops: frozenset(aliases) : join node type
+        @scan_ops: alias : scan node type
+        '''
+        self.cards = cards
+        self.join_ops = join_ops
+        self.scan_ops = scan_ops
+        self.real_names = real_names
+
+    def _rows(self, aliases, left_rows=1.0, right_rows=1.0):
+        if aliases in self.cards:
+            return max(self.cards[aliases], 1.0)
+        return max(left_rows*right_rows, 1.0)
+
+    def _join_cost(self, op, outer, inner, rows):
+        '''
+        @outer, inner: (aliases, rows) for the two sides.
+        '''
+        if op == "Hash Join":
+            return SEQ_SCAN_COST*outer[1] + HASH_BUILD_COST*inner[1] + \
+                    CPU_TUPLE_COST*rows
+        elif op == "Nested Loop":
+            if len(inner[0]) == 1:
+                # index lookups into the inner table
+                return outer[1]*(1.0 + INDEX_SCAN_COST*math.log2(inner[1]+1)) \
+                        + CPU_TUPLE_COST*rows
+            return outer[1]*inner[1] + CPU_TUPLE_COST*rows
+        elif op == "Merge Join":
+            return outer[1]*math.log2(outer[1]+2) + \
+                    inner[1]*math.log2(inner[1]+2) + CPU_TUPLE_COST*rows
+        else:
+            assert False, "join op {} unknown".format(op)
+
+    def _choose_op(self, aliases, outer, inner, rows):
+        if aliases in self.join_ops:
+            op = self.join_ops[aliases]
+            return op, self._join_cost(op, outer, inner, rows)
+        best = None
+        for op in PG_HINT_JOINS:
+            cost = self._join_cost(op, outer, inner, rows)
+            if best is None or cost < best[1]:
+                best = (op, cost)
+        return best
+
+    def _scan_node(self, alias):
+        rows = self._rows(frozenset([alias]))
+        node = {}
+        node["Node Type"] = self.scan_ops.get(alias, "Seq Scan")
+        if alias in self.real_names:
+            node["Relation Name"] = self.real_names[alias]
+        node["Alias"] = alias
+        node["Startup Cost"] = 0.0
+        if node["Node Type"] == "Seq Scan":
+            node["Total Cost"] = SEQ_SCAN_COST*rows
+        else:
+            node["Total Cost"] = INDEX_SCAN_COST*rows
+        node["Plan Rows"] = int(rows)
+        node["Plan Width"] = 4
+        return node
+
+    def _join_node(self, op, cost, rows, outer, inner):
+        node = {}
+        node["Node Type"] = op
+        node["Join Type"] = "Inner"
+        node["Startup Cost"] = 0.0
+        node["Total Cost"] = outer["Total Cost"] + inner["Total Cost"] + cost
+        node["Plan Rows"] = int(rows)
+        node["Plan Width"] = 8
+        node["Plans"] = [outer, inner]
+        return node
+
+    def plan_from_tree(self, tree):
+        '''
+        @tree: alias, or [left_tree, right_tree]
+        @ret: plan for the given join tree.
+        '''
+        plan, _ = self._plan_from_tree(tree)
+        return plan
+
+    def _plan_from_tree(self, tree):
+        if isinstance(tree, str):
+            return self._scan_node(tree), frozenset([tree])
+
+        outer, outer_aliases = self._plan_from_tree(tree[0])
+        inner, inner_aliases = self._plan_from_tree(tree[1])
+        aliases = outer_aliases | inner_aliases
+        rows = self._rows(aliases, outer["Plan Rows"], inner["Plan Rows"])
+        op, cost = self._choose_op(aliases,
+                (outer_aliases, outer["Plan Rows"]),
+                (inner_aliases, inner["Plan Rows"]), rows)
+        return self._join_node(op, cost, rows, outer, inner), aliases
+
+    def best_plan(self):
+        '''
+        left deep dynamic program over the hinted subplans; since these are
+        the connected subgraphs of the join graph, every subplan can be built
+        by joining a smaller subplan with one of its tables.
+        '''
+        subplans = list(self.cards.keys())
+        subplans.sort(key=lambda x: (len(x), sorted(x)))
+        # subplan : (total cost, tree)
+        best = {}
+        for aliases in subplans:
+            if len(aliases) == 1:
+                alias = list(aliases)[0]
+                best[aliases] = (self._scan_node(alias)["Total Cost"], alias)
+                continue
+
+            rows = self._rows(aliases)
+            for alias in sorted(aliases):
+                single = frozenset([alias])
+                rest = aliases - single
+                if rest not in best or single not in best:
+                    continue
+                rest_side = (rest, self._rows(rest))
+                single_side = (single, self._rows(single))
+                for outer, inner in [(rest_side, single_side),
+                        (single_side, rest_side)]:
+                    _, cost = self._choose_op(aliases, outer, inner, rows)
+                    cost += best[outer[0]][0] + best[inner[0]][0]
+                    if aliases not in best or cost < best[aliases][0]:
+                        best[aliases] = (cost, [best[outer[0]][1],
+                            best[inner[0]][1]])
+
+        final = max(best.keys(), key=lambda x: len(x))
+        return self.plan_from_tree(best[final][1])
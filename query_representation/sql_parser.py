@@ -0,0 +1,460 @@
+import re
+import hashlib
+
+'''
+Single pass parser for the subset of SQL used in the CEB workloads:
+
+    SELECT ... FROM table1 [AS] alias1, table2 [AS] alias2, ...
+    WHERE clause1 AND clause2 AND ... [GROUP BY ... | ORDER BY ... | ...]
+
+where each clause is a join condition (alias1.col1 = alias2.col2), or a
+predicate on a single alias (comparisons, IN, BETWEEN, (I)LIKE, IS NULL, and
+parenthesized ORs / ANDs of these). Columns may be type cast (e.g.,
+mi_idx.info::float), and be on either side of a comparison.
+
+The sql is tokenized once, and the tables, aliases, join conditions, and
+predicates (both as strings, and typed) are extracted in the same traversal.
+The strings are formatted the same way as the sqlparse based functions in
+utils.py (extract_from_clause, extract_join_clause, extract_join_graph)
+format them, so the subplan sqls, and everything keyed by their hashes, do
+not change. Parsed queries are cached by the hash of the sql.
+
+parse_query raises ValueError for sqls outside this subset (e.g., explicit
+JOIN ... ON, or subqueries); the callers in utils.py then fall back to
+sqlparse.
+'''
+
+ALIAS_FORMAT = "{TABLE} AS {ALIAS}"
+PARSE_CACHE_SIZE = 100000
+PARSE_CACHE = {}
+
+TOKEN_RE = re.compile(r"""
+    (?P<ws>\s+)
+    |(?P<str>'(?:[^']|'')*')
+    |(?P<num>-?\d+(?:\.\d+)?(?![\w]))
+    |(?P<ident>[A-Za-z_][\w$]*(?:\.(?:[A-Za-z_][\w$]*|\*))?)
+    |(?P<op><=|>=|<>|!=|=|<|>|!~\*|!~|~\*|~|::)
+    |(?P<punct>[(),;*])
+    |(?P<other>.)
+    """, re.X | re.S)
+
+# keywords that end the WHERE clause
+END_WHERE_KEYWORDS = ["GROUP", "ORDER", "LIMIT", "HAVING", "UNION", "OFFSET"]
+CMP_OPS = ["=", "!=", "<>", "<", ">", "<=", ">=", "~", "~*", "!~", "!~*"]
+LIKE_OPS = ["LIKE", "ILIKE"]
+RANGE_OPS = {"<": 1, "<=": 1, ">": 0, ">=": 0}
+# never operands (or function names) in a clause
+CLAUSE_KEYWORDS = ["AND", "OR", "NOT", "IN", "IS", "NULL", "BETWEEN", "LIKE",
+        "ILIKE"]
+
+class Token():
+    def __init__(self, kind, text, start, end):
+        self.kind = kind
+        self.text = text
+        self.upper = text.upper()
+        self.start = start
+        self.end = end
+
+class Unit():
+    '''
+    top level token of a clause, as grouped by sqlparse: a parenthesis, a
+    comparison, or a single token.
+    '''
+    def __init__(self, kind, tokens, text, left=None, op=None, right=None):
+        self.kind = kind
+        self.tokens = tokens
+        self.text = text
+        # only for comparisons
+        self.left = left
+        self.op = op
+        self.right = right
+
+def _hash(sql):
+    return int(hashlib.sha1(str(sql).encode("utf-8")).hexdigest(), 16)
+
+def tokenize(sql):
+    tokens = []
+    for m in TOKEN_RE.finditer(sql):
+        kind = m.lastgroup
+        if kind == "ws":
+            continue
+        tokens.append(Token(kind, m.group(), m.start(), m.end()))
+    return tokens
+
+def _match_parens(tokens):
+    '''
+    @ret: list, index of the matching ")" for every "(".
+    '''
+    matches = [None]*len(tokens)
+    stack = []
+    for i, tok in enumerate(tokens):
+        if tok.text == "(":
+            stack.append(i)
+        elif tok.text == ")":
+            if len(stack) == 0:
+                raise ValueError("unbalanced parenthesis")
+            matches[stack.pop()] = i
+    if len(stack) != 0:
+        raise ValueError("unbalanced parenthesis")
+    return matches
+
+def _operand_end(tokens, i, parens, end):
+    '''
+    @ret: index after the operand starting at tokens[i]: a parenthesis, or a
+    token with its function call / type casts.
+    '''
+    if tokens[i].text == "(":
+        i = parens[i] + 1
+    else:
+        i += 1
+        if i < end and tokens[i].text == "(" and tokens[i-1].kind == "ident":
+            i = parens[i] + 1
+    while i+1 < end and tokens[i].text == "::" and tokens[i+1].kind == "ident":
+        i += 2
+    return i
+
+def _op_end(tokens, i, end):
+    '''
+    @ret: index after the comparison operator at tokens[i], or None.
+    '''
+    tok = tokens[i]
+    if tok.kind == "op" and tok.text in CMP_OPS:
+        return i+1
+    if tok.upper in LIKE_OPS:
+        return i+1
+    if tok.upper == "NOT" and i+1 < end and tokens[i+1].upper in LIKE_OPS:
+        return i+2
+    return None
+
+def _group_units(sql, tokens, start, end, parens):
+    '''
+    groups tokens[start:end] into top level units.
+    '''
+    spans = []
+    i = start
+    while i < end:
+        tok = tokens[i]
+        if tok.upper == "NOT" and i+1 < end and tokens[i+1].upper == "NULL":
+            spans.append(("keyword", i, i+2))
+            i += 2
+        elif _op_end(tokens, i, end) is not None:
+            j = _op_end(tokens, i, end)
+            spans.append(("op", i, j))
+            i = j
+        elif tok.upper in CLAUSE_KEYWORDS:
+            spans.append(("keyword", i, i+1))
+            i += 1
+        elif tok.kind in ["ident", "num", "str"] or tok.text == "(":
+            j = _operand_end(tokens, i, parens, end)
+            kind = "paren" if tok.text == "(" else tok.kind
+            if kind == "ident" and j > i+1 and tokens[i+1].text == "(":
+                kind = "func"
+            spans.append((kind, i, j))
+            i = j
+        else:
+            spans.append((tok.kind, i, i+1))
+            i += 1
+
+    units = []
+    si = 0
+    while si < len(spans):
+        if si+2 < len(spans) and spans[si+1][0] == "op" \
+                and spans[si][0] not in ["op", "punct"] \
+                and spans[si+2][0] not in ["op", "punct"]:
+            l, o, r = spans[si], spans[si+1], spans[si+2]
+            text = sql[tokens[l[1]].start:tokens[r[2]-1].end]
+            units.append(Unit("comparison", tokens[l[1]:r[2]], text,
+                left=l, op=" ".join([t.upper for t in tokens[o[1]:o[2]]]),
+                right=r))
+            si += 3
+        else:
+            kind, i, j = spans[si]
+            text = sql[tokens[i].start:tokens[j-1].end]
+            units.append(Unit(kind, tokens[i:j], text))
+            units[-1].span = spans[si]
+            si += 1
+    return units
+
+def _column_alias(tokens, span):
+    '''
+    @ret: alias of the column in span (which may be type cast, e.g.,
+    mi_idx.info::float), None if it is not a column reference with an alias,
+    or False if it is not a column reference.
+    '''
+    kind, i, j = span
+    if kind != "ident":
+        return False
+    for k in range(i+1, j, 2):
+        if tokens[k].text != "::":
+            return False
+    text = tokens[i].text
+    if "." not in text:
+        return None
+    return text[0:text.find(".")]
+
+def _span_text(sql, tokens, span):
+    return sql[tokens[span[1]].start:tokens[span[2]-1].end]
+
+def _clause_tables(sql, tokens, units, parens):
+    '''
+    tables referenced by the first comparison, or column, of the clause;
+    same as find_all_tables_till_keyword in utils.py.
+    '''
+    while len(units) > 0:
+        unit = units[0]
+        if unit.kind == "comparison":
+            tables = []
+            for span in [unit.left, unit.right]:
+                alias = _column_alias(tokens, span)
+                if alias is not False:
+                    tables.append(alias)
+            return tables
+        if unit.kind == "ident":
+            return [_column_alias(tokens, unit.span)]
+        if unit.kind != "paren":
+            return []
+        # first unit inside the parenthesis
+        start = tokens.index(unit.tokens[0]) + 1
+        end = parens[start-1]
+        units = _group_units(sql, tokens, start, end, parens)
+    return []
+
+def _literal(tok_text):
+    if tok_text.startswith("'"):
+        return tok_text[1:-1].replace("''", "'")
+    try:
+        return int(tok_text)
+    except:
+        pass
+    try:
+        return float(tok_text)
+    except:
+        return tok_text
+
+def _typed_predicates(sql, tokens, units, parens, ranges, typed):
+    '''
+    appends (column, pred type, vals) to typed, in the same format as
+    extract_predicates in utils.py: "in" with a list of values, "lt" with
+    [lower, upper] bounds, "eq", and like types.
+    @ranges: column : [lower, upper]; range predicates on the same column
+    are combined into a single "lt" predicate.
+    '''
+    units = [u for u in units if u.text != ";"]
+    if len(units) == 1 and units[0].kind == "paren":
+        start = tokens.index(units[0].tokens[0]) + 1
+        end = parens[start-1]
+        units = _group_units(sql, tokens, start, end, parens)
+
+    ors = [[]]
+    for unit in units:
+        if unit.text.upper() == "OR":
+            ors.append([])
+        else:
+            ors[-1].append(unit)
+    if len(ors) > 1:
+        for cur_units in ors:
+            _typed_predicates(sql, tokens, cur_units, parens, ranges, typed)
+        return
+
+    texts = [u.text.upper() for u in units]
+    # e.g., (mii1.info ~ '...' AND 0.0 <= mii1.info::float)
+    if "AND" in texts and "BETWEEN" not in texts:
+        ands = [[]]
+        for unit in units:
+            if unit.text.upper() == "AND":
+                ands.append([])
+            else:
+                ands[-1].append(unit)
+        for cur_units in ands:
+            _typed_predicates(sql, tokens, cur_units, parens, ranges, typed)
+        return
+
+    if len(units) == 1 and units[0].kind == "comparison":
+        unit = units[0]
+        col_span, val_span = unit.left, unit.right
+        # the column on the right, e.g., 3.0 <= mi_idx.info::float
+        flipped = _column_alias(tokens, col_span) in [None, False]
+        if flipped:
+            col_span, val_span = unit.right, unit.left
+            if _column_alias(tokens, col_span) in [None, False] or \
+                    val_span[0] not in ["num", "str"]:
+                return
+        col = tokens[col_span[1]].text
+        val = _literal(sql[tokens[val_span[1]].start:tokens[val_span[2]-1].end])
+        if unit.op in RANGE_OPS:
+            if col not in ranges:
+                ranges[col] = [None, None]
+                typed.append((col, "lt", ranges[col]))
+            bound = RANGE_OPS[unit.op]
+            if flipped:
+                bound = 1 - bound
+            ranges[col][bound] = val
+        elif unit.op == "=":
+            typed.append((col, "eq", val))
+        elif "LIKE" in unit.op:
+            pred_type = unit.op.lower().replace("not ", "n")
+            typed.append((col, pred_type, [val]))
+    elif len(units) == 3 and texts[1] == "IN" and units[2].kind == "paren":
+        vals = [_literal(t.text) for t in units[2].tokens[1:-1]
+                if t.text != ","]
+        typed.append((units[0].text, "in", vals))
+    elif len(units) == 3 and texts[1:] == ["IS", "NULL"]:
+        typed.append((units[0].text, "in", ["NULL"]))
+    elif len(units) == 5 and texts[1] == "BETWEEN":
+        typed.append((units[0].text, "lt", [_literal(units[2].text),
+            _literal(units[4].text)]))
+
+def _parse(sql):
+    tokens = tokenize(sql)
+    parens = _match_parens(tokens)
+
+    depth = 0
+    from_idx = None
+    where_idx = None
+    where_end = len(tokens)
+    for i, tok in enumerate(tokens):
+        if tok.text == "(":
+            depth += 1
+        elif tok.text == ")":
+            depth -= 1
+        elif tok.upper == "SELECT" and i != 0:
+            raise ValueError("subqueries are not supported")
+        elif depth == 0 and tok.upper in ["JOIN", "ON", "USING"]:
+            raise ValueError("explicit joins are not supported")
+        elif depth == 0 and tok.upper == "FROM" and from_idx is None:
+            from_idx = i
+        elif depth == 0 and tok.upper == "WHERE" and where_idx is None:
+            where_idx = i
+        elif depth == 0 and tok.upper in END_WHERE_KEYWORDS and \
+                where_idx is not None and where_end == len(tokens):
+            where_end = i
+    if from_idx is None:
+        raise ValueError("no FROM clause")
+
+    # FROM clause
+    froms = []
+    aliases = {}
+    tables = []
+    from_end = where_idx
+    if from_end is None:
+        from_end = len(tokens)
+        for i in range(from_idx+1, len(tokens)):
+            if tokens[i].upper in END_WHERE_KEYWORDS or tokens[i].text == ";":
+                from_end = i
+                break
+    items = [[]]
+    for tok in tokens[from_idx+1:from_end]:
+        if tok.text == ",":
+            items.append([])
+        else:
+            items[-1].append(tok)
+    for item in items:
+        if len(item) == 3 and item[1].upper == "AS":
+            item = [item[0], item[2]]
+        if not all([t.kind == "ident" for t in item]) or len(item) not in [1,2]:
+            raise ValueError("unsupported FROM clause")
+        table_name = item[0].text
+        tables.append(table_name)
+        if len(item) == 2:
+            froms.append(ALIAS_FORMAT.format(TABLE = table_name,
+                ALIAS = item[1].text))
+            aliases[item[1].text] = table_name
+        else:
+            froms.append(table_name)
+
+    # WHERE clauses, split by the top level ANDs
+    clauses = []
+    if where_idx is not None:
+        cur = []
+        in_between = False
+        depth = 0
+        for i in range(where_idx+1, where_end):
+            tok = tokens[i]
+            if tok.text == "(":
+                depth += 1
+            elif tok.text == ")":
+                depth -= 1
+            if depth == 0 and tok.upper == "BETWEEN":
+                in_between = True
+            elif depth == 0 and tok.upper == "AND":
+                if in_between:
+                    in_between = False
+                else:
+                    clauses.append(cur)
+                    cur = []
+                    continue
+            cur.append(i)
+        clauses.append(cur)
+
+    cur_tables = [k for k in aliases] if len(aliases) > 0 else tables
+    joins = []
+    # (tables referenced by the clause, formatted clause)
+    matches = []
+    ranges = {}
+    typed = {}
+    for clause in clauses:
+        if len(clause) == 0:
+            continue
+        units = _group_units(sql, tokens, clause[0], clause[-1]+1, parens)
+        clause_tables = _clause_tables(sql, tokens, units, parens)
+        if len(clause_tables) == 0:
+            continue
+        match = " " + " ".join([u.text for u in units])
+        matches.append((clause_tables, match))
+
+        if not all([t in cur_tables for t in clause_tables]):
+            continue
+        unit = units[0]
+        if unit.kind == "comparison" and unit.op in ["=", "!="] and \
+                _column_alias(tokens, unit.right) and \
+                _column_alias(tokens, unit.left):
+            left = _span_text(sql, tokens, unit.left)
+            right = _span_text(sql, tokens, unit.right)
+            joins.append(left + " " + unit.op + " " + right)
+        elif len(set(clause_tables)) == 1:
+            alias = clause_tables[0]
+            if alias not in typed:
+                typed[alias] = []
+                ranges[alias] = {}
+            _typed_predicates(sql, tokens, units, parens, ranges[alias],
+                    typed[alias])
+
+    ret = {}
+    ret["froms"] = froms
+    ret["aliases"] = aliases
+    ret["tables"] = tables
+    ret["joins"] = joins
+    ret["matches"] = matches
+    ret["typed_predicates"] = typed
+    return ret
+
+def parse_query(sql):
+    '''
+    @ret: dict with the keys:
+        froms, aliases, tables: same as extract_from_clause.
+        joins: same as extract_join_clause.
+        matches: [(tables referenced, clause string)] for each WHERE clause;
+        the clause strings are the same as the ones returned by
+        find_all_clauses.
+        typed_predicates: alias : [(column, pred type, vals)]
+    The returned dict is cached, and should not be modified.
+    '''
+    key = _hash(sql)
+    if key in PARSE_CACHE:
+        return PARSE_CACHE[key]
+    ret = _parse(sql)
+    if len(PARSE_CACHE) >= PARSE_CACHE_SIZE:
+        PARSE_CACHE.clear()
+    PARSE_CACHE[key] = ret
+    return ret
+
+def get_predicates_for(parsed, tables):
+    '''
+    @ret: clause strings in the WHERE clause that only reference the given
+    tables; same as find_all_clauses(tables, where clause).
+    '''
+    preds = []
+    for clause_tables, match in parsed["matches"]:
+        if all([t in tables for t in clause_tables]):
+            preds.append(match)
+    return preds
@@ -13,7 +13,9 @@ import shelve
 import pdb
 import os
 import errno
+import pickle
 import klepto
+from query_representation.sql_parser import parse_query, get_predicates_for
 import getpass
 
 # used for shortest-path or flow based framing of QO
@@ -262,8 +264,14 @@ def nx_graph_to_query(G, from_clause=None):
 
 def extract_join_clause(query):
     '''
-    FIXME: this can be optimized further / or made to handle more cases
+    Uses the single pass parser in sql_parser.py, and falls back to sqlparse
+    for sqls it does not support.
     '''
+    try:
+        return list(parse_query(query)["joins"])
+    except ValueError:
+        pass
+
     parsed = sqlparse.parse(query)[0]
     # let us go over all the where clauses
     start = time.time()
@@ -475,6 +483,13 @@ def extract_from_clause(query):
           aliases:{alias1: table1, alias2: table2} (OR [] if no aliases present)
           tables: [table1, table2, ...]
     '''
+    try:
+        parsed = parse_query(query)
+        return list(parsed["froms"]), dict(parsed["aliases"]), \
+                list(parsed["tables"])
+    except ValueError:
+        pass
+
     def handle_table(identifier):
         table_name = identifier.get_real_name()
         alias = identifier.get_alias()
@@ -612,14 +627,19 @@ def find_all_tables_till_keyword(token):
 
     return tables
 
-def execute_query(sql, user, db_host, port, pwd, db_name, pre_execs):
+def execute_query(sql, user, db_host, port, pwd, db_name, pre_execs,
+        db_backend=None):
     '''
     @db_host: going to ignore it so default localhost is used.
     @pre_execs: options like set join_collapse_limit to 1 that are executed
     before the query.
+    @db_backend: None connects to PostgreSQL; else, see db_backends.py
     '''
-    con = pg.connect(user=user, host=db_host, port=port,
-            password=pwd, database=db_name)
+    if db_backend is not None:
+        con = db_backend.connect(user, pwd, db_host, port, db_name)
+    else:
+        con = pg.connect(user=user, host=db_host, port=port,
+                password=pwd, database=db_name)
     cursor = con.cursor()
 
     for setup_sql in pre_execs:
@@ -656,6 +676,19 @@ def make_dir(directory):
         if e.errno != errno.EEXIST:
             raise
 
+def save_object(file_name, data):
+    with open(file_name, "wb") as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_object(file_name):
+    '''
+    @ret: None if file_name does not exist.
+    '''
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, "rb") as f:
+        return pickle.load(f)
+
 def get_pg_join_order(join_graph, explain):
     '''
     '''
@@ -714,7 +747,15 @@ def get_pg_join_order(join_graph, explain):
 def extract_join_graph(sql):
     '''
     @sql: string
+    @ret: nx.Graph with the aliases as nodes (with their real_name, and
+    predicates; and, when sql_parser.py supports the sql, also pred_cols,
+    pred_types, pred_vals), and the join_condition on the edges.
     '''
+    try:
+        parsed = parse_query(sql)
+    except ValueError:
+        parsed = None
+
     froms,aliases,tables = extract_from_clause(sql)
     joins = extract_join_clause(sql)
     join_graph = nx.Graph()
@@ -743,6 +784,17 @@ def extract_join_graph(sql):
             join_graph.nodes()[t1]["real_name"] = table1
             join_graph.nodes()[t2]["real_name"] = table2
 
+    if parsed is not None:
+        for t1 in join_graph.nodes():
+            info = join_graph.nodes()[t1]
+            info["predicates"] = get_predicates_for(parsed, [t1])
+            typed = parsed["typed_predicates"].get(t1, [])
+            info["pred_cols"] = [p[0] for p in typed]
+            info["pred_types"] = [p[1] for p in typed]
+            info["pred_vals"] = [list(p[2]) if isinstance(p[2], list) \
+                    else p[2] for p in typed]
+        return join_graph
+
     parsed = sqlparse.parse(sql)[0]
     # let us go over all the where clauses
     where_clauses = None
@@ -787,7 +839,7 @@ def extract_values(obj, key):
 
 def cached_execute_query(sql, user, db_host, port, pwd, db_name,
         execution_cache_threshold, sql_cache_dir=None,
-        timeout=120000):
+        timeout=120000, db_backend=None):
     '''
     @timeout:
     @db_host: going to ignore it so default localhost is used.
@@ -804,15 +856,18 @@ def cached_execute_query(sql, user, db_host, port, pwd, db_name,
 
     # archive only considers the stuff stored in disk
     if sql_cache is not None and hashed_sql in sql_cache.archive:
-        return sql_cache.archive[hashed_sql], False
+        return sql_cache.archive[hashed_sql]
 
     start = time.time()
 
     os_user = getpass.getuser()
     # con = pg.connect(user=user, port=port,
             # password=pwd, database=db_name)
-    con = pg.connect(user=user, host=db_host, port=port,
-            password=pwd, database=db_name)
+    if db_backend is not None:
+        con = db_backend.connect(user, pwd, db_host, port, db_name)
+    else:
+        con = pg.connect(user=user, host=db_host, port=port,
+                password=pwd, database=db_name)
     cursor = con.cursor()
     if timeout is not None:
         cursor.execute("SET statement_timeout = {}".format(timeout))
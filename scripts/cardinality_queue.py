@@ -0,0 +1,377 @@
+import sys
+sys.path.append(".")
+import argparse
+import glob
+import os
+import socket
+import sqlite3
+import time
+import multiprocessing as mp
+import psycopg2 as pg
+
+from query_representation.utils import *
+from query_representation.query import *
+from query_representation.db_backends import get_db_backend
+
+from get_query_cardinalities import TIMEOUT_COUNT_CONSTANT, \
+        CROSS_JOIN_CONSTANT, EXCEPTION_COUNT_CONSTANT, is_cross_join
+
+'''
+Persistent, SQLite backed, job queue for collecting the true cardinalities
+(card_type actual in get_query_cardinalities.py). There is one row per (query
+file, subplan), with its status, number of attempts, execution time, and
+current timeout.
+
+    # scans the qrep files once, and adds a job for every missing subplan
+    python3 scripts/cardinality_queue.py --mode init --queue_fn cards.db --query_dir queries/joblight/all_joblight/
+    # can be stopped / restarted at any time, or started on more machines
+    python3 scripts/cardinality_queue.py --mode work --queue_fn cards.db --num_workers 8 --user ceb --pwd password
+    python3 scripts/cardinality_queue.py --mode status --queue_fn cards.db
+    # writes the finished cardinalities back to the qrep files
+    python3 scripts/cardinality_queue.py --mode export --queue_fn cards.db
+
+Workers claim batches of the cheapest pending jobs (smallest timeout, then
+fewest tables, then smallest PostgreSQL estimates), and write the results back
+in batches. Jobs that time out are retried with a larger timeout
+(--timeout_growth), up to --max_timeout; so all the cheap subplans finish
+before we spend time on the expensive ones. Jobs left running by a worker that
+crashed are reset to pending once they have been running for longer than their
+timeout.
+'''
+
+QUEUE_SCHEMA = """CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    qfn TEXT NOT NULL,
+    subplan TEXT NOT NULL,
+    sql TEXT NOT NULL,
+    num_tables INTEGER,
+    priority REAL,
+    status TEXT NOT NULL,
+    attempts INTEGER DEFAULT 0,
+    timeout_ms INTEGER,
+    exec_time REAL,
+    card INTEGER,
+    worker TEXT,
+    updated REAL,
+    UNIQUE(qfn, subplan))"""
+QUEUE_INDEX = """CREATE INDEX IF NOT EXISTS jobs_pending ON jobs
+    (status, timeout_ms, num_tables, priority)"""
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+TIMEOUT = "timeout"
+FAILED = "failed"
+EXPORTED = "exported"
+
+# seconds, added to a job's timeout before it is considered stale; should be
+# larger than the interval at which workers flush results (FLUSH_SECS)
+STALE_GRACE = 120
+FLUSH_SECS = 30
+
+def connect_queue(queue_fn):
+    con = sqlite3.connect(queue_fn, timeout=120)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute(QUEUE_SCHEMA)
+    con.execute(QUEUE_INDEX)
+    con.commit()
+    return con
+
+def init_queue(queue_fn, qfns, key_name, init_timeout, rerun_timeouts=True):
+    '''
+    adds a job for each subplan of the qreps in qfns that does not have the
+    key_name cardinality yet.
+    @ret: number of jobs added.
+    '''
+    con = connect_queue(queue_fn)
+    num_added = 0
+    for qfn in qfns:
+        qrep = load_qrep(qfn)
+        rows = []
+        for subset, info in qrep["subset_graph"].nodes().items():
+            if subset == SOURCE_NODE or \
+                    not all([a in qrep["join_graph"] for a in subset]):
+                continue
+            cards = info.get("cardinality", {})
+            if key_name in cards:
+                card = cards[key_name]
+                if card < TIMEOUT_COUNT_CONSTANT or not rerun_timeouts \
+                        or card == EXCEPTION_COUNT_CONSTANT:
+                    continue
+
+            sg = qrep["join_graph"].subgraph(subset)
+            subsql = nx_graph_to_query(sg)
+            est = cards.get("expected", 0)
+            if is_cross_join(sg):
+                status = DONE
+                card = CROSS_JOIN_CONSTANT
+            else:
+                status = PENDING
+                card = None
+            rows.append((qfn, " ".join(subset), subsql, len(subset),
+                float(est), status, init_timeout, card, time.time()))
+
+        cur = con.executemany("""INSERT OR IGNORE INTO jobs (qfn, subplan, sql,
+                num_tables, priority, status, timeout_ms, card, updated) VALUES
+                (?,?,?,?,?,?,?,?,?)""", rows)
+        num_added += cur.rowcount
+        con.commit()
+
+    con.close()
+    return num_added
+
+def reset_stale_jobs(con):
+    '''
+    jobs that have been running for longer than their timeout (since the last
+    flush of their worker) belong to workers that died.
+    '''
+    cur = con.execute("""UPDATE jobs SET status = ?, worker = NULL WHERE
+            status = ? AND updated + timeout_ms / 1000.0 + ? < ?""",
+            (PENDING, RUNNING, STALE_GRACE, time.time()))
+    con.commit()
+    return cur.rowcount
+
+def claim_jobs(con, worker, batch_size):
+    '''
+    @ret: [(id, sql, attempts, timeout_ms)] of the cheapest pending jobs, which
+    are marked as running.
+    '''
+    con.execute("BEGIN IMMEDIATE")
+    jobs = con.execute("""SELECT id, sql, attempts, timeout_ms FROM jobs WHERE
+            status = ? ORDER BY timeout_ms, num_tables, priority LIMIT ?""",
+            (PENDING, batch_size)).fetchall()
+    con.executemany("""UPDATE jobs SET status = ?, worker = ?, updated = ?
+            WHERE id = ?""", [(RUNNING, worker, time.time(), job[0])
+                for job in jobs])
+    con.commit()
+    return jobs
+
+def complete_jobs(con, worker, results):
+    '''
+    @results: [(status, card, exec_time, attempts, timeout_ms, id)]
+    Also refreshes the timestamp of the jobs still claimed by the worker, so
+    they are not considered stale.
+    '''
+    now = time.time()
+    con.executemany("""UPDATE jobs SET status = ?, card = ?, exec_time = ?,
+            attempts = ?, timeout_ms = ?, worker = NULL, updated = ? WHERE id = ?""",
+            [r[0:5] + (now, r[5]) for r in results])
+    con.execute("UPDATE jobs SET updated = ? WHERE status = ? AND worker = ?",
+            (now, RUNNING, worker))
+    con.commit()
+
+def _is_timeout(e):
+    return isinstance(e, pg.extensions.QueryCanceledError) or \
+            "timeout" in str(e)
+
+def run_job(cursor, con, sql, attempts, timeout_ms, timeout_growth,
+        max_timeout, max_attempts):
+    '''
+    @ret: (status, card, exec_time, attempts, timeout_ms) to write back.
+    '''
+    attempts += 1
+    start = time.time()
+    try:
+        cursor.execute("SET statement_timeout = {}".format(timeout_ms))
+        cursor.execute(sql)
+        card = cursor.fetchall()[0][0]
+        return (DONE, card, time.time()-start, attempts, timeout_ms)
+    except Exception as e:
+        exec_time = time.time()-start
+        try:
+            con.rollback()
+        except Exception:
+            pass
+        if _is_timeout(e):
+            if timeout_ms >= max_timeout:
+                return (TIMEOUT, TIMEOUT_COUNT_CONSTANT, exec_time, attempts,
+                        timeout_ms)
+            # retry later, once the cheaper jobs are done
+            new_timeout = int(min(timeout_ms*timeout_growth, max_timeout))
+            return (PENDING, None, exec_time, attempts, new_timeout)
+
+        print(e)
+        if attempts >= max_attempts:
+            return (FAILED, EXCEPTION_COUNT_CONSTANT, exec_time, attempts,
+                    timeout_ms)
+        return (PENDING, None, exec_time, attempts, timeout_ms)
+
+def run_worker(queue_fn, worker, db_backend, db_args, batch_size,
+        timeout_growth, max_timeout, max_attempts, flush_secs=FLUSH_SECS):
+    '''
+    pulls jobs until the queue is empty.
+    @db_args: (user, pwd, db_host, port, db_name)
+    @ret: number of jobs processed.
+    '''
+    qcon = connect_queue(queue_fn)
+    if db_backend is not None:
+        con = db_backend.connect(*db_args)
+    else:
+        user, pwd, db_host, port, db_name = db_args
+        con = pg.connect(user=user, host=db_host, port=port,
+                password=pwd, database=db_name)
+    con.autocommit = True
+    cursor = con.cursor()
+
+    num_jobs = 0
+    while True:
+        jobs = claim_jobs(qcon, worker, batch_size)
+        if len(jobs) == 0:
+            break
+        results = []
+        last_flush = time.time()
+        for jid, sql, attempts, timeout_ms in jobs:
+            res = run_job(cursor, con, sql, attempts, timeout_ms,
+                    timeout_growth, max_timeout, max_attempts)
+            results.append(res + (jid,))
+            num_jobs += 1
+            if time.time() - last_flush > flush_secs:
+                complete_jobs(qcon, worker, results)
+                results = []
+                last_flush = time.time()
+        complete_jobs(qcon, worker, results)
+
+    cursor.close()
+    con.close()
+    qcon.close()
+    return num_jobs
+
+def export_queue(queue_fn, key_name):
+    '''
+    writes the finished cardinalities back to the qrep files.
+    @ret: number of qrep files updated.
+    '''
+    con = connect_queue(queue_fn)
+    rows = con.execute("""SELECT id, qfn, subplan, card, exec_time FROM jobs
+            WHERE status IN (?,?,?) ORDER BY qfn""", (DONE, TIMEOUT,
+                FAILED)).fetchall()
+    qfn_rows = {}
+    for row in rows:
+        if row[1] not in qfn_rows:
+            qfn_rows[row[1]] = []
+        qfn_rows[row[1]].append(row)
+
+    for qfn, rows in qfn_rows.items():
+        qrep = load_qrep(qfn)
+        for _, _, subplan, card, exec_time in rows:
+            info = qrep["subset_graph"].nodes()[tuple(subplan.split(" "))]
+            if "cardinality" not in info:
+                info["cardinality"] = {}
+            if "exec_time" not in info:
+                info["exec_time"] = {}
+            info["cardinality"][key_name] = card
+            info["exec_time"][key_name] = exec_time
+        save_qrep(qfn, qrep)
+        con.executemany("UPDATE jobs SET status = ? WHERE id = ?",
+                [(EXPORTED, row[0]) for row in rows])
+        con.commit()
+
+    con.close()
+    return len(qfn_rows)
+
+def queue_status(queue_fn):
+    '''
+    @ret: dict status : (num jobs, total exec time)
+    '''
+    con = connect_queue(queue_fn)
+    rows = con.execute("""SELECT status, COUNT(*), SUM(exec_time) FROM jobs
+            GROUP BY status""").fetchall()
+    con.close()
+    return {r[0] : (r[1], r[2]) for r in rows}
+
+def _worker_main(worker_idx):
+    worker = "{}-{}-{}".format(socket.gethostname(), os.getpid(), worker_idx)
+    if args.db_backend == "postgres":
+        db_backend = None
+    else:
+        db_backend = get_db_backend(args.db_backend)
+    return run_worker(args.queue_fn, worker, db_backend,
+            (args.user, args.pwd, args.db_host, args.port, args.db_name),
+            args.batch_size, args.timeout_growth, args.max_timeout,
+            args.max_attempts)
+
+def main():
+    if args.mode == "init":
+        fns = list(glob.glob(args.query_dir + "/*.pkl"))
+        fns.sort()
+        if args.num_queries != -1:
+            fns = fns[0:args.num_queries]
+        num_added = init_queue(args.queue_fn, fns, args.key_name,
+                args.init_timeout, args.rerun_timeouts)
+        print("added {} jobs from {} queries".format(num_added, len(fns)))
+
+    elif args.mode == "work":
+        con = connect_queue(args.queue_fn)
+        num_reset = reset_stale_jobs(con)
+        con.close()
+        if num_reset > 0:
+            print("reset {} stale jobs".format(num_reset))
+
+        start = time.time()
+        if args.num_workers == 1:
+            num_jobs = _worker_main(0)
+        else:
+            with mp.Pool(args.num_workers) as pool:
+                num_jobs = sum(pool.map(_worker_main, range(args.num_workers)))
+        print("processed {} jobs in {} seconds".format(num_jobs,
+            time.time()-start))
+
+    elif args.mode == "export":
+        num_qfns = export_queue(args.queue_fn, args.key_name)
+        print("updated {} qreps".format(num_qfns))
+
+    if args.mode in ["status", "work", "export"]:
+        for status, (num, exec_time) in sorted(queue_status(
+                args.queue_fn).items()):
+            print("{}: {} jobs, total exec time: {}".format(status, num,
+                exec_time))
+
+def read_flags():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--mode", type=str, required=False,
+            default="status", help="""init, work, export, OR status.""")
+    parser.add_argument("--queue_fn", type=str, required=False,
+            default="./cardinality_queue.db")
+    parser.add_argument("--db_name", type=str, required=False,
+            default="imdb")
+    parser.add_argument("--db_host", type=str, required=False,
+            default="localhost")
+    parser.add_argument("--user", type=str, required=False,
+            default="")
+    parser.add_argument("--pwd", type=str, required=False,
+            default="")
+    parser.add_argument("--port", type=int, required=False,
+            default=5432)
+    parser.add_argument("--db_backend", type=str, required=False,
+            default="postgres")
+    parser.add_argument("--query_dir", type=str, required=False,
+            default=None)
+    parser.add_argument("-n", "--num_queries", type=int,
+            required=False, default=-1)
+    parser.add_argument("--key_name", type=str, required=False,
+            default="actual")
+    parser.add_argument("--rerun_timeouts", type=int,
+            required=False, default=1)
+
+    parser.add_argument("--num_workers", type=int,
+            required=False, default=8)
+    parser.add_argument("--batch_size", type=int,
+            required=False, default=32, help="""number of jobs claimed, and
+            written back, together by a worker.""")
+    parser.add_argument("--init_timeout", type=int,
+            required=False, default=60000, help="""initial statement_timeout
+            (ms) of each job.""")
+    parser.add_argument("--timeout_growth", type=float,
+            required=False, default=4.0)
+    parser.add_argument("--max_timeout", type=int,
+            required=False, default=1800000*5)
+    parser.add_argument("--max_attempts", type=int,
+            required=False, default=3, help="""for failures other than
+            timeouts.""")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = read_flags()
+    main()
@@ -17,8 +17,12 @@ import pickle
 from networkx.readwrite import json_graph
 import re
 from query_representation.query import parse_sql
+from query_representation.db_backends import get_db_backend
 
 from wanderjoin import WanderJoin
+from wanderjoin_batched import BatchedWanderJoin
+from join_index import JoinIndexStore
+from shared_subplans import SharedSubplanCounter
 import math
 
 import scipy.stats as st
@@ -70,6 +74,17 @@ def read_flags():
             default=5432)
     parser.add_argument("--wj_walk_timeout", type=float, required=False,
             default=0.5)
+    parser.add_argument("--wj_engine", type=str, required=False,
+            default="sql", help="""sql or batched; batched runs the walks in
+            numpy over in-memory join indexes.""")
+    parser.add_argument("--join_index_dir", type=str, required=False,
+            default=None, help="""persistent join index, built with
+            scripts/join_index.py, for --wj_engine batched.""")
+    parser.add_argument("--wj_target_rel_error", type=float, required=False,
+            default=None, help="""allocate the walks across the subplans
+            adaptively, until the relative half width of the confidence
+            interval of each estimate is below this, or the walk budget
+            (--wj_walk_timeout per walk path) is used up.""")
     parser.add_argument("--query_dir", type=str, required=False,
             default=None)
     parser.add_argument("-n", "--num_queries", type=int,
@@ -98,6 +113,19 @@ def read_flags():
             required=False, default=None)
     parser.add_argument("--db_year", type=int,
             required=False, default=None)
+    parser.add_argument("--db_backend", type=str,
+            required=False, default="postgres", help="""postgres OR local;
+            local is a deterministic in-process stand-in, useful for
+            profiling this script without a DB. It answers from the
+            cardinalities already stored in the loaded qreps, so it requires
+            --output_dir, and never overwrites the qreps in --query_dir.""")
+    parser.add_argument("--output_dir", type=str, required=False,
+            default=None, help="""if given, the updated qreps are saved
+            here instead of overwriting the ones in --query_dir.""")
+    parser.add_argument("--shared_subplans", type=int,
+            required=False, default=0, help="""for card_type actual: compute
+            the subplans of each query from aggregated temp tables of the
+            shared sub-joins, instead of a separate COUNT(*) per subplan.""")
 
     return parser.parse_args()
 
@@ -133,8 +161,73 @@ def is_cross_join(sg):
         return False
     return True
 
+def get_shared_cardinalities(qrep, node_list, card_key, key_name, user,
+        db_host, port, pwd, db_name, true_timeout, db_backend):
+    '''
+    computes the true cardinalities of the missing subplans in node_list by
+    reusing the shared sub-joins (see shared_subplans.py). Subplans that could
+    not be computed (e.g., timeouts, or unsupported join conditions) are left
+    as is, so they will be executed with the normal COUNT(*) queries.
+    @ret: number of subplans updated.
+    '''
+    todo = []
+    for subset in node_list:
+        cards = qrep["subset_graph"].nodes()[subset].get(card_key, {})
+        if key_name in cards and cards[key_name] < TIMEOUT_COUNT_CONSTANT:
+            continue
+        todo.append(subset)
+
+    if len(todo) == 0:
+        return 0
+
+    if db_backend is not None:
+        con = db_backend.connect(user, pwd, db_host, port, db_name)
+    else:
+        con = pg.connect(user=user, host=db_host, port=port,
+                password=pwd, database=db_name)
+    # so a timeout does not lose the temp tables created so far
+    con.autocommit = True
+    cursor = con.cursor()
+
+    counter = SharedSubplanCounter(qrep, cursor, timeout=true_timeout)
+    if not counter.supported():
+        print("shared subplans: unsupported join conditions")
+        cursor.close()
+        con.close()
+        return 0
+
+    counts = counter.get_counts(todo)
+    counter.cleanup()
+    cursor.close()
+    con.close()
+
+    for subset, (card, exec_time) in counts.items():
+        info = qrep["subset_graph"].nodes()[subset]
+        if card_key not in info:
+            info[card_key] = {}
+        if "exec_time" not in info:
+            info["exec_time"] = {}
+        if is_cross_join(qrep["join_graph"].subgraph(subset)):
+            card = CROSS_JOIN_CONSTANT
+        info[card_key][key_name] = card
+        info["exec_time"][key_name] = exec_time
+
+    print("shared subplans: computed {}/{} subplans".format(len(counts),
+        len(todo)))
+    return len(counts)
+
 def get_cardinality_wj(qrep, card_type, key_name, db_host, db_name, user, pwd,
-        port, fn, wj_fn, wj_walk_timeout, idx, seed, trie_cache, use_tries):
+        port, fn, wj_fn, wj_walk_timeout, idx, seed, trie_cache, use_tries,
+        wj_engine="sql", join_index_dir=None, target_rel_error=None):
+    '''
+    @wj_engine: sql, runs every hop of the walks as a query in the DB
+    (wanderjoin.py); batched, loads the join columns once, and runs batches of
+    walks in numpy (wanderjoin_batched.py).
+    @join_index_dir: persistent join index (join_index.py) used by the
+    batched engine.
+    @target_rel_error: None, or allocate the walks adaptively until the
+    relative confidence interval of every subplan is within it.
+    '''
 
     key_name = "wanderjoin-" + str(wj_walk_timeout)
     # key_name = "wj" + str(wj_walk_timeout)
@@ -148,9 +241,20 @@ def get_cardinality_wj(qrep, card_type, key_name, db_host, db_name, user, pwd,
     if idx % 10 == 0:
         print("query: ", idx)
     start = time.time()
-    wj = WanderJoin(user, pwd, db_host, port,
-            db_name, verbose=True, walks_timeout=wj_walk_timeout, seed =
-            seed, use_tries=use_tries, trie_cache=trie_cache)
+    if wj_engine == "batched":
+        join_index = None
+        if join_index_dir is not None:
+            join_index = JoinIndexStore(join_index_dir)
+        wj = BatchedWanderJoin(user, pwd, db_host, port,
+                db_name, verbose=True, walks_timeout=wj_walk_timeout, seed =
+                seed, join_index=join_index, target_rel_error=target_rel_error)
+    elif wj_engine == "sql":
+        wj = WanderJoin(user, pwd, db_host, port,
+                db_name, verbose=True, walks_timeout=wj_walk_timeout, seed =
+                seed, use_tries=use_tries, trie_cache=trie_cache,
+                target_rel_error=target_rel_error)
+    else:
+        assert False, "unknown wj_engine: {}".format(wj_engine)
 
     if SOURCE_NODE in list(qrep["subset_graph"].nodes()):
         qrep["subset_graph"].remove_node(SOURCE_NODE)
@@ -185,10 +289,14 @@ def get_cardinality_wj(qrep, card_type, key_name, db_host, db_name, user, pwd,
 
 def get_cardinality(qrep, card_type, key_name, db_host, db_name, user, pwd,
         port, true_timeout, pg_total, cache_dir, fn, wj_walk_timeout, idx,
-        sampling_percentage, sampling_type, skip_zero_queries, db_year):
+        sampling_percentage, sampling_type, skip_zero_queries, db_year,
+        db_backend=None, shared_subplans=False):
     '''
     updates qrep's fields with the needed cardinality estimates, and returns
     the qrep.
+    @db_backend: None connects to PostgreSQL; else, see db_backends.py
+    @shared_subplans: compute the true cardinalities by reusing shared
+    sub-joins, instead of a COUNT(*) query for every subplan.
     '''
     print("get cardinality!")
     if key_name is None:
@@ -200,8 +308,11 @@ def get_cardinality(qrep, card_type, key_name, db_host, db_name, user, pwd,
     if sampling_percentage is not None:
         key_name = str(sampling_type) + str(sampling_percentage) + "_" + key_name
 
-        con = pg.connect(user=user, host=db_host, port=port,
-                password=pwd, database=db_name)
+        if db_backend is not None:
+            con = db_backend.connect(user, pwd, db_host, port, db_name)
+        else:
+            con = pg.connect(user=user, host=db_host, port=port,
+                    password=pwd, database=db_name)
 
         cursor = con.cursor()
 
@@ -233,6 +344,11 @@ def get_cardinality(qrep, card_type, key_name, db_host, db_name, user, pwd,
     if db_year is not None:
         card_key = str(db_year) + card_key
 
+    if card_type == "actual" and shared_subplans \
+            and sampling_percentage is None:
+        get_shared_cardinalities(qrep, node_list, card_key, key_name, user,
+                db_host, port, pwd, db_name, true_timeout, db_backend)
+
     for subqi, subset in enumerate(node_list):
         info = qrep["subset_graph"].nodes()[subset]
         if card_key not in info:
@@ -289,7 +405,8 @@ def get_cardinality(qrep, card_type, key_name, db_host, db_name, user, pwd,
 
         if card_type == "pg":
             subsql = "EXPLAIN " + subsql
-            output = execute_query(subsql, user, db_host, port, pwd, db_name, [])
+            output = execute_query(subsql, user, db_host, port, pwd, db_name, [],
+                    db_backend=db_backend)
             card = pg_est_from_explain(output)
             cards[key_name] = card
             if subqi % 10 == 0:
@@ -319,7 +436,7 @@ def get_cardinality(qrep, card_type, key_name, db_host, db_name, user, pwd,
             start = time.time()
             pre_execs = ["SET statement_timeout = {}".format(true_timeout)]
             output = execute_query(subsql, user, db_host, port, pwd, db_name,
-                            pre_execs)
+                            pre_execs, db_backend=db_backend)
             if isinstance(output, Exception):
                 print(output)
                 card = EXCEPTION_COUNT_CONSTANT
@@ -356,7 +473,7 @@ def get_cardinality(qrep, card_type, key_name, db_host, db_name, user, pwd,
                     INT = 1000)
             print(subsql)
             output = execute_query(subsql, user, db_host, port, pwd, db_name,
-                            [])
+                            [], db_backend=db_backend)
             print(output)
             pdb.set_trace()
             assert False
@@ -366,7 +483,8 @@ def get_cardinality(qrep, card_type, key_name, db_host, db_name, user, pwd,
             if args.pg_total:
                 exec_sql = "EXPLAIN " + exec_sql
 
-            output = execute_query(exec_sql, user, db_host, port, pwd, db_name, [])
+            output = execute_query(exec_sql, user, db_host, port, pwd, db_name, [],
+                    db_backend=db_backend)
             card = pg_est_from_explain(output)
             cards[key_name] = card
         else:
@@ -391,6 +509,18 @@ def main():
     fns = list(glob.glob(args.query_dir + "/*"))
     fns.sort()
     par_args = []
+    if args.db_backend == "postgres":
+        db_backend = None
+    else:
+        assert args.output_dir is not None and \
+                os.path.abspath(args.output_dir) != \
+                os.path.abspath(args.query_dir), \
+                "--db_backend local needs a separate --output_dir"
+        # seeded with each qrep as it is loaded below
+        db_backend = get_db_backend(args.db_backend)
+
+    if args.output_dir is not None:
+        make_dir(args.output_dir)
 
     for i, fn in enumerate(fns):
         if i >= args.num_queries and args.num_queries != -1:
@@ -401,6 +531,10 @@ def main():
 
         if ".pkl" in fn:
             qrep = load_qrep(fn)
+            if db_backend is not None:
+                db_backend.add_qreps([qrep])
+            if args.output_dir is not None:
+                fn = os.path.join(args.output_dir, os.path.basename(fn))
         else:
             with open(fn, "r") as f:
                 sql = f.read()
@@ -429,7 +563,8 @@ def main():
                 get_cardinality_wj(qrep, args.card_type, args.key_name, args.db_host,
                         args.db_name, args.user, args.pwd, args.port,
                          fn, wj_fn, args.wj_walk_timeout, i, args.seed, None,
-                         args.use_tries)
+                         args.use_tries, args.wj_engine, args.join_index_dir,
+                         args.wj_target_rel_error)
                 print("done!")
                 pdb.set_trace()
             else:
@@ -437,7 +572,8 @@ def main():
                         args.db_name, args.user, args.pwd, args.port,
                         args.true_timeout, args.pg_total, args.card_cache_dir, fn,
                         args.wj_walk_timeout, i, args.sampling_percentage,
-                        args.sampling_type, True, args.db_year)
+                        args.sampling_type, True, args.db_year, db_backend,
+                        args.shared_subplans)
 
             continue
 
@@ -458,14 +594,16 @@ def main():
             par_args.append((qrep, args.card_type, args.key_name, args.db_host,
                     args.db_name, args.user, args.pwd, args.port,
                      fn, wj_fn, args.wj_walk_timeout, i, args.seed, None,
-                     args.use_tries))
+                     args.use_tries, args.wj_engine, args.join_index_dir,
+                     args.wj_target_rel_error))
         else:
             par_func = get_cardinality
             par_args.append((qrep, args.card_type, args.key_name, args.db_host,
                     args.db_name, args.user, args.pwd, args.port,
                     args.true_timeout, args.pg_total, args.card_cache_dir, fn,
                     args.wj_walk_timeout, i, args.sampling_percentage,
-                    args.sampling_type, args.skip_zero_queries, args.db_year))
+                    args.sampling_type, args.skip_zero_queries, args.db_year,
+                    db_backend, args.shared_subplans))
 
     if args.no_parallel:
         print("Generated all cardinalities")
@@ -480,5 +618,6 @@ def main():
         qreps = pool.starmap(par_func, par_args)
     print("Generated all cardinalities in {} seconds".format(time.time()-start))
 
-args = read_flags()
-main()
+if __name__ == "__main__":
+    args = read_flags()
+    main()
@@ -0,0 +1,275 @@
+import sys
+sys.path.append(".")
+import argparse
+import asyncio
+import asyncpg
+import copy
+import glob
+import heapq
+import os
+import time
+import klepto
+
+from query_representation.utils import *
+from query_representation.query import *
+
+from get_query_cardinalities import TIMEOUT_COUNT_CONSTANT, \
+        CROSS_JOIN_CONSTANT, EXCEPTION_COUNT_CONSTANT, CACHE_TIMEOUT, \
+        is_cross_join
+
+'''
+asyncio based collector for the true cardinalities (card_type actual in
+get_query_cardinalities.py).
+
+Instead of one connection per subplan, and parallelism only across query
+files, the COUNT(*) queries of all the subplans of all the queries are put in
+a single priority queue (cheapest subplans first), and executed by
+--num_workers coroutines sharing a bounded asyncpg connection pool. Identical
+subplan sqls across queries (e.g., subplans without predicates from the same
+template) are only executed once. Every query runs in its own transaction with
+SET LOCAL statement_timeout, and the updated qreps are checkpointed every
+--checkpoint_every completed subplans.
+
+    python3 scripts/get_query_cardinalities_async.py --query_dir queries/joblight/all_joblight/ --num_workers 16 --user ceb --pwd password
+'''
+
+def get_subplans(qrep):
+    node_list = list(qrep["subset_graph"].nodes())
+    node_list.sort(reverse=True, key = lambda x: len(x))
+    for source_node in [SOURCE_NODE, tuple(["s"])]:
+        if source_node in node_list:
+            node_list.remove(source_node)
+    return node_list
+
+def needs_card(cards, key_name):
+    if key_name not in cards:
+        return True
+    card = cards[key_name]
+    if card == EXCEPTION_COUNT_CONSTANT:
+        return False
+    if card >= TIMEOUT_COUNT_CONSTANT:
+        return args.rerun_timeouts
+    return False
+
+def _save_qrep(fn, qrep):
+    '''
+    writes to a temporary file, and renames it, so an interrupted write never
+    leaves a torn qrep behind.
+    '''
+    save_qrep(fn + ".tmp.pkl", qrep)
+    os.replace(fn + ".tmp.pkl", fn)
+
+def _job_priority(qrep, subset):
+    '''
+    cheap subplans first: fewer tables, and then smaller estimated
+    cardinalities.
+    '''
+    info = qrep["subset_graph"].nodes()[subset]
+    est = info.get("cardinality", {}).get("expected", float("inf"))
+    return (len(subset), est)
+
+class CardinalityCollector():
+    def __init__(self, qreps, fns, sql_cache):
+        self.qreps = qreps
+        self.fns = fns
+        self.sql_cache = sql_cache
+        self.key_name = args.key_name
+
+        # key: hash of subplan sql; val: [priority, sql, [(qidx, subset)]]
+        jobs = {}
+        self.num_subplans = 0
+        self.num_existing = 0
+        self.num_cached = 0
+        self.num_cj = 0
+
+        for qidx, qrep in enumerate(qreps):
+            for subset in get_subplans(qrep):
+                info = qrep["subset_graph"].nodes()[subset]
+                if "cardinality" not in info:
+                    info["cardinality"] = {}
+                if "exec_time" not in info:
+                    info["exec_time"] = {}
+
+                self.num_subplans += 1
+                if not needs_card(info["cardinality"], self.key_name):
+                    self.num_existing += 1
+                    continue
+
+                sg = qrep["join_graph"].subgraph(subset)
+                if is_cross_join(sg):
+                    info["cardinality"][self.key_name] = CROSS_JOIN_CONSTANT
+                    self.num_cj += 1
+                    continue
+
+                subsql = nx_graph_to_query(sg)
+                hash_sql = deterministic_hash(subsql)
+                if hash_sql in self.sql_cache.archive:
+                    info["cardinality"][self.key_name] = \
+                            self.sql_cache.archive[hash_sql]
+                    self.num_cached += 1
+                    continue
+
+                priority = _job_priority(qrep, subset)
+                if hash_sql not in jobs:
+                    jobs[hash_sql] = [priority, subsql, []]
+                jobs[hash_sql][0] = min(jobs[hash_sql][0], priority)
+                jobs[hash_sql][2].append((qidx, subset))
+
+        self.heap = []
+        for hash_sql, (priority, subsql, targets) in jobs.items():
+            self.heap.append((priority, hash_sql, subsql, targets))
+        heapq.heapify(self.heap)
+        self.num_jobs = len(self.heap)
+
+        self.dirty = set()
+        self.num_done = 0
+        self.num_timeout = 0
+        self.num_failed = 0
+        self.since_checkpoint = 0
+        # qidx : the task saving its latest checkpoint
+        self.checkpoints = {}
+
+    async def run_query(self, pool, subsql):
+        '''
+        @ret: cardinality, execution time.
+        '''
+        start = time.time()
+        async with pool.acquire() as con:
+            try:
+                async with con.transaction():
+                    await con.execute("SET LOCAL statement_timeout = {}".format(
+                        args.true_timeout))
+                    card = await con.fetchval(subsql)
+            except asyncpg.exceptions.QueryCanceledError:
+                print("timeout query: ")
+                print(subsql)
+                card = TIMEOUT_COUNT_CONSTANT
+                self.num_timeout += 1
+            except Exception as e:
+                print(e)
+                card = EXCEPTION_COUNT_CONSTANT
+                self.num_failed += 1
+
+        return card, time.time() - start
+
+    async def worker(self, pool):
+        while len(self.heap) > 0:
+            _, hash_sql, subsql, targets = heapq.heappop(self.heap)
+            card, exec_time = await self.run_query(pool, subsql)
+
+            if exec_time > CACHE_TIMEOUT and card < TIMEOUT_COUNT_CONSTANT:
+                self.sql_cache.archive[hash_sql] = card
+
+            for qidx, subset in targets:
+                info = self.qreps[qidx]["subset_graph"].nodes()[subset]
+                info["cardinality"][self.key_name] = card
+                info["exec_time"][self.key_name] = exec_time
+                self.dirty.add(qidx)
+
+            self.num_done += 1
+            self.since_checkpoint += 1
+            if self.num_done % 1000 == 0:
+                print("finished {}/{} subplan queries".format(self.num_done,
+                    self.num_jobs))
+            if self.since_checkpoint >= args.checkpoint_every:
+                self.checkpoint()
+
+    async def _save(self, qidx, qrep, prev):
+        # the saves of a qrep are chained, so an older copy never overwrites
+        # a newer one
+        if prev is not None:
+            await prev
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, _save_qrep, self.fns[qidx], qrep)
+
+    def checkpoint(self):
+        '''
+        saves the updated qreps; the copies are made here, so the pickling /
+        writing can happen in the executor while the workers keep updating
+        the qreps.
+        '''
+        self.since_checkpoint = 0
+        if len(self.dirty) == 0:
+            return
+        for qidx in self.dirty:
+            qrep = copy.deepcopy(self.qreps[qidx])
+            self.checkpoints[qidx] = asyncio.ensure_future(self._save(qidx,
+                qrep, self.checkpoints.get(qidx, None)))
+        self.dirty = set()
+
+    async def run(self):
+        pool = await asyncpg.create_pool(user=args.user, password=args.pwd,
+                host=args.db_host, port=args.port, database=args.db_name,
+                min_size=1, max_size=args.num_workers)
+
+        workers = [self.worker(pool) for _ in range(args.num_workers)]
+        await asyncio.gather(*workers)
+        await pool.close()
+
+        self.checkpoint()
+        await asyncio.gather(*self.checkpoints.values())
+
+def main():
+    fns = list(glob.glob(args.query_dir + "/*.pkl"))
+    fns.sort()
+    if args.num_queries != -1:
+        fns = fns[0:args.num_queries]
+
+    qreps = []
+    for fn in fns:
+        qreps.append(load_qrep(fn))
+
+    sql_cache = klepto.archives.dir_archive(args.card_cache_dir,
+            cached=True, serialized=True)
+
+    start = time.time()
+    collector = CardinalityCollector(qreps, fns, sql_cache)
+    print("queries: {}, subplans: {}, existing: {}, found in cache: {}, "
+            "cross joins: {}, subplan queries to execute: {}".format(
+                len(qreps), collector.num_subplans, collector.num_existing,
+                collector.num_cached, collector.num_cj, collector.num_jobs))
+
+    asyncio.run(collector.run())
+
+    print("Generated all cardinalities in {} seconds, timeouts: {}, "
+            "failed: {}".format(time.time()-start, collector.num_timeout,
+                collector.num_failed))
+
+def read_flags():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--db_name", type=str, required=False,
+            default="imdb")
+    parser.add_argument("--db_host", type=str, required=False,
+            default="localhost")
+    parser.add_argument("--user", type=str, required=False,
+            default="")
+    parser.add_argument("--pwd", type=str, required=False,
+            default="")
+    parser.add_argument("--port", type=int, required=False,
+            default=5432)
+    parser.add_argument("--card_cache_dir", type=str, required=False,
+            default="./cardinality_cache")
+    parser.add_argument("--query_dir", type=str, required=False,
+            default=None)
+    parser.add_argument("-n", "--num_queries", type=int,
+            required=False, default=-1)
+    parser.add_argument("--key_name", type=str, required=False,
+            default="actual")
+    parser.add_argument("--true_timeout", type=int,
+            required=False, default=1800000*5, help="""statement_timeout (ms)
+            for each subplan query.""")
+    parser.add_argument("--rerun_timeouts", type=int,
+            required=False, default=1)
+    parser.add_argument("--num_workers", type=int,
+            required=False, default=8, help="""number of concurrent subplan
+            queries; also the size of the connection pool.""")
+    parser.add_argument("--checkpoint_every", type=int,
+            required=False, default=500, help="""save the updated qreps after
+            these many subplan queries finish.""")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = read_flags()
+    main()
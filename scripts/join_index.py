@@ -0,0 +1,247 @@
+import sys
+sys.path.append(".")
+import argparse
+import glob
+import json
+import os
+import time
+import numpy as np
+import psycopg2 as pg
+
+from query_representation.utils import *
+from query_representation.query import *
+from wanderjoin_batched import JoinIndex, WalkTable, to_key_array, \
+        get_join_keys
+
+'''
+Persistent join indexes for the batched WanderJoin engine
+(wanderjoin_batched.py), built once per database and shared by all the
+queries, and all the processes, using them.
+
+For every table, the rows (ordered by --row_id_col) are stored as .npy files:
+the row ids, and the values of each join column. Every join column also gets
+the sorted keys / offsets / row permutation arrays of a JoinIndex. All of
+these are opened with np.load(mmap_mode="r"), so loading the index is
+instant, and processes on the same machine share a single copy through the
+page cache.
+
+The index is built on the full tables; a query's predicates are applied by a
+per (table, predicates) mask over the rows, computed by selecting the ids of
+the rows that satisfy the predicates. Walks then sample among all the rows
+with the join key, and reject the rows not in the mask, which keeps the
+estimates unbiased.
+
+    python3 scripts/join_index.py --query_dir queries/imdb/ --join_index_dir ./join_index --user ceb --pwd password
+'''
+
+JOIN_INDEX_META = "meta.json"
+JOIN_INDEX_CODES = "codes.pkl"
+LOAD_TABLE_TMP = "SELECT {COLS} FROM {TABLE} ORDER BY {ROW_ID}"
+LOAD_IDS_TMP = "SELECT {ALIAS}.{ROW_ID} FROM {TABLE} AS {ALIAS} WHERE {PREDS}"
+
+def _array_fn(index_dir, table, name):
+    return os.path.join(index_dir, "{}.{}.npy".format(table, name))
+
+def get_join_index_columns(qreps):
+    '''
+    @ret: table : sorted list of its join columns, over all the qreps.
+    '''
+    columns = {}
+    for qrep in qreps:
+        join_graph = qrep["join_graph"]
+        join_keys = get_join_keys(join_graph)
+        if join_keys is None:
+            continue
+        for (a1, a2), (col, _) in join_keys.items():
+            table = join_graph.nodes()[a1]["real_name"]
+            if table not in columns:
+                columns[table] = set()
+            columns[table].add(col)
+
+    for table in columns:
+        columns[table] = list(columns[table])
+        columns[table].sort()
+    return columns
+
+def build_join_index(cursor, index_dir, columns, row_id_col="id"):
+    '''
+    @columns: table : join columns to index; tables already in the index, with
+    all of these columns, are skipped.
+    '''
+    make_dir(index_dir)
+    meta_fn = os.path.join(index_dir, JOIN_INDEX_META)
+    codes_fn = os.path.join(index_dir, JOIN_INDEX_CODES)
+    meta = {"row_id_col": row_id_col, "tables": {}}
+    if os.path.exists(meta_fn):
+        with open(meta_fn, "r") as f:
+            meta = json.load(f)
+        assert meta["row_id_col"] == row_id_col
+    codes = load_object(codes_fn)
+    if codes is None:
+        codes = {}
+
+    for table, cols in columns.items():
+        if table in meta["tables"]:
+            cols = list(set(cols).union(meta["tables"][table]["columns"]))
+            cols.sort()
+            if cols == meta["tables"][table]["columns"]:
+                continue
+
+        start = time.time()
+        sql = LOAD_TABLE_TMP.format(COLS = ",".join([row_id_col] + cols),
+                TABLE = table, ROW_ID = row_id_col)
+        cursor.execute(sql)
+        outputs = cursor.fetchall()
+
+        ids = to_key_array([out[0] for out in outputs], codes)
+        np.save(_array_fn(index_dir, table, "ids"), ids)
+        for ci, col in enumerate(cols):
+            vals = to_key_array([out[ci+1] for out in outputs], codes)
+            index = JoinIndex.build(vals)
+            np.save(_array_fn(index_dir, table, col), vals)
+            np.save(_array_fn(index_dir, table, col + ".keys"), index.keys)
+            np.save(_array_fn(index_dir, table, col + ".offsets"),
+                    index.offsets)
+            np.save(_array_fn(index_dir, table, col + ".rows"), index.rows)
+
+        meta["tables"][table] = {"columns": cols, "num_rows": len(outputs)}
+        print("join index for {}, rows: {}, columns: {}, took: {}".format(
+            table, len(outputs), cols, time.time()-start))
+
+    # written last, so an interrupted build is just redone
+    save_object(codes_fn, codes)
+    with open(meta_fn, "w") as f:
+        json.dump(meta, f)
+
+class MmapWalkTable(WalkTable):
+    '''
+    WalkTable over the memory mapped arrays of a table in a JoinIndexStore;
+    the predicates are applied with the mask over its rows.
+    '''
+    def __init__(self, store, table, mask):
+        self.store = store
+        self.table = table
+        self.mask = mask
+        self.valid_rows = np.nonzero(mask)[0]
+        self.num_rows = len(self.valid_rows)
+
+    def get_index(self, col):
+        return self.store.get_index(self.table, col)
+
+    def sample_rows(self, num, rng):
+        return self.valid_rows[rng.randint(0, self.num_rows, size=num)]
+
+    def values(self, col, rows):
+        return self.store.get_column(self.table, col)[rows]
+
+    def accept(self, rows):
+        return self.mask[rows]
+
+class JoinIndexStore():
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, JOIN_INDEX_META), "r") as f:
+            self.meta = json.load(f)
+        # the ints the non numeric join keys in the index are mapped to; the
+        # tables loaded from the DB must use the same ones
+        self.codes = load_object(os.path.join(index_dir, JOIN_INDEX_CODES))
+        if self.codes is None:
+            self.codes = {}
+        self.index_dir = index_dir
+        self.row_id_col = self.meta["row_id_col"]
+        self.arrays = {}
+        self.indexes = {}
+        # (table, predicates) : mask over the table's rows
+        self.masks = {}
+
+    def has_columns(self, table, cols):
+        if table not in self.meta["tables"]:
+            return False
+        return set(cols).issubset(self.meta["tables"][table]["columns"])
+
+    def _load(self, table, name):
+        key = (table, name)
+        if key not in self.arrays:
+            self.arrays[key] = np.load(_array_fn(self.index_dir, table, name),
+                    mmap_mode="r")
+        return self.arrays[key]
+
+    def get_column(self, table, col):
+        return self._load(table, col)
+
+    def get_index(self, table, col):
+        key = (table, col)
+        if key not in self.indexes:
+            self.indexes[key] = JoinIndex(self._load(table, col + ".keys"),
+                    self._load(table, col + ".offsets"),
+                    self._load(table, col + ".rows"))
+        return self.indexes[key]
+
+    def get_mask(self, cursor, table, alias, predicates):
+        num_rows = self.meta["tables"][table]["num_rows"]
+        if len(predicates) == 0:
+            return np.ones(num_rows, dtype=bool)
+        key = (table, alias, tuple(predicates))
+        if key in self.masks:
+            return self.masks[key]
+
+        sql = LOAD_IDS_TMP.format(ALIAS = alias, ROW_ID = self.row_id_col,
+                TABLE = table, PREDS = " AND ".join(predicates))
+        cursor.execute(sql)
+        sel_ids = np.array([out[0] for out in cursor.fetchall()])
+        ids = self._load(table, "ids")
+        mask = np.zeros(num_rows, dtype=bool)
+        if len(sel_ids) > 0:
+            pos = np.minimum(np.searchsorted(ids, sel_ids), num_rows-1)
+            pos = pos[ids[pos] == sel_ids]
+            mask[pos] = True
+        self.masks[key] = mask
+        return mask
+
+    def get_table(self, cursor, table, alias, predicates):
+        return MmapWalkTable(self, table, self.get_mask(cursor, table, alias,
+            predicates))
+
+def main():
+    fns = list(glob.glob(args.query_dir + "/*/*.pkl"))
+    fns += list(glob.glob(args.query_dir + "/*.pkl"))
+    fns.sort()
+    qreps = [load_qrep(fn) for fn in fns]
+    columns = get_join_index_columns(qreps)
+    print("queries: {}, tables to index: {}".format(len(qreps), len(columns)))
+
+    con = pg.connect(user=args.user, host=args.db_host, port=args.port,
+            password=args.pwd, database=args.db_name)
+    cursor = con.cursor()
+    start = time.time()
+    build_join_index(cursor, args.join_index_dir, columns, args.row_id_col)
+    cursor.close()
+    con.close()
+    print("built join index in {} seconds".format(time.time()-start))
+
+def read_flags():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--db_name", type=str, required=False,
+            default="imdb")
+    parser.add_argument("--db_host", type=str, required=False,
+            default="localhost")
+    parser.add_argument("--user", type=str, required=False,
+            default="")
+    parser.add_argument("--pwd", type=str, required=False,
+            default="")
+    parser.add_argument("--port", type=int, required=False,
+            default=5432)
+    parser.add_argument("--query_dir", type=str, required=False,
+            default="./queries/imdb/", help="""the join columns of all the
+            queries in it (or in its template subdirectories) are indexed.""")
+    parser.add_argument("--join_index_dir", type=str, required=False,
+            default="./join_index")
+    parser.add_argument("--row_id_col", type=str, required=False,
+            default="id", help="""unique column, present in every table, used
+            to map the rows satisfying predicates to the index.""")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = read_flags()
+    main()
@@ -0,0 +1,229 @@
+import sys
+sys.path.append(".")
+import re
+import time
+
+from query_representation.utils import *
+
+'''
+Computes the true cardinalities of all the subplans of a query by reusing the
+shared sub-joins, instead of executing an independent COUNT(*) for every
+subplan.
+
+Every base table is filtered once, and aggregated on its join columns into a
+temp table with a cnt column (number of rows with those join column values).
+A subplan S is then computed from a subplan S' = S - {t} (of size |S|-1) as:
+
+    SELECT frontier(S), SUM(P.cnt * T.cnt) AS cnt
+    FROM tmp(S') AS P, tmp(t) AS T WHERE <join conditions between S' and t>
+    GROUP BY frontier(S)
+
+where frontier(S) are the join columns that connect S to the tables outside
+it. count(S) = SUM(cnt) over tmp(S). Each subplan is thus one (aggregated)
+join of two small temp tables, and each base table filter is evaluated once per
+query. Only supports equi-joins; queries with other join conditions should use
+the normal COUNT(*) queries.
+'''
+
+SHARED_TMP_FMT = "ceb_shared_{}"
+EQUI_JOIN_RE = re.compile(r"^\s*(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)\s*$")
+
+def _col_name(alias, col):
+    return alias + "__" + col
+
+def get_join_columns(join_graph):
+    '''
+    @ret: None if any join condition is not a simple equi-join; else, dict
+    (alias1, alias2) : [(alias1 col, alias2 col)].
+    '''
+    join_cols = {}
+    for a1, a2, data in join_graph.edges(data=True):
+        join_cols[(a1, a2)] = []
+        join_cols[(a2, a1)] = []
+        for cond in data["join_condition"].split(" AND "):
+            match = EQUI_JOIN_RE.match(cond)
+            if match is None:
+                return None
+            l_alias, l_col, r_alias, r_col = match.groups()
+            if l_alias == a2:
+                l_alias, l_col, r_alias, r_col = r_alias, r_col, l_alias, l_col
+            assert l_alias == a1 and r_alias == a2
+            join_cols[(a1, a2)].append((l_col, r_col))
+            join_cols[(a2, a1)].append((r_col, l_col))
+    return join_cols
+
+def _frontier(join_graph, join_cols, subset):
+    '''
+    @ret: sorted list of temp table column names that are needed to join
+    subset with the remaining tables.
+    '''
+    cols = set()
+    for alias in subset:
+        for other in join_graph.neighbors(alias):
+            if other in subset:
+                continue
+            for col, _ in join_cols[(alias, other)]:
+                cols.add(_col_name(alias, col))
+    cols = list(cols)
+    cols.sort()
+    return cols
+
+class SharedSubplanCounter():
+    def __init__(self, qrep, cursor, timeout=None):
+        '''
+        @cursor: DB-API cursor; the connection should be in autocommit mode
+        so a failed statement does not drop the earlier temp tables.
+        @timeout: statement_timeout (ms) for each statement; None to skip.
+        '''
+        self.qrep = qrep
+        self.join_graph = qrep["join_graph"]
+        self.cursor = cursor
+        self.timeout = timeout
+        self.join_cols = get_join_columns(self.join_graph)
+        # subset : (temp table name, number of rows)
+        self.tmp_tables = {}
+
+    def supported(self):
+        return self.join_cols is not None
+
+    def _execute(self, sql):
+        self.cursor.execute(sql)
+
+    def _create(self, subset, select_sql):
+        '''
+        @ret: cardinality of subset.
+        '''
+        name = SHARED_TMP_FMT.format(len(self.tmp_tables))
+        self._execute("DROP TABLE IF EXISTS {}".format(name))
+        self._execute("CREATE TEMP TABLE {} AS {}".format(name, select_sql))
+        self._execute("SELECT SUM(cnt), COUNT(*) FROM {}".format(name))
+        card, rows = self.cursor.fetchall()[0]
+        self.tmp_tables[subset] = (name, rows)
+        if card is None:
+            card = 0
+        return int(card)
+
+    def _base_table(self, alias):
+        info = self.join_graph.nodes()[alias]
+        cols = set()
+        for other in self.join_graph.neighbors(alias):
+            for col, _ in self.join_cols[(alias, other)]:
+                cols.add(col)
+        cols = list(cols)
+        cols.sort()
+
+        sel_cols = ["{}.{} AS {}".format(alias, c, _col_name(alias, c))
+                for c in cols]
+        sql = "SELECT " + ", ".join(sel_cols + ["COUNT(*) AS cnt"])
+        sql += " FROM {} AS {}".format(info["real_name"], alias)
+        if len(info["predicates"]) > 0:
+            sql += " WHERE " + " AND ".join(info["predicates"])
+        if len(cols) > 0:
+            sql += " GROUP BY " + ", ".join(["{}.{}".format(alias, c)
+                for c in cols])
+        return self._create((alias,), sql)
+
+    def _join(self, subset):
+        '''
+        joins the smallest already computed subset - {t} with t.
+        '''
+        best = None
+        for alias in subset:
+            prev = tuple(a for a in subset if a != alias)
+            if prev not in self.tmp_tables:
+                continue
+            rows = self.tmp_tables[prev][1] + self.tmp_tables[(alias,)][1]
+            if best is None or rows < best[0]:
+                best = (rows, prev, alias)
+        assert best is not None
+        _, prev, alias = best
+
+        prev_name = self.tmp_tables[prev][0]
+        base_name = self.tmp_tables[(alias,)][0]
+        conds = []
+        for other in self.join_graph.neighbors(alias):
+            if other not in prev:
+                continue
+            for col, ocol in self.join_cols[(alias, other)]:
+                conds.append("P.{} = T.{}".format(_col_name(other, ocol),
+                    _col_name(alias, col)))
+
+        frontier = _frontier(self.join_graph, self.join_cols, subset)
+        sel_cols = []
+        for col in frontier:
+            if col.startswith(alias + "__"):
+                sel_cols.append("T." + col)
+            else:
+                sel_cols.append("P." + col)
+
+        sql = "SELECT " + ", ".join(sel_cols + \
+                ["SUM(CAST(P.cnt AS NUMERIC) * T.cnt) AS cnt"])
+        sql += " FROM {} AS P, {} AS T".format(prev_name, base_name)
+        if len(conds) > 0:
+            sql += " WHERE " + " AND ".join(conds)
+        if len(sel_cols) > 0:
+            sql += " GROUP BY " + ", ".join(sel_cols)
+        return self._create(subset, sql)
+
+    def _drop(self, subset):
+        name = self.tmp_tables[subset][0]
+        self._execute("DROP TABLE IF EXISTS {}".format(name))
+
+    def get_counts(self, subsets):
+        '''
+        @subsets: subplans (sorted alias tuples, connected in the join graph)
+        to compute.
+        @ret: dict subset : (cardinality, exec time). If a statement fails (e.g.,
+        because of the timeout), the subplans computed so far are returned.
+        '''
+        ret = {}
+        if len(subsets) == 0:
+            return ret
+        max_size = max([len(s) for s in subsets])
+        subsets = set(subsets)
+
+        # need every connected subplan up to max_size to build the larger ones
+        all_subsets = []
+        for s in self.qrep["subset_graph"].nodes():
+            if len(s) > max_size or s == SOURCE_NODE \
+                    or not all([a in self.join_graph for a in s]):
+                continue
+            all_subsets.append(s)
+        all_subsets.sort(key=lambda x: (len(x), x))
+
+        if self.timeout is not None:
+            self._execute("SET statement_timeout = {}".format(self.timeout))
+
+        prev_level = []
+        cur_level = []
+        try:
+            for subset in all_subsets:
+                if len(cur_level) > 0 and len(subset) > len(cur_level[0]):
+                    # temp tables are only needed by the next level
+                    for s in prev_level:
+                        if len(s) > 1:
+                            self._drop(s)
+                    prev_level = cur_level
+                    cur_level = []
+
+                start = time.time()
+                if len(subset) == 1:
+                    card = self._base_table(subset[0])
+                else:
+                    card = self._join(subset)
+                cur_level.append(subset)
+                if subset in subsets:
+                    ret[subset] = (card, time.time() - start)
+        except Exception as e:
+            print("shared subplan computation failed: ", e)
+
+        return ret
+
+    def cleanup(self):
+        for subset in self.tmp_tables:
+            try:
+                self._drop(subset)
+            except Exception as e:
+                print(e)
+                break
+        self.tmp_tables = {}
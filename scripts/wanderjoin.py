@@ -14,12 +14,20 @@ import pickle
 import re
 from collections import defaultdict
 import scipy.stats as st
+import numpy as np
+import math
 import copy
 import pygtrie
 
 MAX_WALKS = 10000000
 CONF_ALPHA = 0.99
 
+# adaptive walks (target_rel_error): relative confidence interval width used
+# for subplans without any successful walks
+MAX_REL_SCORE = 10.0
+# subplans without successful walks after these many walks are assumed empty
+MAX_ZERO_WALKS = 1000
+
 ## use archive for anything in between ARCHIVE_THRESH and USE_THRESH
 TRIE_ARCHIVE_THRESHOLD = 10
 # anything above this does not use tries
@@ -43,11 +51,108 @@ DROP_MULTICOL_INDEXES = False
 
 # DEBUG_TRIES = True
 
+def get_node_selectivities(join_graph, subset_graph):
+    '''
+    @ret: alias : number of rows filtered out by the predicates (estimated),
+    used to choose the walk order.
+    '''
+    node_selectivities = {}
+    for node, info in join_graph.nodes(data=True):
+        if len(info["predicates"]) == 0:
+            node_sel = 0.00
+        else:
+            cards = subset_graph.nodes()[tuple([node])]["cardinality"]
+            # TODO: we can also compute, and use true values here maybe?
+            node_sel = float(cards["total"]) - cards["expected"]
+        node_selectivities[node] = node_sel
+    return node_selectivities
+
+def find_walk_path(nodes, node_selectivities, sg):
+    '''
+    @nodes: list of aliases in sg; note: elements are removed from it.
+    @ret: order in which the random walks visit the tables of sg.
+    '''
+    sels = [node_selectivities[t] for t in nodes]
+    path = []
+    first_node = nodes[np.argmax(sels)]
+
+    nodes.remove(first_node)
+    path.append(first_node)
+
+    for i in range(len(sg.nodes())-1):
+        join_edges = list(nx.edge_boundary(sg, path, nodes))
+        assert len(join_edges) != 0
+
+        # use node_selectivities here...
+        if len(join_edges) == 1:
+            path.append(join_edges[0][1])
+        else:
+            options = [j[1] for j in join_edges]
+            sels = [node_selectivities[t] for t in options]
+            # path.append(options[np.argmax(sels)])
+            # random.seed(1)
+            winners = np.argwhere(sels == np.amax(sels))
+            path.append(options[random.choice(winners.flatten())])
+
+        nodes.remove(path[-1])
+
+    # hack, for small tables. can also do it based on expected count or so.
+    if first_node in ["kt","it1","it2","it3","it4","rt","k"]:
+        path[0] = path[1]
+        path[1] = first_node
+    return path
+
+def get_walk_score(est_sum, sq_sum, num, succ, conf_alpha=CONF_ALPHA):
+    '''
+    @est_sum, sq_sum: sum, and sum of squares, of the estimates of num walks,
+    of which succ were successful.
+    @ret: half width of the confidence interval of the estimate, relative to
+    the estimate.
+    '''
+    if succ == 0:
+        if num >= MAX_ZERO_WALKS:
+            return 0.0
+        return MAX_REL_SCORE
+    if num <= 1:
+        return MAX_REL_SCORE
+    mean = est_sum / num
+    var = max(sq_sum - est_sum**2 / num, 0.0) / (num - 1)
+    alpha = st.norm.ppf((conf_alpha+1)/2)
+    half_interval = alpha*np.sqrt(var) / np.sqrt(num)
+    return min(half_interval / mean, MAX_REL_SCORE)
+
+def allocate_walks(scores, target_rel_error, num_walks):
+    '''
+    @scores: relative confidence interval width of the worst subplan covered
+    by each walk path.
+    @ret: number of walks for each path; paths already within the target get
+    none, and the rest get walks in proportion to (score / target)^2, i.e.,
+    roughly the factor by which their number of walks has to grow.
+    '''
+    weights = []
+    for score in scores:
+        if score <= target_rel_error:
+            weights.append(0.0)
+        else:
+            weights.append((score / target_rel_error)**2)
+    total = sum(weights)
+    if total == 0:
+        return [0]*len(scores)
+    return [int(math.ceil(num_walks*w / total)) for w in weights]
+
 class WanderJoin():
 
     def __init__(self, user, pwd, db_host, port, db_name,
             verbose=False, cache_dir="./sql_cache", walks_timeout=0.5,
-            seed=1234, use_tries=True, trie_cache=None):
+            seed=1234, use_tries=True, trie_cache=None,
+            target_rel_error=None, pilot_walks=20, walks_per_round=200):
+        '''
+        @target_rel_error: None runs the walks for one subplan at a time,
+        until walks_timeout, or 100 successful walks. Else, the walks of all
+        the subplans are allocated adaptively (see get_counts_adaptive), until
+        the relative confidence interval width of every subplan is below
+        target_rel_error, or walks_timeout per walk path is used up.
+        '''
         self.user = user
         self.pwd = pwd
         self.db_host = db_host
@@ -59,6 +164,9 @@ class WanderJoin():
         self.walks_timeout = walks_timeout
         self.verbose = verbose
         self.use_tries = use_tries
+        self.target_rel_error = target_rel_error
+        self.pilot_walks = pilot_walks
+        self.walks_per_round = walks_per_round
         if self.use_tries:
             tstart = time.time()
             if trie_cache is None:
@@ -69,35 +177,7 @@ class WanderJoin():
             print("loading cache took: ", time.time() - tstart)
 
     def find_path(self, nodes, node_selectivities, sg):
-        sels = [node_selectivities[t] for t in nodes]
-        path = []
-        first_node = nodes[np.argmax(sels)]
-
-        nodes.remove(first_node)
-        path.append(first_node)
-
-        for i in range(len(sg.nodes())-1):
-            join_edges = list(nx.edge_boundary(sg, path, nodes))
-            assert len(join_edges) != 0
-
-            # use node_selectivities here...
-            if len(join_edges) == 1:
-                path.append(join_edges[0][1])
-            else:
-                options = [j[1] for j in join_edges]
-                sels = [node_selectivities[t] for t in options]
-                # path.append(options[np.argmax(sels)])
-                # random.seed(1)
-                winners = np.argwhere(sels == np.amax(sels))
-                path.append(options[random.choice(winners.flatten())])
-
-            nodes.remove(path[-1])
-
-        # hack, for small tables. can also do it based on expected count or so.
-        if first_node in ["kt","it1","it2","it3","it4","rt","k"]:
-            path[0] = path[1]
-            path[1] = first_node
-        return path
+        return find_walk_path(nodes, node_selectivities, sg)
 
     def init_path_details(self, path, sg):
         print("going to initiate path details for: ", path)
@@ -272,19 +352,9 @@ class WanderJoin():
         # generate a map of key : fkey pairs
         subset_graph = qrep["subset_graph"]
         join_graph = qrep["join_graph"]
-        node_selectivities = {}
-
+        node_selectivities = get_node_selectivities(join_graph, subset_graph)
         for node, info in join_graph.nodes(data=True):
             sels = []
-            if len(info["predicates"]) == 0:
-                node_sel = 0.00
-            else:
-                cards = subset_graph.nodes()[tuple([node])]["cardinality"]
-                # TODO: we can also compute, and use true values here maybe?
-                node_sel = float(cards["total"]) - cards["expected"]
-
-            node_selectivities[node] = node_sel
-
             edges = join_graph.edges(node)
             for edge in edges:
                 # edge_data = join_graph.get_edge_data(edge[0], edge[1])
@@ -308,6 +378,10 @@ class WanderJoin():
         subset_keys = list(subset_graph.nodes())
         subset_keys.sort(key = lambda v : len(v), reverse=True)
 
+        if self.target_rel_error is not None:
+            return self.get_counts_adaptive(join_graph, subset_graph,
+                    subset_keys, node_selectivities, total_start)
+
         card_ests = {}
         card_vars = {}
         card_samples = {}
@@ -425,6 +499,125 @@ class WanderJoin():
             exec_nodes, all_exec_duration, wj_data["total_time"]))
         return wj_data
 
+    def walk_path(self, path, sg, path_details, prefixes, num_walks,
+            stats):
+        '''
+        runs num_walks walks along path, and adds their estimates to the
+        stats of each prefix subplan of it.
+        @stats: [card_ests, card_sqs, card_samples, succ_walks]
+        @ret: time spent in the walks.
+        '''
+        card_ests, card_sqs, card_samples, succ_walks = stats
+        path_execs, path_join_keys, path_tries = path_details
+        duration = 0.0
+        for _ in range(num_walks):
+            cur_duration, pis = self.run_path(path, sg, path_execs,
+                    path_join_keys, path_tries)
+            duration += cur_duration
+            cur_pi = 1
+            for nodeidx, nodes in enumerate(prefixes):
+                if nodeidx < len(pis):
+                    cur_pi *= pis[nodeidx]
+                if nodeidx == 0:
+                    continue
+                card_samples[nodes] += 1
+                if nodeidx < len(pis):
+                    card_ests[nodes] += cur_pi
+                    card_sqs[nodes] += float(cur_pi)**2
+                    succ_walks[nodes] += 1
+        return duration
+
+    def get_counts_adaptive(self, join_graph, subset_graph, subset_keys,
+            node_selectivities, total_start):
+        '''
+        Every subplan is covered by a walk path, and each walk along a path
+        gives estimates for all its prefix subplans; subplans that are
+        prefixes of several paths pool the walks of all of them. After
+        pilot_walks walks on every path, each round allocates walks_per_round
+        walks across the paths, in proportion to how far the relative
+        confidence interval width of their worst prefix subplan is from
+        target_rel_error. Stops when every subplan is within the target, or
+        after walks_timeout seconds of walks per path.
+        '''
+        card_ests = {}
+        card_sqs = {}
+        card_samples = {}
+        succ_walks = {}
+        stats = [card_ests, card_sqs, card_samples, succ_walks]
+
+        paths = []
+        for node in subset_keys:
+            if len(node) == 1 or node in card_samples:
+                continue
+            tables = list(node)
+            sg = join_graph.subgraph(tables)
+            path = self.find_path(tables, node_selectivities, sg)
+            path_details = self.init_path_details(path, sg)
+            prefixes = []
+            for nodeidx in range(len(path)):
+                nodes = path[0:nodeidx+1]
+                nodes.sort()
+                prefixes.append(tuple(nodes))
+            for nodes in prefixes[1:]:
+                if nodes not in card_samples:
+                    card_ests[nodes] = 0.0
+                    card_sqs[nodes] = 0.0
+                    card_samples[nodes] = 0
+                    succ_walks[nodes] = 0
+            paths.append((path, sg, path_details, prefixes))
+
+        for node in subset_keys:
+            if len(node) == 1:
+                # FIXME: temporary hack
+                true = subset_graph.nodes()[node]["cardinality"]["actual"]
+                card_ests[node] = true
+                card_sqs[node] = float(true)**2
+                card_samples[node] = 1
+
+        all_exec_duration = 0.0
+        for path, sg, path_details, prefixes in paths:
+            all_exec_duration += self.walk_path(path, sg, path_details,
+                    prefixes, self.pilot_walks, stats)
+
+        time_budget = self.walks_timeout*len(paths)
+        num_rounds = 0
+        while all_exec_duration < time_budget:
+            scores = []
+            for _, _, _, prefixes in paths:
+                scores.append(max([get_walk_score(card_ests[nodes],
+                    card_sqs[nodes], card_samples[nodes], succ_walks[nodes])
+                    for nodes in prefixes[1:]]))
+            num_walks = allocate_walks(scores, self.target_rel_error,
+                    self.walks_per_round)
+            if sum(num_walks) == 0:
+                break
+            num_rounds += 1
+            for pi, (path, sg, path_details, prefixes) in enumerate(paths):
+                if num_walks[pi] == 0:
+                    continue
+                all_exec_duration += self.walk_path(path, sg, path_details,
+                        prefixes, num_walks[pi], stats)
+                if all_exec_duration >= time_budget:
+                    break
+
+        card_vars = {}
+        for nodes in card_ests:
+            num = card_samples[nodes]
+            card_vars[nodes] = max(card_sqs[nodes] - card_ests[nodes]**2 / num,
+                    0.0)
+
+        wj_data = {}
+        wj_data["card_ests_sum"] = card_ests
+        wj_data["card_vars_sum"] = card_vars
+        wj_data["card_samples"] = card_samples
+        wj_data["succ_walks"] = succ_walks
+        wj_data["exec_time"] = all_exec_duration
+        wj_data["total_time"] = time.time() - total_start
+        wj_data["total_trie_time"] = self.total_trie_time
+        print("walk paths: {}, rounds: {}, all exec duration: {}, total time: {}".format(
+            len(paths), num_rounds, all_exec_duration, wj_data["total_time"]))
+        return wj_data
+
     def run_path(self, node_list, join_graph,
             path_execs, path_join_keys, path_tries):
         pis = []
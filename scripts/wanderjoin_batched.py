@@ -0,0 +1,450 @@
+import sys
+sys.path.append(".")
+import psycopg2 as pg
+import re
+import time
+import numpy as np
+import scipy.stats as st
+
+from query_representation.utils import *
+from wanderjoin import get_node_selectivities, find_walk_path, MAX_WALKS, \
+        CONF_ALPHA, get_walk_score, allocate_walks
+
+'''
+Batched version of the WanderJoin random walks in wanderjoin.py.
+
+For every table in the query, the join key columns of the rows satisfying its
+predicates are loaded once into numpy arrays, and each join column gets a
+CSR-style index (sorted unique keys, offsets into a row permutation). A batch
+of walks then advances one hop at a time for all the walks together: the
+previous tables' join keys are looked up with np.searchsorted, and the next
+rows are sampled uniformly among the matches. The Horvitz-Thompson estimate of
+a walk for the prefix of the path up to table i is the product of the fanouts
+up to i (0 if the walk failed before i), so the estimates of all the prefix
+subplans are columns of one (num_walks x path length) array.
+
+Join conditions that are not on the walk path (cycles in the join graph) are
+checked on the sampled rows, and walks that violate them fail.
+
+get_counts returns the same wj_data dict as WanderJoin.get_counts.
+'''
+
+EQUI_JOIN_RE = re.compile(r"^\s*(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)\s*$")
+LOAD_ROWS_TMP = "SELECT {COLS} FROM {TABLE} AS {ALIAS} {WHERE}"
+
+def get_join_keys(join_graph):
+    '''
+    @ret: None if any join condition is not a simple equi-join; else, dict
+    (alias1, alias2) : (alias1 col, alias2 col).
+    '''
+    join_keys = {}
+    for a1, a2, data in join_graph.edges(data=True):
+        match = EQUI_JOIN_RE.match(data["join_condition"])
+        if match is None:
+            return None
+        l_alias, l_col, r_alias, r_col = match.groups()
+        if l_alias == a2:
+            l_alias, l_col, r_alias, r_col = r_alias, r_col, l_alias, l_col
+        join_keys[(a1, a2)] = (l_col, r_col)
+        join_keys[(a2, a1)] = (r_col, l_col)
+    return join_keys
+
+def to_key_array(vals, codes):
+    '''
+    @vals: list of join key values; None for NULLs.
+    @codes: dict, shared by all the columns of a query, used to map non
+    numeric values to ints.
+    @ret: numpy array; int64, or float64 with NaN for NULLs.
+    '''
+    if all([isinstance(v, (int, np.integer)) for v in vals]):
+        return np.array(vals, dtype=np.int64)
+    keys = np.empty(len(vals), dtype=np.float64)
+    for i, v in enumerate(vals):
+        if v is None:
+            keys[i] = np.nan
+        elif isinstance(v, (int, float, np.integer, np.floating)):
+            keys[i] = v
+        else:
+            if v not in codes:
+                codes[v] = -(len(codes)+1)
+            keys[i] = codes[v]
+    return keys
+
+class JoinIndex():
+    '''
+    CSR-style index on one join column: the positions of the rows with key
+    keys[i] are rows[offsets[i]:offsets[i+1]].
+    '''
+    def __init__(self, keys=None, offsets=None, rows=None):
+        self.keys = keys
+        self.offsets = offsets
+        self.rows = rows
+
+    @staticmethod
+    def build(col):
+        '''
+        @col: key array, with NaN for NULLs.
+        '''
+        if col.dtype == np.float64:
+            rows = np.nonzero(~np.isnan(col))[0]
+        else:
+            rows = np.arange(len(col))
+        order = np.argsort(col[rows], kind="stable")
+        rows = rows[order]
+        keys, starts = np.unique(col[rows], return_index=True)
+        offsets = np.append(starts, len(rows)).astype(np.int64)
+        return JoinIndex(keys, offsets, rows)
+
+    def sample(self, vals, rng):
+        '''
+        @vals: join key values to look up.
+        @ret: sampled row for each value (-1 if no match), and the number of
+        matching rows.
+        '''
+        if len(self.keys) == 0:
+            return np.full(len(vals), -1, dtype=np.int64), \
+                    np.zeros(len(vals), dtype=np.int64)
+        pos = np.searchsorted(self.keys, vals)
+        pos = np.minimum(pos, len(self.keys)-1)
+        found = self.keys[pos] == vals
+        fanouts = np.where(found, self.offsets[pos+1] - self.offsets[pos], 0)
+        choice = self.offsets[pos] + \
+                np.floor(rng.random_sample(len(vals))*fanouts).astype(np.int64)
+        choice = np.minimum(choice, len(self.rows)-1)
+        sampled = np.where(found, self.rows[choice], -1)
+        return sampled, fanouts
+
+class WalkTable():
+    '''
+    join key columns, and indexes, of the rows of one table that satisfy the
+    query's predicates.
+    '''
+    def __init__(self, columns):
+        '''
+        @columns: col name : key array; all of the same length.
+        '''
+        self.columns = columns
+        self.indexes = {}
+        self.num_rows = len(list(columns.values())[0]) if len(columns) > 0 \
+                else 0
+
+    def get_index(self, col):
+        if col not in self.indexes:
+            self.indexes[col] = JoinIndex.build(self.columns[col])
+        return self.indexes[col]
+
+    def sample_rows(self, num, rng):
+        return rng.randint(0, self.num_rows, size=num)
+
+    def values(self, col, rows):
+        return self.columns[col][rows]
+
+    def accept(self, rows):
+        '''
+        @ret: bool mask of the sampled rows that satisfy the predicates.
+        '''
+        return np.ones(len(rows), dtype=bool)
+
+def _prefix_key(path, idx):
+    nodes = list(path[0:idx+1])
+    nodes.sort()
+    return tuple(nodes)
+
+class BatchedWanderJoin():
+
+    def __init__(self, user, pwd, db_host, port, db_name,
+            verbose=False, walks_timeout=0.5, seed=1234,
+            batch_size=1000, min_succ_walks=100, db_backend=None,
+            join_index=None, target_rel_error=None, pilot_walks=100):
+        '''
+        @walks_timeout: seconds spent on the walks for each subplan.
+        @min_succ_walks: stop the walks for a subplan after these many
+        successful walks.
+        @db_backend: None connects to PostgreSQL; else, see db_backends.py
+        @join_index: JoinIndexStore (join_index.py); tables in it are not
+        loaded from the DB, only the ids of the rows satisfying the
+        predicates are.
+        @target_rel_error: see WanderJoin; None walks each path until
+        walks_timeout or min_succ_walks.
+        '''
+        self.user = user
+        self.pwd = pwd
+        self.db_host = db_host
+        self.port = port
+        self.db_name = db_name
+        self.db_backend = db_backend
+        self.verbose = verbose
+        self.walks_timeout = walks_timeout
+        self.batch_size = batch_size
+        self.min_succ_walks = min_succ_walks
+        self.join_index = join_index
+        self.target_rel_error = target_rel_error
+        self.pilot_walks = pilot_walks
+        self.rng = np.random.RandomState(seed)
+
+    def _connect(self):
+        if self.db_backend is not None:
+            return self.db_backend.connect(self.user, self.pwd, self.db_host,
+                    self.port, self.db_name)
+        return pg.connect(user=self.user, host=self.db_host, port=self.port,
+                password=self.pwd, database=self.db_name)
+
+    def load_tables(self, join_graph, join_keys):
+        '''
+        @ret: alias : WalkTable
+        '''
+        con = self._connect()
+        cursor = con.cursor()
+        if self.join_index is not None:
+            # so the keys of the indexed tables match the ones loaded here
+            codes = dict(self.join_index.codes)
+        else:
+            codes = {}
+        tables = {}
+        for alias, info in join_graph.nodes(data=True):
+            cols = set()
+            for other in join_graph.neighbors(alias):
+                cols.add(join_keys[(alias, other)][0])
+            cols = list(cols)
+            cols.sort()
+
+            if self.join_index is not None and \
+                    self.join_index.has_columns(info["real_name"], cols):
+                tables[alias] = self.join_index.get_table(cursor,
+                        info["real_name"], alias, info["predicates"])
+                continue
+
+            where = ""
+            if len(info["predicates"]) > 0:
+                where = "WHERE " + " AND ".join(info["predicates"])
+            sels = ["{}.{}".format(alias, c) for c in cols]
+            if len(sels) == 0:
+                sels = ["1"]
+            sql = LOAD_ROWS_TMP.format(COLS = ",".join(sels),
+                    TABLE = info["real_name"], ALIAS = alias, WHERE = where)
+            cursor.execute(sql)
+            outputs = cursor.fetchall()
+
+            columns = {}
+            for ci, col in enumerate(cols):
+                columns[col] = to_key_array([out[ci] for out in outputs], codes)
+            table = WalkTable(columns)
+            table.num_rows = len(outputs)
+            tables[alias] = table
+
+        cursor.close()
+        con.close()
+        return tables
+
+    def _path_hops(self, path, sg, join_keys):
+        '''
+        @ret: for each table after the first: (parent alias, parent col, col)
+        of the join used to reach it, and [(col, other alias, other col)] of
+        the other join conditions with the tables before it on the path.
+        '''
+        hops = [None]
+        checks = [[]]
+        for i in range(1, len(path)):
+            node = path[i]
+            prev = [p for p in path[0:i] if sg.has_edge(p, node)]
+            assert len(prev) != 0
+            parent = prev[0]
+            col, parent_col = join_keys[(node, parent)]
+            hops.append((parent, parent_col, col))
+            cur_checks = []
+            for other in prev[1:]:
+                ccol, ocol = join_keys[(node, other)]
+                cur_checks.append((ccol, other, ocol))
+            checks.append(cur_checks)
+        return hops, checks
+
+    def run_walks(self, path, hops, checks, tables, num_walks):
+        '''
+        @ret: (num_walks, len(path)) array of the Horvitz-Thompson estimates
+        of each walk, for each prefix of the path.
+        '''
+        ests = np.zeros((num_walks, len(path)), dtype=np.float64)
+        first = tables[path[0]]
+        if first.num_rows == 0:
+            return ests
+
+        rows = {}
+        rows[path[0]] = first.sample_rows(num_walks, self.rng)
+        alive = first.accept(rows[path[0]])
+        cur = np.full(num_walks, float(first.num_rows))
+        ests[:,0] = np.where(alive, cur, 0.0)
+
+        for i in range(1, len(path)):
+            node = path[i]
+            table = tables[node]
+            parent, parent_col, col = hops[i]
+            idxs = np.nonzero(alive)[0]
+            node_rows = np.full(num_walks, -1, dtype=np.int64)
+            if len(idxs) == 0:
+                break
+
+            vals = tables[parent].values(parent_col, rows[parent][idxs])
+            sampled, fanouts = table.get_index(col).sample(vals, self.rng)
+            node_rows[idxs] = sampled
+            cur[idxs] *= fanouts
+            ok = fanouts > 0
+            ok[ok] = table.accept(sampled[ok])
+            for ccol, other, ocol in checks[i]:
+                ok[ok] = table.values(ccol, sampled[ok]) == \
+                        tables[other].values(ocol, rows[other][idxs[ok]])
+            alive[idxs[~ok]] = False
+            rows[node] = node_rows
+            ests[:,i] = np.where(alive, cur, 0.0)
+
+        return ests
+
+    def walk_path(self, path_info, tables, num_walks, stats):
+        '''
+        runs num_walks walks (in batches) along the path, and adds their
+        estimates to the stats of each prefix subplan of it.
+        @stats: [card_ests, card_sqs, card_samples, succ_walks]
+        '''
+        card_ests, card_sqs, card_samples, succ_walks = stats
+        path, hops, checks, prefixes = path_info
+        done = 0
+        while done < num_walks:
+            batch = min(self.batch_size, num_walks - done)
+            ests = self.run_walks(path, hops, checks, tables, batch)
+            done += batch
+            sums = ests.sum(axis=0)
+            sqs = (ests**2).sum(axis=0)
+            succ = (ests > 0).sum(axis=0)
+            for i, prefix in enumerate(prefixes):
+                if len(prefix) == 1:
+                    continue
+                card_ests[prefix] += sums[i]
+                card_sqs[prefix] += sqs[i]
+                card_samples[prefix] += batch
+                succ_walks[prefix] += succ[i]
+
+    def get_counts(self, qrep):
+        '''
+        @ret: count for each subquery
+        '''
+        total_start = time.time()
+        subset_graph = qrep["subset_graph"]
+        join_graph = qrep["join_graph"]
+        join_keys = get_join_keys(join_graph)
+        assert join_keys is not None, "only supports equi-joins"
+
+        load_start = time.time()
+        tables = self.load_tables(join_graph, join_keys)
+        load_time = time.time() - load_start
+        node_selectivities = get_node_selectivities(join_graph, subset_graph)
+
+        subset_keys = list(subset_graph.nodes())
+        subset_keys = [s for s in subset_keys if s != SOURCE_NODE]
+        subset_keys.sort(key = lambda v : len(v), reverse=True)
+
+        card_ests = {}
+        card_sqs = {}
+        card_samples = {}
+        succ_walks = {}
+        stats = [card_ests, card_sqs, card_samples, succ_walks]
+
+        # every subplan is a prefix of some walk path
+        paths = []
+        for node in subset_keys:
+            if len(node) == 1 or node in card_samples:
+                continue
+            sg = join_graph.subgraph(node)
+            path = find_walk_path(list(node), node_selectivities, sg)
+            hops, checks = self._path_hops(path, sg, join_keys)
+            prefixes = [_prefix_key(path, i) for i in range(len(path))]
+            for prefix in prefixes:
+                if len(prefix) > 1 and prefix not in card_samples:
+                    card_ests[prefix] = 0.0
+                    card_sqs[prefix] = 0.0
+                    card_samples[prefix] = 0
+                    succ_walks[prefix] = 0
+            paths.append((path, hops, checks, prefixes))
+
+        for node in subset_keys:
+            if len(node) == 1:
+                # exact, since we loaded all the rows satisfying the predicates
+                card_ests[node] = float(tables[node[0]].num_rows)
+                card_sqs[node] = float(tables[node[0]].num_rows)**2
+                card_samples[node] = 1
+                succ_walks[node] = 1
+
+        exec_start = time.time()
+        if self.target_rel_error is None:
+            for path_info in paths:
+                node = path_info[3][-1]
+                start = time.time()
+                while card_samples[node] < MAX_WALKS:
+                    self.walk_path(path_info, tables, self.batch_size, stats)
+                    if time.time() - start > self.walks_timeout:
+                        break
+                    if succ_walks[node] >= self.min_succ_walks:
+                        break
+        else:
+            self.walk_adaptive(paths, tables, stats)
+        all_exec_duration = time.time() - exec_start
+
+        if self.verbose:
+            for node in card_ests:
+                est, half = get_estimate(card_ests[node], card_sqs[node],
+                        card_samples[node])
+                print("nodes: {}, walks: {}, succ walks: {}, est: {}+/-{}".format(
+                    node, card_samples[node], succ_walks[node], est, half))
+
+        card_vars = {}
+        for node in card_ests:
+            num = card_samples[node]
+            card_vars[node] = max(card_sqs[node] - card_ests[node]**2 / num, 0.0)
+
+        wj_data = {}
+        wj_data["card_ests_sum"] = card_ests
+        wj_data["card_vars_sum"] = card_vars
+        wj_data["card_samples"] = card_samples
+        wj_data["succ_walks"] = succ_walks
+        wj_data["exec_time"] = all_exec_duration
+        wj_data["total_time"] = time.time() - total_start
+        wj_data["total_trie_time"] = load_time
+        print("walk paths: {}, all exec duration: {}, total time: {}".format(
+            len(paths), all_exec_duration, wj_data["total_time"]))
+        return wj_data
+
+    def walk_adaptive(self, paths, tables, stats):
+        '''
+        same allocation as WanderJoin.get_counts_adaptive: pilot walks on every
+        path, and then rounds of walks allocated by the relative confidence
+        interval widths, until all subplans are within target_rel_error, or
+        walks_timeout seconds per path are used up.
+        '''
+        card_ests, card_sqs, card_samples, succ_walks = stats
+        start = time.time()
+        time_budget = self.walks_timeout*len(paths)
+        for path_info in paths:
+            self.walk_path(path_info, tables, self.pilot_walks, stats)
+
+        while time.time() - start < time_budget:
+            scores = []
+            for _, _, _, prefixes in paths:
+                scores.append(max([get_walk_score(card_ests[p], card_sqs[p],
+                    card_samples[p], succ_walks[p]) for p in prefixes[1:]]))
+            num_walks = allocate_walks(scores, self.target_rel_error,
+                    self.batch_size)
+            if sum(num_walks) == 0:
+                break
+            for pi, path_info in enumerate(paths):
+                if num_walks[pi] > 0:
+                    self.walk_path(path_info, tables, num_walks[pi], stats)
+
+def get_estimate(est_sum, sq_sum, num, conf_alpha=CONF_ALPHA):
+    '''
+    @ret: mean of the walk estimates, and the half width of its confidence
+    interval.
+    '''
+    if num <= 1:
+        return est_sum, 0.0
+    mean = est_sum / num
+    var = max(sq_sum - est_sum**2 / num, 0.0) / (num - 1)
+    alpha = st.norm.ppf((conf_alpha+1)/2)
+    return mean, alpha*np.sqrt(var) / np.sqrt(num)
@@ -0,0 +1,44 @@
+import sys
+sys.path.append(".")
+sys.path.append("./scripts")
+import os
+
+from query_representation.query import *
+from query_representation.db_backends import get_db_backend
+from benchmarks.synthetic import *
+from cardinality_queue import *
+
+def test_queue(tmp_path):
+    qreps = gen_synthetic_workload([3,4], 2, 2, seed=5)
+    qfns = []
+    for i, qrep in enumerate(qreps):
+        qfn = os.path.join(str(tmp_path), str(i) + ".pkl")
+        save_qrep(qfn, qrep)
+        qfns.append(qfn)
+
+    queue_fn = os.path.join(str(tmp_path), "queue.db")
+    num_subplans = sum([len(q["subset_graph"].nodes()) for q in qreps])
+    assert init_queue(queue_fn, qfns, "actual2", 1000) == num_subplans
+    # already queued jobs are not added again
+    assert init_queue(queue_fn, qfns, "actual2", 1000) == 0
+
+    # a worker that died while running a job
+    con = connect_queue(queue_fn)
+    jobs = claim_jobs(con, "dead", 2)
+    con.execute("UPDATE jobs SET updated = 0 WHERE worker = 'dead'")
+    con.commit()
+    assert reset_stale_jobs(con) == 2
+    con.close()
+
+    # one backend per query, since the synthetic queries of a template can
+    # share subplan sqls with different cardinalities
+    db_backend = get_db_backend("local", qreps=qreps[0:1])
+    num_jobs = run_worker(queue_fn, "w0", db_backend, (None,)*5, 4, 2.0,
+            10000, 3)
+    assert num_jobs == num_subplans
+    assert queue_status(queue_fn)[DONE][0] == num_subplans
+
+    assert export_queue(queue_fn, "actual2") == len(qreps)
+    qrep = load_qrep(qfns[0])
+    for node, info in qrep["subset_graph"].nodes().items():
+        assert info["cardinality"]["actual2"] == info["cardinality"]["actual"]
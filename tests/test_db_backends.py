@@ -0,0 +1,111 @@
+import sys
+sys.path.append(".")
+import os
+import numpy as np
+
+from query_representation.query import *
+from query_representation.db_backends import *
+from evaluation.plan_losses import PPC, get_pg_join_order, get_leading_hint
+from cardinality_estimation.featurizer import Featurizer
+from benchmarks.synthetic import *
+
+def _get_qreps():
+    return gen_synthetic_workload([4,6], 2, 3, seed=7)
+
+def _get_cards(qrep, ckey):
+    cards = {}
+    for node, info in qrep["subset_graph"].nodes().items():
+        cards[" ".join(node)] = info["cardinality"][ckey]
+    return cards
+
+def test_local_count():
+    qreps = _get_qreps()
+    qrep = qreps[0]
+    db_backend = get_db_backend("local", qreps=[qrep])
+    for node, info in qrep["subset_graph"].nodes().items():
+        sql = nx_graph_to_query(qrep["join_graph"].subgraph(node))
+        output = execute_query(sql, None, None, None, None, None, [],
+                db_backend=db_backend)
+        assert output[0][0] == info["cardinality"]["actual"]
+
+    # unknown queries get a deterministic value
+    sql = "SELECT COUNT(*) FROM unknown AS u"
+    out1 = execute_query(sql, None, None, None, None, None, [],
+            db_backend=db_backend)
+    out2 = execute_query(sql, None, None, None, None, None, [],
+            db_backend=db_backend)
+    assert out1 == out2
+
+def test_local_explain():
+    qreps = _get_qreps()
+    db_backend = get_db_backend("local")
+    con = db_backend.connect()
+    cursor = con.cursor()
+    for qrep in qreps:
+        cursor.execute("/*+ " + " ".join(["Rows({} #{})".format(k, v) for k,v
+            in _get_cards(qrep, "expected").items()]) + " */ " + \
+                    "explain (format json) " + qrep["sql"])
+        explain = cursor.fetchall()
+        assert explain[0][0][0]["Plan"]["Node Type"] == "Aggregate"
+        _, join_ops, scan_ops = get_pg_join_order(qrep["join_graph"], explain)
+        assert len(scan_ops) == len(qrep["join_graph"].nodes())
+        assert len(join_ops) == len(qrep["join_graph"].nodes()) - 1
+        assert "Leading" in get_leading_hint(qrep["join_graph"], explain)
+
+def test_local_ppc(tmp_path):
+    qreps = _get_qreps()
+    db_backend = get_db_backend("local", qreps=qreps)
+    cwd = os.getcwd()
+    # PPC keeps its caches in the working directory
+    os.chdir(tmp_path)
+    try:
+        ppc = PPC("cm1", None, None, None, None, None, db_backend=db_backend)
+        sqls = [q["sql"] for q in qreps]
+        jgs = [q["join_graph"] for q in qreps]
+        trues = [_get_cards(q, "actual") for q in qreps]
+        ests = [_get_cards(q, "expected") for q in qreps]
+        costs, opt_costs, _, exec_sqls = ppc.compute_costs(sqls, jgs, trues,
+                ests, pool=None)
+        assert np.all(costs >= opt_costs)
+        assert "Rows(" in exec_sqls[0]
+
+        costs, opt_costs, _, _ = ppc.compute_costs(sqls, jgs, trues,
+                trues, pool=None)
+        assert np.allclose(costs, opt_costs)
+    finally:
+        os.chdir(cwd)
+
+def test_local_column_stats():
+    qreps = _get_qreps()
+    column_stats = get_synthetic_column_stats(qreps)
+    db_backend = get_db_backend("local", column_stats=column_stats)
+    featurizer = Featurizer(None, None, None, None, None,
+            db_backend=db_backend)
+    featurizer.update_column_stats(qreps)
+    for col, stats in column_stats.items():
+        for key in ["min_value", "max_value", "num_values", "total_values"]:
+            assert featurizer.column_stats[col][key] == stats[key]
+
+def test_local_buffers():
+    qrep = _get_qreps()[0]
+    db_backend = get_db_backend("local", io_latency=0.05)
+    cursor = db_backend.connect().cursor()
+    tables = set([info["real_name"] for info in
+        qrep["join_graph"].nodes().values()])
+
+    # explain does not read the tables, explain analyze does
+    cursor.execute("explain (format json) " + qrep["sql"])
+    assert "Actual Total Time" not in cursor.fetchall()[0][0][0]["Plan"]
+    assert len(db_backend.buffers) == 0
+    cursor.execute("explain (analyze, costs, format json) " + qrep["sql"])
+    explain = cursor.fetchall()[0][0][0]
+    assert explain["Execution Time"] == explain["Plan"]["Actual Total Time"]
+    assert explain["Plan"]["Plans"][0]["Actual Rows"] == \
+            explain["Plan"]["Plans"][0]["Plan Rows"]
+    assert db_backend.buffers == tables
+
+    db_backend.restart()
+    assert len(db_backend.buffers) == 0
+    for table in tables:
+        cursor.execute("SELECT pg_prewarm('{}')".format(table))
+    assert db_backend.buffers == tables
@@ -0,0 +1,80 @@
+import sys
+sys.path.append(".")
+import os
+
+from benchmarks.synthetic import *
+from cardinality_estimation.algs import *
+from cardinality_estimation.experiments import run_parallel, get_cpu_sets, \
+        successive_halving
+
+def _train_and_test(alg, featurizer, qreps):
+    alg.train(qreps, featurizer=featurizer)
+    return os.getpid(), len(alg.dataset_cache), alg.test(qreps)
+
+def test_run_parallel():
+    cpu_sets = get_cpu_sets(3)
+    assert len(cpu_sets) == 3
+    if len(os.sched_getaffinity(0)) >= 3:
+        assert len(set(sum(cpu_sets, []))) == len(sum(cpu_sets, []))
+
+    qreps = gen_synthetic_workload([3,4], 2, 3, seed=37)
+    featurizer = get_synthetic_featurizer(qreps, "combined")
+    dataset_cache = {}
+    algs = []
+    for hidden_layer_size in [16, 32, 64]:
+        alg = FCNN(max_epochs = 1, lr=0.0001, mb_size = 32,
+                weight_decay = 0.0, load_query_together = False,
+                result_dir = None, num_hidden_layers=2, eval_epoch = 1,
+                optimizer_name="adamw", clip_gradient=20.0,
+                loss_func_name = "mse", hidden_layer_size = hidden_layer_size,
+                dedup_subplans = True)
+        alg.featurizer = featurizer
+        alg.dataset_cache = dataset_cache
+        init_datasets(alg, qreps, [qreps])
+        algs.append(alg)
+    # one training, and one evaluation, dataset shared by all the algs
+    assert len(dataset_cache) == 2
+
+    results = run_parallel(_train_and_test,
+            [(alg, featurizer, qreps) for alg in algs], 2)
+    assert len(set([pid for pid, _, _ in results])) == 3
+    for _, num_datasets, ests in results:
+        # nothing was featurized again in the forked processes
+        assert num_datasets == 2
+        assert len(ests) == len(qreps)
+
+def _exit_job(job_idx):
+    if job_idx == 1:
+        # e.g., killed by the OOM killer
+        os._exit(9)
+    return job_idx
+
+def test_run_parallel_dead_job():
+    try:
+        run_parallel(_exit_job, [(i,) for i in range(3)], 3)
+    except AssertionError as e:
+        assert "1 parallel jobs failed" in str(e)
+    else:
+        assert False, "the dead job was not reported"
+
+def test_successive_halving():
+    configs = [{"lr": lr} for lr in [0.5, 0.1, 0.01, 0.001, 0.2, 0.05]]
+    runs = []
+    def run_fn(config_idx, config, num_epochs):
+        runs.append((config_idx, num_epochs))
+        return abs(config["lr"] - 0.01) / num_epochs
+
+    best_idx, history = successive_halving(configs, run_fn, 1, 9, eta=3)
+    assert best_idx == 2
+    # 6 configs for 1 epoch, 2 for 3, and the best for 9
+    assert len(runs) == 9
+    assert sorted(history[best_idx].keys()) == [1, 3, 9]
+    assert sorted(history[3].keys()) == [1, 3]
+    assert list(history[0].keys()) == [1]
+
+    # configs without a loss rank last
+    def run_fn(config_idx, config, num_epochs):
+        return None if config_idx == 0 else float(config_idx)
+    best_idx, history = successive_halving(configs, run_fn, 1, 3, eta=3)
+    assert best_idx == 1
+    assert list(history[0].keys()) == [1]
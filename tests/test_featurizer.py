@@ -0,0 +1,256 @@
+import sys
+sys.path.append(".")
+import sqlite3
+import networkx as nx
+import numpy as np
+
+from benchmarks.synthetic import *
+from cardinality_estimation.featurizer import Featurizer, get_num_paths
+from query_representation.utils import deterministic_hash
+
+def _old_flow_features(featurizer, node, subsetg, template_name, join_graph):
+    '''
+    the flow features of node computed from scratch, as before they were
+    cached per template.
+    '''
+    assert node != SOURCE_NODE
+    ckey = "cardinality"
+    flow_features = np.zeros(featurizer.num_flow_features, dtype=np.float32)
+    cur_idx = 0
+    # incoming edges
+    in_degree = subsetg.in_degree(node)
+    flow_features[cur_idx + in_degree] = 1.0
+    cur_idx += featurizer.max_in_degree+1
+    # outgoing edges
+    out_degree = subsetg.out_degree(node)
+    flow_features[cur_idx + out_degree] = 1.0
+    cur_idx += featurizer.max_out_degree+1
+    # num tables
+    max_tables = len(featurizer.aliases)
+    nt = len(node)
+    # assert nt <= max_tables
+    flow_features[cur_idx + nt] = 1.0
+    cur_idx += max_tables
+
+    # precomputed based stuff
+    if featurizer.feat_num_paths:
+        if node in featurizer.template_info[template_name]:
+            num_paths = featurizer.template_info[template_name][node]["num_paths"]
+        else:
+            num_paths = 0
+
+        # assuming min num_paths = 0, min-max normalization
+        flow_features[cur_idx] = num_paths / featurizer.max_paths
+        cur_idx += 1
+
+    if featurizer.feat_pg_costs and featurizer.heuristic_features and \
+            featurizer.cost_model is not None:
+        in_edges = subsetg.in_edges(node)
+        in_cost = 0.0
+        for edge in in_edges:
+            in_cost += subsetg[edge[0]][edge[1]][featurizer.cost_model + "pg_cost"]
+        # normalized pg cost
+        flow_features[cur_idx] = in_cost / subsetg.graph[featurizer.cost_model + "total_cost"]
+        cur_idx += 1
+
+    if featurizer.feat_tolerance:
+        tol = subsetg.nodes()[node]["tolerance"]
+        tol_idx = int(np.log10(tol))
+        assert tol_idx <= 4
+        flow_features[cur_idx + tol_idx-1] = 1.0
+        cur_idx += 4
+
+    if featurizer.feat_flows and featurizer.heuristic_features:
+        in_edges = subsetg.in_edges(node)
+        in_flows = 0.0
+        for edge in in_edges:
+            in_flows += subsetg[edge[0]][edge[1]]["pg_flow"]
+        # normalized pg flow
+        flow_features[cur_idx] = in_flows
+        cur_idx += 1
+
+    if featurizer.feat_pg_path:
+        if "pg_path" in subsetg.nodes()[node]:
+            flow_features[cur_idx] = 1.0
+
+    if featurizer.feat_join_graph_neighbors:
+        # neighbors = nx.node_boundary(join_graph, node)
+        neighbors = list(nx.node_boundary(join_graph, node))
+        neighbors.sort()
+
+        for al in neighbors:
+            if al not in featurizer.aliases:
+                # possible, for instance with set featurization - we don't
+                # reserve spots for all possible columns / tables in the
+                # unseen set
+                continue
+            table = featurizer.aliases[al]
+            tidx = featurizer.table_featurizer[table]
+            flow_features[cur_idx + tidx] = 1.0
+        cur_idx += len(featurizer.table_featurizer)
+
+    if featurizer.feat_rel_pg_ests and featurizer.heuristic_features \
+            and featurizer.cost_model is not None:
+        total_cost = subsetg.graph[featurizer.cost_model+"total_cost"]
+        pg_est = subsetg.nodes()[node][ckey]["expected"]
+        flow_features[cur_idx] = pg_est / total_cost
+        cur_idx += 1
+        neighbors = list(nx.node_boundary(join_graph, node))
+        neighbors.sort()
+
+        # neighbors in join graph
+        for al in neighbors:
+            if al not in featurizer.aliases:
+                continue
+            table = featurizer.aliases[al]
+            tidx = featurizer.table_featurizer[table]
+            ncard = subsetg.nodes()[tuple([al])][ckey]["expected"]
+            # TODO: should this be normalized? how?
+            flow_features[cur_idx + tidx] = pg_est / ncard
+            flow_features[cur_idx + tidx] /= 1e5
+
+        cur_idx += len(featurizer.table_featurizer)
+
+    if featurizer.feat_rel_pg_ests_onehot \
+            and featurizer.heuristic_features \
+            and featurizer.cost_model is not None:
+        total_cost = subsetg.graph[featurizer.cost_model+"total_cost"]
+        pg_est = subsetg.nodes()[node][ckey]["expected"]
+        # flow_features[cur_idx] = pg_est / total_cost
+        pg_ratio = total_cost / float(pg_est)
+
+        bucket = featurizer.get_onehot_bucket(featurizer.PG_EST_BUCKETS, 10, pg_ratio)
+        flow_features[cur_idx+bucket] = 1.0
+        cur_idx += featurizer.PG_EST_BUCKETS
+
+        # neighbors = nx.node_boundary(join_graph, node)
+        neighbors = list(nx.node_boundary(join_graph, node))
+        neighbors.sort()
+
+        # neighbors in join graph
+        for al in neighbors:
+            if al not in featurizer.aliases:
+                continue
+            table = featurizer.aliases[al]
+            tidx = featurizer.table_featurizer[table]
+            ncard = subsetg.nodes()[tuple([al])][ckey]["expected"]
+            # TODO: should this be normalized? how?
+            # flow_features[cur_idx + tidx] = pg_est / ncard
+            # flow_features[cur_idx + tidx] /= 1e5
+            if pg_est > ncard:
+                # first featurizer.PG_EST_BUCKETS
+                bucket = featurizer.get_onehot_bucket(featurizer.PG_EST_BUCKETS, 10,
+                        pg_est / float(ncard))
+                flow_features[cur_idx+bucket] = 1.0
+            else:
+                bucket = featurizer.get_onehot_bucket(featurizer.PG_EST_BUCKETS, 10,
+                        float(ncard) / pg_est)
+                flow_features[cur_idx+featurizer.PG_EST_BUCKETS+bucket] = 1.0
+
+            cur_idx += 2*featurizer.PG_EST_BUCKETS
+
+    if featurizer.feat_pg_est_one_hot and featurizer.heuristic_features:
+        pg_est = subsetg.nodes()[node][ckey]["expected"]
+
+        for i in range(featurizer.PG_EST_BUCKETS):
+            if pg_est > 10**i and pg_est < 10**(i+1):
+                flow_features[cur_idx+i] = 1.0
+                break
+
+        if pg_est > 10**featurizer.PG_EST_BUCKETS:
+            flow_features[cur_idx+featurizer.PG_EST_BUCKETS] = 1.0
+        cur_idx += featurizer.PG_EST_BUCKETS
+
+    return flow_features
+
+def test_flow_features():
+    qreps = gen_synthetic_workload([3,5], 2, 3, seed=11)
+    for qrep in qreps:
+        subsetg = qrep["subset_graph"]
+        dest = max(subsetg.nodes(), key=len)
+        num_paths = get_num_paths(subsetg, dest)
+        for node in subsetg.nodes():
+            assert num_paths[node] == \
+                    len(list(nx.all_simple_paths(subsetg, dest, node)))
+
+    featurizer = Featurizer(None, None, None, None, None)
+    featurizer.feat_num_paths = True
+    featurizer.column_stats = get_synthetic_column_stats(qreps)
+    featurizer.update_column_stats(qreps)
+    featurizer.setup(ynormalization="log", featurization_type="set",
+            flow_features=True, feat_num_paths=True)
+    featurizer.update_ystats(qreps)
+    assert featurizer.max_paths > 0
+
+    def _check_flow_features(subsetg, template_name, join_graph):
+        for node in subsetg.nodes():
+            if node == SOURCE_NODE:
+                continue
+            # template's cached rows + query's features, v/s computing all
+            feats = featurizer.get_flow_features(node, subsetg,
+                    template_name, join_graph)
+            exp_feats = _old_flow_features(featurizer, node, subsetg,
+                    template_name, join_graph)
+            assert np.array_equal(feats, exp_feats)
+
+    for qrep in qreps:
+        _check_flow_features(qrep["subset_graph"], qrep["template_name"],
+                qrep["join_graph"])
+
+    # another structure, with as many subplans, under the same template name
+    qrep = qreps[-1]
+    subsetg = qrep["subset_graph"].copy()
+    subsetg.remove_edge(*[edge for edge in subsetg.edges()
+        if SOURCE_NODE not in edge][0])
+    _check_flow_features(subsetg, qrep["template_name"], qrep["join_graph"])
+
+def test_column_sketches(tmp_path):
+    qreps = gen_synthetic_workload([3,4], 2, 3, seed=13)
+    db_fn = str(tmp_path / "stats.db")
+    load_synthetic_sqlite(db_fn, qreps, num_rows=500,
+            columns=SQLITE_COLUMNS + ["name"]).close()
+
+    featurizers = []
+    for column_sketches in [False, True]:
+        featurizer = Featurizer(None, None, None, None, None,
+                db_backend=SqliteBackend(db_fn),
+                column_sketches=column_sketches)
+        featurizer.update_column_stats(qreps)
+        featurizers.append(featurizer)
+
+    # same stats from the single scan
+    for col, stats in featurizers[0].column_stats.items():
+        sstats = featurizers[1].column_stats[col]
+        for key in ["min_value", "max_value", "num_values", "total_values"]:
+            assert stats[key] == sstats[key]
+        assert set(stats["unique_values"]) == set(sstats["unique_values"])
+
+    featurizer = featurizers[1]
+    featurizer.setup(ynormalization="log", featurization_type="set",
+            sketch_features=True)
+    featurizer.update_ystats(qreps)
+    con = sqlite3.connect(db_fn)
+    cursor = con.cursor()
+    num_checked = 0
+    for qrep in qreps:
+        rows = featurizer.get_query_set_rows(qrep)
+        for alias, ridx in rows["pred_idx"].items():
+            info = qrep["join_graph"].nodes()[alias]
+            if info["pred_types"][0] == "ilike":
+                continue
+            cursor.execute("SELECT COUNT(*) FROM {} AS {} WHERE {}".format(
+                info["real_name"], alias, " AND ".join(info["predicates"])))
+            true_sel = cursor.fetchall()[0][0] / 500.0
+            # the slot before the two heuristic estimates
+            assert abs(rows["pred"][ridx][-3] - true_sel) < 0.05
+            num_checked += 1
+    assert num_checked > 0
+
+def test_bucket_cache():
+    qreps = gen_synthetic_workload([3,4], 2, 3, seed=17)
+    featurizer = get_synthetic_featurizer(qreps, "set")
+    for qrep in qreps:
+        featurizer.get_query_set_rows(qrep)
+    assert len(featurizer.bucket_cache) > 0
+    for (val, num_buckets), bucket in featurizer.bucket_cache.items():
+        assert bucket == deterministic_hash(val) % num_buckets
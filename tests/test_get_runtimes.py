@@ -0,0 +1,123 @@
+import sys
+sys.path.append(".")
+sys.path.append("./evaluation")
+import os
+import ast
+import numpy as np
+import pandas as pd
+
+from query_representation.query import *
+from benchmarks.synthetic import *
+import get_runtimes
+
+def _write_costs(result_dir, qreps, dups):
+    '''
+    @dups: qnames with the same sql as the first query.
+    '''
+    os.makedirs(result_dir, exist_ok=True)
+    rows = []
+    for i, qrep in enumerate(qreps):
+        rows.append({"qname": str(i) + ".pkl", "join_order": "",
+            "exec_sql": "explain (format json) " + qrep["sql"], "cost": 1.0})
+    for qname in dups:
+        rows.append(dict(rows[0], qname=qname))
+    pd.DataFrame(rows).to_csv(os.path.join(result_dir,
+        "PostgresPlanCost.csv"), index=False)
+
+def _run(monkeypatch, result_dir, plan_cache_dir, flags=[]):
+    '''
+    @ret: number of sqls executed.
+    '''
+    monkeypatch.setattr(sys, "argv", ["get_runtimes.py", "--db_backend",
+        "local", "--result_dir", result_dir, "--plan_cache_dir",
+        plan_cache_dir] + flags)
+    get_runtimes.args = get_runtimes.read_flags()
+    executed = []
+    execute_sql = get_runtimes.execute_sql
+    def _execute_sql(sql, *args, **kwargs):
+        executed.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+    monkeypatch.setattr(get_runtimes, "execute_sql", _execute_sql)
+    get_runtimes.main()
+    monkeypatch.undo()
+    return len(executed)
+
+def test_runtimes_plan_cache(tmp_path, monkeypatch):
+    qreps = gen_synthetic_workload([3,4], 2, 1, seed=3)
+    result_dir = str(tmp_path / "results1")
+    plan_cache_dir = str(tmp_path / "plan_cache")
+    _write_costs(result_dir, qreps, ["dup.pkl"])
+
+    # the duplicate plan is executed once
+    assert _run(monkeypatch, result_dir, plan_cache_dir,
+            ["--num_sessions", "2"]) == len(qreps)
+    rt_fn = os.path.join(result_dir, "Runtimes.csv")
+    runtimes = pd.read_csv(rt_fn)
+    assert len(runtimes) == len(qreps) + 1
+    rts = dict(zip(runtimes["qname"], runtimes["runtime"]))
+    assert rts["dup.pkl"] == rts["0.pkl"]
+
+    # stored queries are skipped
+    assert _run(monkeypatch, result_dir, plan_cache_dir) == 0
+    assert len(pd.read_csv(rt_fn)) == len(qreps) + 1
+
+    # the plans executed for the first result dir are reused
+    result_dir2 = str(tmp_path / "results2")
+    _write_costs(result_dir2, qreps, [])
+    assert _run(monkeypatch, result_dir2, plan_cache_dir) == 0
+    runtimes2 = pd.read_csv(os.path.join(result_dir2, "Runtimes.csv"))
+    assert dict(zip(runtimes2["qname"], runtimes2["runtime"])) == \
+            {qname: rts[qname] for qname in runtimes2["qname"]}
+
+    # but not the ones simulated with another local backend
+    result_dir3 = str(tmp_path / "results3")
+    _write_costs(result_dir3, qreps, [])
+    assert _run(monkeypatch, result_dir3, plan_cache_dir,
+            ["--local_io_latency", "0.001"]) == len(qreps)
+
+    # or timed with other trials
+    result_dir4 = str(tmp_path / "results4")
+    _write_costs(result_dir4, qreps, [])
+    assert _run(monkeypatch, result_dir4, plan_cache_dir,
+            ["--num_trials", "2"]) == 2*len(qreps)
+
+def test_runtimes_trials(tmp_path, monkeypatch):
+    qreps = gen_synthetic_workload([3,4], 2, 1, seed=3)
+    result_dir = str(tmp_path / "results")
+    _write_costs(result_dir, qreps, [])
+    rt_fn = os.path.join(result_dir, "Runtimes.csv")
+    # the old format, before the repeated trials
+    pd.DataFrame([{"qname": "0.pkl", "runtime": 1.0, "exp_analyze": None}])\
+            .to_csv(rt_fn, index=False)
+
+    io_latency = 0.01
+    num_executed = _run(monkeypatch, result_dir, "", ["--warmup_runs", "1",
+        "--num_trials", "3", "--cache_state", "cold", "--local_io_latency",
+        str(io_latency)])
+    assert num_executed == 4*(len(qreps)-1)
+
+    runtimes = pd.read_csv(rt_fn)
+    assert list(runtimes.columns) == get_runtimes.RUNTIME_COLUMNS
+    assert len(runtimes) == len(qreps)
+    assert runtimes["runtime"].values[0] == 1.0
+    assert np.isnan(runtimes["runtime_p95"].values[0])
+
+    for i, row in runtimes.iloc[1:].iterrows():
+        trials = ast.literal_eval(row["trials"])
+        assert len(trials) == 3
+        assert np.isclose(row["runtime"], np.median(trials))
+        assert np.isclose(row["runtime_p95"], np.percentile(trials, 95))
+        # every cold trial reads all the tables
+        qrep = qreps[int(row["qname"].replace(".pkl", ""))]
+        assert min(trials) >= io_latency*len(qrep["join_graph"].nodes())
+
+        # scans and joins, from the local EXPLAIN ANALYZE plan
+        op_times = ast.literal_eval(row["op_times"])
+        assert op_times[0]["node_type"] == "Aggregate"
+        scans = [op["relation"] for op in op_times
+                if op["relation"] is not None]
+        assert sorted(scans) == sorted(qrep["join_graph"].nodes())
+        for op in op_times:
+            assert 0.0 <= op["self_time"] <= op["total_time"]
+        assert np.isclose(sum([op["self_time"] for op in op_times]),
+                op_times[0]["total_time"])
@@ -0,0 +1,33 @@
+import sys
+sys.path.append(".")
+import numpy as np
+import pygtrie
+
+from query_gen.predicate_samplers import InSampler, IlikeSampler
+
+def test_ilike_sampler():
+    trie = pygtrie.CharTrie()
+    for token, count in {"star":10, "stark":5, "wars":20, "war":1, "a":3}.items():
+        trie[token] = count
+    sampler = IlikeSampler(trie)
+    rng = np.random.RandomState(0)
+
+    for _ in range(20):
+        prefix, size = sampler.sample(rng, 2, 3, 14, 100)
+        assert 2 <= len(prefix) <= 3
+        # size is the total count of the tokens starting with prefix
+        assert size == sum(trie[prefix:])
+        assert 14 < size < 100
+    assert sampler.sample(rng, 2, 3, 1000, 2000) == (None, None)
+
+def test_in_sampler():
+    output = [("v{}".format(i), i) for i in range(20)]
+    sampler = InSampler(output)
+    rng = np.random.RandomState(0)
+    pred_group = {"min_samples": 3, "max_samples": 5,
+            "sampling_method": "quantile", "num_quantiles": 4}
+    for _ in range(20):
+        samples = sampler.sample(rng, pred_group)
+        assert 3 <= len(samples) <= 5
+        # all from one quantile partition, of 5 rows each
+        assert len(set([s[1] // 5 for s in samples])) == 1
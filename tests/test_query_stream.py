@@ -0,0 +1,247 @@
+import sys
+sys.path.append(".")
+import os
+import copy
+import numpy as np
+import torch
+from torch.utils import data
+
+from query_representation.query import *
+from benchmarks.synthetic import *
+from cardinality_estimation.dataset import QueryDataset, QueryStream, \
+        get_feature_matrix, collate_queries
+from cardinality_estimation.algs import *
+import cardinality_estimation.algs as algs
+
+def _save_qreps(tmp_path, qreps):
+    qfns = []
+    for i, qrep in enumerate(qreps):
+        qfns.append(os.path.join(str(tmp_path), "{}.pkl".format(i)))
+        save_qrep(qfns[-1], qrep)
+    return qfns
+
+def test_stream_samples(tmp_path):
+    qreps = gen_synthetic_workload([3,4], 2, 5, seed=5)
+    qfns = _save_qreps(tmp_path, qreps)
+    featurizer = get_synthetic_featurizer(qreps, "combined")
+    ds = QueryDataset(qreps, featurizer, False)
+
+    stream = QueryStream(qfns, featurizer, shard_size=3,
+            shuffle_buffer_size=20)
+    for num_workers in [0, 2]:
+        loader = data.DataLoader(stream, batch_size=16,
+                num_workers=num_workers)
+        ys = torch.cat([y for _, y, _ in loader]).numpy()
+        # every subplan exactly once, in a different order
+        assert len(ys) == len(ds)
+        assert np.allclose(np.sort(ys), np.sort(ds.Y.numpy()))
+        assert not np.allclose(ys, ds.Y.numpy())
+
+def test_stream_train(tmp_path):
+    qreps = gen_synthetic_workload([3,4], 2, 4, seed=7)
+    qfns = _save_qreps(tmp_path, qreps)
+    for alg_cls, feat_type in [(FCNN, "combined"), (MSCN, "set")]:
+        featurizer = get_synthetic_featurizer(qreps, feat_type)
+        alg = alg_cls(max_epochs = 2, lr=0.0001, mb_size = 32,
+                load_padded_mscn_feats = False,
+                weight_decay = 0.0, load_query_together = False,
+                result_dir = None, num_hidden_layers=2, eval_epoch = 1,
+                optimizer_name="adamw", clip_gradient=20.0,
+                loss_func_name = "mse", hidden_layer_size = 32,
+                stream_shard_size = 3, stream_buffer_size = 50,
+                stream_num_workers = 0)
+        alg.train(qfns, featurizer=featurizer)
+        assert isinstance(alg.trainds, QueryStream)
+        ests = alg.test(qreps)
+        assert len(ests) == len(qreps)
+
+def test_set_idxs():
+    qreps = gen_synthetic_workload([3,5], 2, 2, seed=9)
+    featurizer = get_synthetic_featurizer(qreps, "set")
+    ds = QueryDataset(qreps, featurizer, False)
+    assert ds.set_idxs
+    idx = 0
+    for qrep in qreps:
+        nodes = [n for n in qrep["subset_graph"].nodes() if n != SOURCE_NODE]
+        nodes.sort()
+        rows = featurizer.get_query_set_rows(qrep)
+        assert len(rows["table"]) == len(qrep["join_graph"].nodes())
+        for node in nodes:
+            x, _ = featurizer.get_subplan_features(qrep, node)
+            dsx = ds[idx][0]
+            for key in ["table", "pred", "join"]:
+                assert np.array_equal(np.array(x[key]), np.array(dsx[key]))
+            idx += 1
+
+def test_dedup_subplans():
+    qreps = gen_synthetic_workload([3,4], 2, 4, seed=19)
+    # same subplans, with the same estimates, in a second copy of the queries
+    qreps = qreps + [copy.deepcopy(qrep) for qrep in qreps]
+    for alg_cls, feat_type in [(FCNN, "combined"), (MSCN, "set")]:
+        featurizer = get_synthetic_featurizer(qreps, feat_type)
+        ds = QueryDataset(qreps, featurizer, False, dedup_subplans=True)
+        assert ds.dedup_ratio >= 2.0
+        assert len(ds.subplan_idxs) == len(QueryDataset(qreps, featurizer,
+            False))
+
+        alg = alg_cls(max_epochs = 1, lr=0.0001, mb_size = 32,
+                load_padded_mscn_feats = False,
+                weight_decay = 0.0, load_query_together = False,
+                result_dir = None, num_hidden_layers=2, eval_epoch = 1,
+                optimizer_name="adamw", clip_gradient=20.0,
+                loss_func_name = "mse", hidden_layer_size = 32)
+        alg.train(qreps, featurizer=featurizer)
+        ests = alg.test(qreps)
+        alg.dedup_subplans = True
+        dedup_ests = alg.test(qreps)
+        for est, dest in zip(ests, dedup_ests):
+            assert est.keys() == dest.keys()
+            for node in est:
+                assert np.isclose(est[node], dest[node], rtol=1e-4)
+
+def test_tree_models(tmp_path, monkeypatch):
+    qreps = gen_synthetic_workload([3,4], 2, 4, seed=23)
+    featurizer = get_synthetic_featurizer(qreps, "combined")
+    ds = QueryDataset(qreps, featurizer, False)
+    X, Y = get_feature_matrix(featurizer, qreps)
+    assert np.array_equal(X, ds.X.numpy())
+    assert np.array_equal(Y, ds.Y.numpy())
+
+    # the QuantileDMatrix passes over the chunks featurize each of them once
+    num_calls = []
+    def _get_feature_matrix(*args):
+        num_calls.append(1)
+        return get_feature_matrix(*args)
+    monkeypatch.setattr(algs, "get_feature_matrix", _get_feature_matrix)
+    it = QueryMatrixIter(qreps, featurizer, 3, cache_chunks=True)
+    dmat = xgb.QuantileDMatrix(it)
+    assert dmat.num_row() == len(X)
+    assert len(num_calls) == len(range(0, len(qreps), 3))
+    monkeypatch.undo()
+
+    all_ests = []
+    for external_memory in [False, True]:
+        alg = XGBoost(grid_search=False, tree_method="hist", subsample=1.0,
+                n_estimators=10, max_depth=4, lr=0.1, chunk_size=3,
+                external_memory=external_memory,
+                cache_dir=str(tmp_path / "xgb_cache"))
+        alg.train(qreps, featurizer=featurizer)
+        all_ests.append(alg.test(qreps))
+    for ests, ext_ests in zip(*all_ests):
+        for node in ests:
+            assert np.isclose(ests[node], ext_ests[node])
+
+    alg = RandomForest(grid_search=False, n_estimators=5, max_depth=4,
+            lr=0.01, chunk_size=3)
+    alg.train(qreps, featurizer=featurizer)
+    assert len(alg.test(qreps)) == len(qreps)
+
+def _get_fcnn(**kwargs):
+    return FCNN(mb_size = 32, weight_decay = 0.0,
+            load_query_together = False, result_dir = None,
+            num_hidden_layers=2, optimizer_name="adamw", clip_gradient=20.0,
+            loss_func_name = "mse", hidden_layer_size = 32, **kwargs)
+
+def test_val_qerrors():
+    qrep = gen_synthetic_workload([3], 1, 1, seed=29)[0]
+    nodes = [node for node in qrep["subset_graph"].nodes()
+            if node != SOURCE_NODE]
+    qrep["subset_graph"].nodes()[nodes[0]]["cardinality"]["actual"] = 0
+    ests = {node: 10.0 for node in nodes}
+    ests[nodes[1]] = 0.0
+    errors = algs._get_qerrors([qrep], [ests], "cardinality")
+    # 0 cardinalities count as 1, as in the QError eval function
+    assert np.all(np.isfinite(errors))
+    assert errors[0] == 10.0
+
+def test_early_stopping(tmp_path):
+    qreps = gen_synthetic_workload([3,4], 2, 4, seed=29)
+    trainqs, valqs = qreps[:6], qreps[6:]
+    featurizer = get_synthetic_featurizer(qreps, "combined")
+    checkpoint_dir = str(tmp_path / "checkpoints")
+
+    alg = _get_fcnn(max_epochs=3, lr=0.001, eval_epoch=1,
+            early_stopping_patience=5, checkpoint_dir=checkpoint_dir)
+    alg.train(trainqs, featurizer=featurizer, valqs=valqs)
+    assert alg.epoch == 2
+    assert os.path.exists(os.path.join(checkpoint_dir, "checkpoint.pt"))
+
+    # resumes after the last checkpointed epoch
+    epochs = []
+    alg = _get_fcnn(max_epochs=5, lr=0.001, eval_epoch=1,
+            early_stopping_patience=5, checkpoint_dir=checkpoint_dir)
+    alg.train_one_epoch = lambda: epochs.append(alg.epoch)
+    alg.train(trainqs, featurizer=featurizer, valqs=valqs)
+    assert epochs == [3, 4]
+
+    # the last epoch is evaluated, and checkpointed, whatever the eval_epoch
+    checkpoint_dir = str(tmp_path / "last_epoch")
+    alg = _get_fcnn(max_epochs=1, lr=0.001, eval_epoch=2,
+            early_stopping_patience=5, checkpoint_dir=checkpoint_dir)
+    alg.train(trainqs, featurizer=featurizer, valqs=valqs)
+    assert alg.best_val_qerr is not None
+    epochs = []
+    alg = _get_fcnn(max_epochs=3, lr=0.001, eval_epoch=2,
+            early_stopping_patience=5, checkpoint_dir=checkpoint_dir)
+    alg.train_one_epoch = lambda: epochs.append(alg.epoch)
+    alg.train(trainqs, featurizer=featurizer, valqs=valqs)
+    assert epochs == [1, 2]
+
+    # the val q-error never improves without any updates
+    checkpoint_dir = str(tmp_path / "stopped")
+    epochs = []
+    alg = _get_fcnn(max_epochs=10, lr=0.0, eval_epoch=1,
+            early_stopping_patience=2, checkpoint_dir=checkpoint_dir)
+    alg.train_one_epoch = lambda: epochs.append(alg.epoch)
+    alg.train(trainqs, featurizer=featurizer, valqs=valqs)
+    assert epochs == [0, 1, 2]
+    best_qerr = alg.best_val_qerr
+
+    # a run that stopped early is not trained further when resumed
+    epochs = []
+    alg = _get_fcnn(max_epochs=10, lr=0.0, eval_epoch=1,
+            early_stopping_patience=2, checkpoint_dir=checkpoint_dir)
+    alg.train_one_epoch = lambda: epochs.append(alg.epoch)
+    alg.train(trainqs, featurizer=featurizer, valqs=valqs)
+    assert epochs == []
+    assert alg.best_val_qerr == best_qerr
+
+def test_load_query_together():
+    qreps = gen_synthetic_workload([3,4], 2, 3, seed=31)
+    for alg_cls, feat_type, padded in [(FCNN, "combined", False),
+            (MSCN, "set", False), (MSCN, "set", True)]:
+        featurizer = get_synthetic_featurizer(qreps, feat_type)
+        ds = QueryDataset(qreps, featurizer, False,
+                load_padded_mscn_feats=padded)
+        qds = QueryDataset(qreps, featurizer, True,
+                load_padded_mscn_feats=padded)
+        assert len(qds) == len(qreps)
+        assert sum(qds.idx_lens) == len(ds)
+
+        # a query's subplans, in the order of the ungrouped samples
+        if feat_type == "combined":
+            x, y, info, offsets = collate_queries([qds[1]])
+            start = qds.start_idxs[1]
+            assert torch.equal(x, ds.X[start:start+qds.idx_lens[1]])
+            assert [i["query_idx"] for i in info] == [1]*qds.idx_lens[1]
+        else:
+            assert len(qds[1]) == qds.idx_lens[1]
+
+        # the (start, len) of each query's subplans in the minibatch
+        collate_fn = mscn_collate_fn if feat_type == "set" and not padded \
+                else None
+        x, y, info, offsets = collate_queries([qds[2], qds[0]],
+                collate_fn=collate_fn)
+        assert offsets == [(0, qds.idx_lens[2]),
+                (qds.idx_lens[2], qds.idx_lens[0])]
+        assert len(y) == qds.idx_lens[2] + qds.idx_lens[0]
+
+        alg = alg_cls(max_epochs = 1, lr=0.0001, mb_size = 32,
+                load_padded_mscn_feats = padded,
+                weight_decay = 0.0, load_query_together = True,
+                result_dir = None, num_hidden_layers=2, eval_epoch = 1,
+                optimizer_name="adamw", clip_gradient=20.0,
+                loss_func_name = "mse", hidden_layer_size = 32)
+        alg.train(qreps, featurizer=featurizer)
+        assert alg.trainds.load_query_together
+        assert len(alg.test(qreps)) == len(qreps)
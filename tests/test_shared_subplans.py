@@ -0,0 +1,31 @@
+import sys
+sys.path.append(".")
+sys.path.append("./scripts")
+import numpy as np
+
+from query_representation.utils import *
+from benchmarks.synthetic import *
+from shared_subplans import SharedSubplanCounter
+
+def test_shared_counts():
+    qreps = gen_synthetic_workload([3,5], 2, 2, seed=3)
+    for qrep in qreps:
+        # sqlite does not support ILIKE
+        for _, info in qrep["join_graph"].nodes(data=True):
+            info["predicates"] = [p for p in info["predicates"]
+                    if "ILIKE" not in p]
+
+    con = load_synthetic_sqlite(":memory:", qreps)
+    cursor = con.cursor()
+    for qrep in qreps:
+        counter = SharedSubplanCounter(qrep, cursor)
+        assert counter.supported()
+        subsets = list(qrep["subset_graph"].nodes())
+        counts = counter.get_counts(subsets)
+        counter.cleanup()
+        assert len(counts) == len(subsets)
+
+        for subset in subsets:
+            sql = nx_graph_to_query(qrep["join_graph"].subgraph(subset))
+            cursor.execute(sql)
+            assert counts[subset][0] == cursor.fetchall()[0][0]
@@ -0,0 +1,74 @@
+import sys
+sys.path.append(".")
+import pytest
+
+from query_representation.utils import *
+from query_representation.sql_parser import parse_query
+
+SQL = """SELECT COUNT(*) FROM title as t, movie_info as mi, cast_info ci
+WHERE t.id = mi.movie_id AND ci.movie_id=t.id
+AND (mi.info IN ('a','b''c') OR mi.info IS NULL)
+AND t.title NOT ILIKE '%war%'
+AND t.production_year BETWEEN 1990 AND 2000
+AND ci.role_id<=3 AND ci.role_id>1;"""
+
+def test_join_graph():
+    froms, aliases, tables = extract_from_clause(SQL)
+    assert froms == ["title AS t", "movie_info AS mi", "cast_info AS ci"]
+    assert aliases == {"t":"title", "mi":"movie_info", "ci":"cast_info"}
+    assert extract_join_clause(SQL) == ["t.id = mi.movie_id",
+            "ci.movie_id = t.id"]
+
+    jg = extract_join_graph(SQL)
+    assert list(jg.nodes()) == ["t", "mi", "ci"]
+    assert jg["ci"]["t"]["join_condition"] == "ci.movie_id = t.id"
+    # same strings as find_all_clauses
+    assert jg.nodes()["mi"]["predicates"] == \
+            [" (mi.info IN ('a','b''c') OR mi.info IS NULL)"]
+    assert jg.nodes()["ci"]["predicates"] == [" ci.role_id<=3",
+            " ci.role_id>1 ;"]
+
+    assert jg.nodes()["mi"]["pred_types"] == ["in", "in"]
+    assert jg.nodes()["mi"]["pred_vals"] == [["a", "b'c"], ["NULL"]]
+    assert jg.nodes()["t"]["pred_types"] == ["nilike", "lt"]
+    assert jg.nodes()["t"]["pred_vals"] == [["%war%"], [1990, 2000]]
+    assert jg.nodes()["ci"]["pred_cols"] == ["ci.role_id"]
+    assert jg.nodes()["ci"]["pred_vals"] == [[1, 3]]
+
+def test_unsupported_sql():
+    sql = "SELECT COUNT(*) FROM title t JOIN movie_info mi ON t.id = mi.movie_id"
+    with pytest.raises(ValueError):
+        parse_query(sql)
+    # falls back to sqlparse
+    assert extract_from_clause(sql)[2][0] == "title"
+
+CAST_SQL = """SELECT COUNT(*) FROM title as t, movie_info_idx as mii1,
+movie_info_idx as mii2
+WHERE t.id = mii1.movie_id AND t.id = mii2.movie_id
+AND (mii1.info ~ '^(?:[1-9]\\d*|0)?(?:\\.\\d+)?$' AND 1000.0 <= mii1.info::float)
+AND (mii1.info ~ '^(?:[1-9]\\d*|0)?(?:\\.\\d+)?$' AND mii1.info::float <= 10000.0)
+AND 3.0 <= mii2.info::float AND mii2.info::float <= 7.0
+AND 1990 < t.production_year"""
+
+def test_cast_predicates(monkeypatch):
+    # 7a style ranges, with type cast columns on both sides
+    jg = extract_join_graph(CAST_SQL)
+    assert jg.nodes()["mii2"]["predicates"] == [" 3.0 <= mii2.info::float",
+            " mii2.info::float <= 7.0"]
+    assert len(jg.nodes()["mii1"]["predicates"]) == 2
+    assert jg.nodes()["mii1"]["pred_vals"] == [[1000.0, 10000.0]]
+    assert jg.nodes()["mii2"]["pred_cols"] == ["mii2.info"]
+    assert jg.nodes()["mii2"]["pred_vals"] == [[3.0, 7.0]]
+    assert jg.nodes()["t"]["pred_vals"] == [[1990, None]]
+    assert extract_join_clause(CAST_SQL) == \
+            ["t.id = mii1.movie_id", "t.id = mii2.movie_id"]
+
+    # same predicates as the sqlparse path
+    import query_representation.utils as utils
+    def _unsupported(sql):
+        raise ValueError()
+    monkeypatch.setattr(utils, "parse_query", _unsupported)
+    sqlparse_jg = extract_join_graph(CAST_SQL)
+    for alias in jg.nodes():
+        assert jg.nodes()[alias]["predicates"] == \
+                sqlparse_jg.nodes()[alias]["predicates"]
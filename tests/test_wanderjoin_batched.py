@@ -0,0 +1,91 @@
+import sys
+sys.path.append(".")
+sys.path.append("./scripts")
+import sqlite3
+import networkx as nx
+import numpy as np
+
+from query_representation.utils import *
+from benchmarks.synthetic import *
+from wanderjoin_batched import BatchedWanderJoin, JoinIndex, get_join_keys
+from join_index import build_join_index, get_join_index_columns, \
+        JoinIndexStore
+
+def test_join_index():
+    col = np.array([3, 1, 3, 2, 3], dtype=np.int64)
+    index = JoinIndex.build(col)
+    rows, fanouts = index.sample(np.array([3, 4, 1]), np.random.RandomState(0))
+    assert list(fanouts) == [3, 0, 1]
+    assert col[rows[0]] == 3 and rows[1] == -1 and rows[2] == 1
+
+def _check_estimates(tmp_path, use_join_index, target_rel_error=None):
+    qreps = gen_synthetic_workload([4], 1, 2, seed=5)
+    for qrep in qreps:
+        # sqlite does not support ILIKE
+        for _, info in qrep["join_graph"].nodes(data=True):
+            info["predicates"] = [p for p in info["predicates"]
+                    if "ILIKE" not in p]
+
+    db_fn = str(tmp_path / "wj.db")
+    con = load_synthetic_sqlite(db_fn, qreps)
+    cursor = con.cursor()
+    join_index = None
+    if use_join_index:
+        index_dir = str(tmp_path / "join_index")
+        build_join_index(cursor, index_dir, get_join_index_columns(qreps))
+        join_index = JoinIndexStore(index_dir)
+
+    wj = BatchedWanderJoin("", "", "", 0, "", walks_timeout=2.0,
+            batch_size=2000, min_succ_walks=20000,
+            db_backend=SqliteBackend(db_fn), join_index=join_index,
+            target_rel_error=target_rel_error)
+
+    for qrep in qreps:
+        data = wj.get_counts(qrep)
+        for subset in qrep["subset_graph"].nodes():
+            if subset == SOURCE_NODE:
+                continue
+            sql = nx_graph_to_query(qrep["join_graph"].subgraph(subset))
+            cursor.execute(sql)
+            true_card = cursor.fetchall()[0][0]
+            num = data["card_samples"][subset]
+            est = data["card_ests_sum"][subset] / num
+            if len(subset) == 1:
+                assert est == true_card
+            elif true_card > 100:
+                assert abs(est - true_card) / true_card < 0.2
+
+def test_batched_estimates(tmp_path):
+    _check_estimates(tmp_path, False)
+
+def test_join_index_estimates(tmp_path):
+    _check_estimates(tmp_path, True)
+
+def test_adaptive_estimates(tmp_path):
+    _check_estimates(tmp_path, False, target_rel_error=0.05)
+
+def test_join_index_codes(tmp_path):
+    # text join keys, with only t1 in the join index
+    db_fn = str(tmp_path / "codes.db")
+    con = sqlite3.connect(db_fn)
+    cursor = con.cursor()
+    for table, keys in [("t1", ["x", "y", "z"]), ("t2", ["z", "w", "x"])]:
+        cursor.execute("CREATE TABLE {} (id INTEGER, k TEXT)".format(table))
+        cursor.executemany("INSERT INTO {} VALUES (?,?)".format(table),
+                list(enumerate(keys)))
+    con.commit()
+    index_dir = str(tmp_path / "join_index")
+    build_join_index(cursor, index_dir, {"t1": ["k"]})
+
+    join_graph = nx.Graph()
+    join_graph.add_node("a", real_name="t1", predicates=[])
+    join_graph.add_node("b", real_name="t2", predicates=[])
+    join_graph.add_edge("a", "b", join_condition="a.k = b.k")
+    wj = BatchedWanderJoin("", "", "", 0, "", db_backend=SqliteBackend(db_fn),
+            join_index=JoinIndexStore(index_dir))
+    tables = wj.load_tables(join_graph, get_join_keys(join_graph))
+    a_keys = tables["a"].values("k", np.arange(3))
+    b_keys = tables["b"].values("k", np.arange(3))
+    # z, x
+    assert b_keys[0] == a_keys[2] and b_keys[2] == a_keys[0]
+    assert b_keys[1] not in a_keys